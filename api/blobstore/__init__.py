@@ -0,0 +1,40 @@
+# elixire: Image Host software
+# Copyright 2018-2019, elixi.re Team and the elixire contributors
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+elixire - blob storage backends
+
+Where the contents of uploaded files live. Files refer to their
+contents by location (the fspath column, see the blobs table), which
+is given by the backend that stored them.
+"""
+from .base import BlobStore, BlobStoreError
+from .local import LocalBlobStore
+from .s3 import S3BlobStore
+
+BACKENDS = {
+    "local": LocalBlobStore,
+    "s3": S3BlobStore,
+}
+
+
+def create_blobstore(app) -> BlobStore:
+    """Create the storage backend set in STORAGE_BACKEND."""
+    name = getattr(app.econfig, "STORAGE_BACKEND", "local")
+
+    try:
+        backend = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown storage backend: {name!r}")
+
+    return backend(app)
+
+
+__all__ = [
+    "BlobStore",
+    "BlobStoreError",
+    "LocalBlobStore",
+    "S3BlobStore",
+    "create_blobstore",
+]
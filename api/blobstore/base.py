@@ -0,0 +1,59 @@
+# elixire: Image Host software
+# Copyright 2018-2019, elixi.re Team and the elixire contributors
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import asyncio
+from typing import List, Optional
+
+
+class BlobStoreError(Exception):
+    """Raised when the storage backend fails to do something."""
+
+
+class BlobStore:
+    """Interface of the storage backends."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def location(self, file_hash: str, extension: str) -> str:
+        """Give the location new contents with the given
+        hash and extension are stored at."""
+        raise NotImplementedError()
+
+    def local_path(self, location: str) -> Optional[str]:
+        """Give the path of the contents in the local filesystem,
+        if the backend keeps them there."""
+        return None
+
+    async def put(self, location: str, source: str):
+        """Store the contents of a local file. The file may
+        be moved into place instead of copied."""
+        raise NotImplementedError()
+
+    async def get_range(
+        self, location: str, start: int = 0, end: Optional[int] = None
+    ) -> bytes:
+        """Read the contents from start up to (not including) end."""
+        raise NotImplementedError()
+
+    async def stat(self, location: str) -> Optional[int]:
+        """Give the size of the contents, or None if they don't exist."""
+        raise NotImplementedError()
+
+    async def stat_many(self, locations: List[str]) -> List[Optional[int]]:
+        return list(await asyncio.gather(*map(self.stat, locations)))
+
+    async def delete_many(self, locations: List[str]):
+        """Delete contents. Missing ones are ignored."""
+        raise NotImplementedError()
+
+    async def delete(self, location: str):
+        await self.delete_many([location])
+
+    async def presign(
+        self, location: str, *, mimetype: Optional[str] = None
+    ) -> Optional[str]:
+        """Give an URL the contents can be fetched from directly,
+        if the backend can serve them."""
+        return None
@@ -0,0 +1,113 @@
+# elixire: Image Host software
+# Copyright 2018-2019, elixi.re Team and the elixire contributors
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import List, Optional
+
+from .base import BlobStore
+
+log = logging.getLogger(__name__)
+
+#: the layout of IMAGE_FOLDER when IMAGE_SHARDS isn't set,
+#  a single level of folders named after the first hash character
+DEFAULT_SHARDS = (1,)
+
+
+def shard_path(file_hash: str, shards) -> str:
+    """Give the path of contents relative to IMAGE_FOLDER, with one
+    folder level per entry of shards, each as wide as the entry.
+
+    shard_path("abcdef", (2, 2)) == "ab/cd/abcdef"
+    """
+    folders, start = [], 0
+    for width in shards:
+        folders.append(file_hash[start : start + width])
+        start += width
+
+    return "/".join(folders + [file_hash])
+
+
+def _read(path: str, start: int, end: Optional[int]) -> bytes:
+    with open(path, "rb") as fhandle:
+        fhandle.seek(start)
+        return fhandle.read(-1 if end is None else end - start)
+
+
+def _sizes(paths: List[str]) -> List[Optional[int]]:
+    sizes = []
+    for path in paths:
+        try:
+            sizes.append(os.stat(path).st_size)
+        except FileNotFoundError:
+            sizes.append(None)
+
+    return sizes
+
+
+def _move(source: str, path: str):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    shutil.move(source, path)
+
+
+def _unlink(paths: List[str]):
+    for path in paths:
+        try:
+            Path(path).unlink()
+            log.info(f"Deleted {path!s} since no files refer to it")
+        except FileNotFoundError:
+            log.warning(f"fspath {path!s} does not exist")
+
+
+class LocalBlobStore(BlobStore):
+    """Keeps contents in IMAGE_FOLDER, in the local filesystem.
+
+    Locations are absolute paths. Contents are sharded in folders
+    by their hash, as set in IMAGE_SHARDS. Locations of another layout
+    still resolve while files are moved to the current one (see
+    manage.py reshard_files).
+    """
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.shards = tuple(getattr(app.econfig, "IMAGE_SHARDS", DEFAULT_SHARDS))
+
+    def _run(self, function, *args):
+        return self.app.loop.run_in_executor(None, function, *args)
+
+    def location(self, file_hash: str, extension: str) -> str:
+        folder = self.app.econfig.IMAGE_FOLDER
+        path = shard_path(file_hash, self.shards)
+        return str(Path(f"{folder}/{path}{extension}").resolve())
+
+    def resolve(self, location: str) -> str:
+        """Give where the contents at a location are now. When they
+        were moved to the current layout, it's their new path."""
+        if os.path.exists(location):
+            return location
+
+        file_hash, extension = os.path.splitext(os.path.basename(location))
+        return self.location(file_hash, extension)
+
+    def local_path(self, location: str) -> Optional[str]:
+        return self.resolve(location)
+
+    async def put(self, location: str, source: str):
+        await self._run(_move, source, location)
+
+    async def get_range(
+        self, location: str, start: int = 0, end: Optional[int] = None
+    ) -> bytes:
+        return await self._run(lambda: _read(self.resolve(location), start, end))
+
+    async def stat(self, location: str) -> Optional[int]:
+        return (await self.stat_many([location]))[0]
+
+    async def stat_many(self, locations: List[str]) -> List[Optional[int]]:
+        return await self._run(lambda: _sizes(list(map(self.resolve, locations))))
+
+    async def delete_many(self, locations: List[str]):
+        await self._run(_unlink, locations)
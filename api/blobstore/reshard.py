@@ -0,0 +1,185 @@
+# elixire: Image Host software
+# Copyright 2018-2019, elixi.re Team and the elixire contributors
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+elixire - online resharding of IMAGE_FOLDER
+
+Moves stored contents to the layout set in IMAGE_SHARDS while the
+instance keeps serving them. Blobs are walked in batches, in order of
+their key. For each batch, in a single transaction:
+
+ - the blob rows are locked, so uploads of the same contents wait
+ - every content is hard linked at its new path
+ - blobs.fspath and files.fspath are pointed at the new path
+
+Only once that's committed are the cached paths invalidated and the old
+paths unlinked. Readers holding an old path fall back to the current
+layout (see LocalBlobStore.resolve).
+
+The last key done is kept in Redis, so an interrupted run resumes
+where it stopped.
+"""
+import logging
+import os
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from quart import current_app as app
+
+log = logging.getLogger(__name__)
+
+#: where the key of the last blob moved is kept
+CURSOR_KEY = "reshard:cursor"
+
+#: how many blobs are moved per transaction
+BATCH_SIZE = 200
+
+Cursor = Tuple[str, str]
+
+
+def _link(old: str, new: str) -> Optional[bool]:
+    """Make the contents at old also be at new.
+
+    Returns None if there are no contents at old, False if old and new
+    already are the same path (only written differently, e.g relative),
+    or True if the contents got a new path, and the old one can go.
+    """
+    if os.path.realpath(old) == os.path.realpath(new):
+        return False if os.path.exists(old) else None
+
+    Path(new).parent.mkdir(parents=True, exist_ok=True)
+
+    try:
+        os.link(old, new)
+    except FileExistsError:
+        # a run stopped before its transaction committed
+        if not os.path.samefile(old, new):
+            raise
+    except FileNotFoundError:
+        if not os.path.exists(old):
+            return None
+        raise
+
+    return True
+
+
+def _link_many(moves: List[Tuple[str, str]]) -> List[Tuple[str, str, bool]]:
+    """Link contents at their new paths. Returns the moves that can be
+    done, and whether their old path is to be unlinked after."""
+    linked = []
+    for old, new in moves:
+        relinked = _link(old, new)
+        if relinked is None:
+            log.warning(f"fspath {old!s} does not exist, not moving it")
+        else:
+            linked.append((old, new, relinked))
+
+    return linked
+
+
+def _unlink_many(paths: List[str]):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+async def get_cursor() -> Optional[Cursor]:
+    cursor = await app.redis.get(CURSOR_KEY)
+    if cursor is None:
+        return None
+
+    file_hash, _, extension = cursor.partition(":")
+    return file_hash, extension
+
+
+async def reset_cursor():
+    await app.redis.delete(CURSOR_KEY)
+
+
+async def reshard_batch(
+    cursor: Optional[Cursor], batch_size: int = BATCH_SIZE
+) -> Tuple[Optional[Cursor], int]:
+    """Move the contents of the blobs after cursor to the current layout.
+
+    Returns the new cursor, or None once every blob was seen,
+    and how many blobs were moved.
+    """
+    file_hash, extension = cursor or ("", "")
+    loop = app.loop
+    invalidate = []
+
+    async with app.db.acquire() as conn:
+        async with conn.transaction():
+            rows = await conn.fetch(
+                """
+            SELECT hash, extension, fspath
+            FROM blobs
+            WHERE (hash, extension) > ($1, $2)
+            ORDER BY hash, extension
+            LIMIT $3
+            FOR UPDATE
+            """,
+                file_hash,
+                extension,
+                batch_size,
+            )
+
+            if not rows:
+                return None, 0
+
+            moves = []
+            for row in rows:
+                target = app.blobs.location(row["hash"], row["extension"])
+                if row["fspath"] != target:
+                    moves.append((row["fspath"], target))
+
+            moves = await loop.run_in_executor(None, _link_many, moves)
+
+            for old, new, _ in moves:
+                # files go first: their trigger takes them away from the
+                # old blob, then the blob gets its count back on its new path
+                files = await conn.fetch(
+                    """
+                UPDATE files
+                SET fspath = $2
+                WHERE fspath = $1
+                RETURNING filename, domain
+                """,
+                    old,
+                    new,
+                )
+
+                await conn.execute(
+                    """
+                UPDATE blobs
+                SET fspath = $2,
+                    refcount = (
+                        SELECT COUNT(*)
+                        FROM files
+                        WHERE fspath = $2 AND deleted = false
+                    )
+                WHERE fspath = $1
+                """,
+                    old,
+                    new,
+                )
+
+                invalidate.extend(
+                    f"fspath:{row['domain']}:{row['filename']}" for row in files
+                )
+
+    if invalidate:
+        await app.storage.raw_invalidate(*invalidate)
+
+    # paths that only changed how they're written are the same file
+    stale = [old for old, _, relinked in moves if relinked]
+    await loop.run_in_executor(None, _unlink_many, stale)
+
+    last = rows[-1]
+    cursor = (last["hash"], last["extension"])
+    await app.redis.set(CURSOR_KEY, f"{cursor[0]}:{cursor[1]}")
+
+    return cursor, len(moves)
@@ -0,0 +1,306 @@
+# elixire: Image Host software
+# Copyright 2018-2019, elixi.re Team and the elixire contributors
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+elixire - S3 storage backend
+
+Talks the S3 protocol directly over the app's aiohttp session, with
+path-style URLs, so any S3-compatible server (e.g MinIO) works.
+"""
+import asyncio
+import base64
+import datetime
+import hashlib
+import hmac
+import logging
+from typing import Dict, List, Mapping, Optional, Tuple
+from urllib.parse import quote, urlsplit
+from xml.sax.saxutils import escape
+
+from yarl import URL
+
+from .base import BlobStore, BlobStoreError
+
+log = logging.getLogger(__name__)
+
+ALGORITHM = "AWS4-HMAC-SHA256"
+
+#: the most keys a single delete request can have
+DELETE_BATCH = 1000
+
+
+def _quote(value: str, safe: str = "-_.~") -> str:
+    return quote(value, safe=safe)
+
+
+def _canonical_query(query: Dict[str, str]) -> str:
+    return "&".join(
+        f"{_quote(key)}={_quote(value)}" for key, value in sorted(query.items())
+    )
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class S3Signer:
+    """Signs requests with AWS Signature Version 4."""
+
+    def __init__(self, access_key: str, secret_key: str, region: str):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+
+    def _scope(self, amz_date: str) -> str:
+        return f"{amz_date[:8]}/{self.region}/s3/aws4_request"
+
+    def _signature(
+        self,
+        method: str,
+        path: str,
+        query: Dict[str, str],
+        headers: Dict[str, str],
+        payload_hash: str,
+        amz_date: str,
+    ) -> Tuple[str, str]:
+        headers = {
+            key.lower(): " ".join(str(val).split()) for key, val in headers.items()
+        }
+        signed_headers = ";".join(sorted(headers))
+
+        canonical_request = "\n".join(
+            [
+                method,
+                _quote(path, safe="/-_.~"),
+                _canonical_query(query),
+                "".join(f"{key}:{headers[key]}\n" for key in sorted(headers)),
+                signed_headers,
+                payload_hash,
+            ]
+        )
+
+        string_to_sign = "\n".join(
+            [
+                ALGORITHM,
+                amz_date,
+                self._scope(amz_date),
+                _sha256(canonical_request.encode()),
+            ]
+        )
+
+        key = f"AWS4{self.secret_key}".encode()
+        for part in (amz_date[:8], self.region, "s3", "aws4_request"):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        return signed_headers, signature
+
+    def sign(
+        self,
+        method: str,
+        path: str,
+        query: Dict[str, str],
+        headers: Dict[str, str],
+        payload_hash: str,
+        now: datetime.datetime,
+    ) -> Dict[str, str]:
+        """Give the headers of a request, with its authorization.
+        The host header must be in the given ones."""
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        headers = {
+            **headers,
+            "x-amz-content-sha256": payload_hash,
+            "x-amz-date": amz_date,
+        }
+
+        signed_headers, signature = self._signature(
+            method, path, query, headers, payload_hash, amz_date
+        )
+
+        headers["Authorization"] = (
+            f"{ALGORITHM} Credential={self.access_key}/{self._scope(amz_date)},"
+            f"SignedHeaders={signed_headers},Signature={signature}"
+        )
+        return headers
+
+    def presign(
+        self,
+        method: str,
+        host: str,
+        path: str,
+        query: Dict[str, str],
+        expires: int,
+        now: datetime.datetime,
+    ) -> str:
+        """Give the query string of a presigned URL."""
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        query = {
+            **query,
+            "X-Amz-Algorithm": ALGORITHM,
+            "X-Amz-Credential": f"{self.access_key}/{self._scope(amz_date)}",
+            "X-Amz-Date": amz_date,
+            "X-Amz-Expires": str(expires),
+            "X-Amz-SignedHeaders": "host",
+        }
+
+        _, signature = self._signature(
+            method, path, query, {"host": host}, "UNSIGNED-PAYLOAD", amz_date
+        )
+
+        query["X-Amz-Signature"] = signature
+        return _canonical_query(query)
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as fhandle:
+        return fhandle.read()
+
+
+class S3BlobStore(BlobStore):
+    """Keeps contents in an S3 bucket, set in STORAGE_S3.
+
+    Locations are s3://bucket/key URLs.
+    """
+
+    def __init__(self, app):
+        super().__init__(app)
+        config = app.econfig.STORAGE_S3
+
+        self.endpoint = config["endpoint"].rstrip("/")
+        self.host = urlsplit(self.endpoint).netloc
+        self.bucket = config["bucket"]
+        self.prefix = config.get("prefix", "")
+        self.presign_expiry = config.get("presign_expiry", 3600)
+
+        self.signer = S3Signer(
+            config["access_key"],
+            config["secret_key"],
+            config.get("region", "us-east-1"),
+        )
+
+        # for requests over many objects, like stat_many
+        self.semaphore = asyncio.Semaphore(config.get("concurrency", 16))
+
+    def location(self, file_hash: str, extension: str) -> str:
+        return f"s3://{self.bucket}/{self.prefix}{file_hash[0]}/{file_hash}{extension}"
+
+    def _key(self, location: str) -> str:
+        bucket_url = f"s3://{self.bucket}/"
+        if not location.startswith(bucket_url):
+            raise BlobStoreError(f"{location!r} is not in bucket {self.bucket!r}")
+
+        return location[len(bucket_url) :]
+
+    def _path(self, key: str = "") -> str:
+        return f"/{self.bucket}/{key}" if key else f"/{self.bucket}"
+
+    async def _request(
+        self,
+        method: str,
+        key: str = "",
+        *,
+        query: Optional[Dict[str, str]] = None,
+        headers: Optional[Dict[str, str]] = None,
+        body: bytes = b"",
+    ) -> Tuple[int, Mapping[str, str], bytes]:
+        path = self._path(key)
+        query = query or {}
+
+        headers = self.signer.sign(
+            method,
+            path,
+            query,
+            {**(headers or {}), "host": self.host},
+            _sha256(body),
+            datetime.datetime.utcnow(),
+        )
+
+        url = self.endpoint + _quote(path, safe="/-_.~")
+        if query:
+            url += f"?{_canonical_query(query)}"
+
+        async with self.app.session.request(
+            method, URL(url, encoded=True), headers=headers, data=body
+        ) as resp:
+            return resp.status, resp.headers.copy(), await resp.read()
+
+    def _check(self, status: int, data: bytes, *expected: int):
+        if status not in expected:
+            raise BlobStoreError(f"S3 request failed ({status}): {data[:200]!r}")
+
+    async def put(self, location: str, source: str):
+        body = await self.app.loop.run_in_executor(None, _read_file, source)
+        status, _, data = await self._request("PUT", self._key(location), body=body)
+        self._check(status, data, 200)
+
+    async def get_range(
+        self, location: str, start: int = 0, end: Optional[int] = None
+    ) -> bytes:
+        if end is not None and end <= start:
+            return b""
+
+        headers = {}
+        if start or end is not None:
+            last = "" if end is None else end - 1
+            headers["range"] = f"bytes={start}-{last}"
+
+        status, _, data = await self._request(
+            "GET", self._key(location), headers=headers
+        )
+
+        if status == 404:
+            raise FileNotFoundError(location)
+
+        self._check(status, data, 200, 206)
+        return data
+
+    async def stat(self, location: str) -> Optional[int]:
+        async with self.semaphore:
+            status, headers, data = await self._request("HEAD", self._key(location))
+
+        if status == 404:
+            return None
+
+        self._check(status, data, 200)
+        return int(headers["Content-Length"])
+
+    async def delete_many(self, locations: List[str]):
+        keys = [self._key(location) for location in locations]
+
+        for index in range(0, len(keys), DELETE_BATCH):
+            objects = "".join(
+                f"<Object><Key>{escape(key)}</Key></Object>"
+                for key in keys[index : index + DELETE_BATCH]
+            )
+            body = f"<Delete><Quiet>true</Quiet>{objects}</Delete>".encode()
+            md5 = base64.b64encode(hashlib.md5(body).digest()).decode()
+
+            status, _, data = await self._request(
+                "POST",
+                query={"delete": ""},
+                headers={"content-md5": md5, "content-type": "application/xml"},
+                body=body,
+            )
+            self._check(status, data, 200)
+
+            log.info(f"Deleted {len(keys[index : index + DELETE_BATCH])} objects")
+
+    async def presign(
+        self, location: str, *, mimetype: Optional[str] = None
+    ) -> Optional[str]:
+        path = self._path(self._key(location))
+
+        query = {"response-content-disposition": "inline"}
+        if mimetype is not None:
+            query["response-content-type"] = mimetype
+
+        query_string = self.signer.presign(
+            "GET",
+            self.host,
+            path,
+            query,
+            self.presign_expiry,
+            datetime.datetime.utcnow(),
+        )
+        return f"{self.endpoint}{_quote(path, safe='/-_.~')}?{query_string}"
@@ -10,6 +10,7 @@ from api.schema import validate, ADMIN_MODIFY_DOMAIN, ADMIN_SEND_DOMAIN_EMAIL
 from api.decorators import admin_route
 from api.common.email import send_user_email
 from api.common.pagination import Pagination
+from api.common.search import search_domains
 from api.storage import solve_domain
 from api.errors import BadInput
 
@@ -21,6 +22,7 @@ from api.bp.admin.audit_log_actions.domain import (
 
 from api.bp.admin.audit_log_actions.email import DomainOwnerNotifyAction
 
+from api.common import invalidate_upload_profiles
 from api.common.domain import get_domain_info
 
 bp = Blueprint("admin_domain", __name__)
@@ -139,6 +141,9 @@ async def patch_domain(admin_id: int, domain_id: int):
         await _dp_check(db, domain_id, payload, updated_fields, "official")
         await _dp_check(db, domain_id, payload, updated_fields, "permissions")
 
+    if "permissions" in updated_fields:
+        await invalidate_upload_profiles()
+
     return jsonify(
         {
             "updated": updated_fields,
@@ -270,6 +275,7 @@ async def remove_domain(admin_id: int, domain_id: int):
 
     keys = solve_domain(domain_name)
     await app.storage.raw_invalidate(*keys)
+    await invalidate_upload_profiles()
 
     return jsonify(
         {
@@ -360,25 +366,15 @@ async def domains_search(admin_id):
 
     query = args.get("query")
 
-    domain_ids = await app.db.fetch(
-        """
-    SELECT domain_id, COUNT(*) OVER () AS total_count
-    FROM domains
-    WHERE $3 = '' OR domain LIKE '%'||$3||'%'
-    ORDER BY domain_id ASC
-    LIMIT $2::integer
-    OFFSET ($1::integer * $2::integer)
-    """,
-        pagination.page,
-        pagination.per_page,
-        query or "",
+    domain_ids, total_count, next_cursor = await search_domains(
+        query, pagination=pagination
     )
 
     results = {}
 
-    for row in domain_ids:
-        domain_id = row["domain_id"]
+    for domain_id in domain_ids:
         results[domain_id] = await get_domain_info(domain_id)
 
-    total_count = 0 if not domain_ids else domain_ids[0]["total_count"]
-    return jsonify(pagination.response(results, total_count=total_count))
+    return jsonify(
+        pagination.response(results, total_count=total_count, next_cursor=next_cursor)
+    )
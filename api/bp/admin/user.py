@@ -17,7 +17,8 @@ from api.common.email import (
     uid_from_email,
     clean_etoken,
 )
-from api.common.pagination import Pagination
+from api.common.pagination import Pagination, parse_cursor
+from api.common.search import search_users
 
 from api.bp.profile import get_limits, delete_user
 
@@ -46,7 +47,7 @@ async def get_user_handler(admin_id, user_id: int):
 
     dudata = dict(udata)
     dudata["user_id"] = str(dudata["user_id"])
-    dudata["limits"] = await get_limits(app.db, user_id)
+    dudata["limits"] = await get_limits(user_id)
 
     return jsonify(dudata)
 
@@ -204,58 +205,52 @@ async def users_search(admin_id):
     active = args.get("active", True) != "false"
     query = args.get("query")
 
-    users = await app.db.fetch(
-        """
-    SELECT user_id, username, active, admin, consented,
-           COUNT(*) OVER() as total_count
-    FROM users
-    WHERE active = $1
-    AND (
-            $3 = ''
-            OR (username LIKE '%'||$3||'%' OR user_id::text LIKE '%'||$3||'%')
-        )
-    ORDER BY user_id ASC
-    LIMIT $4
-    OFFSET ($2::integer * $4::integer)
-    """,
-        active,
-        pagination.page,
-        query or "",
-        pagination.per_page,
+    users, total_count, next_cursor = await search_users(
+        query, active=active, pagination=pagination
     )
 
     def map_user(record):
         row = dict(record)
         row["user_id"] = str(row["user_id"])
-        del row["total_count"]
         return row
 
     results = [map_user(u) for u in users]
-    total_count = 0 if not users else users[0]["total_count"]
 
-    return jsonify(pagination.response(results, total_count=total_count))
+    return jsonify(
+        pagination.response(results, total_count=total_count, next_cursor=next_cursor)
+    )
 
 
 # === DEPRECATED ===
 #  read https://gitlab.com/elixire/elixire/issues/61#note_91039503
 # These routes are here to maintain compatibility with some of our
 # utility software (admin panels)
+#
+# they all take an optional ?after=<user_id> argument for keyset pagination,
+# in which case the page in the route is ignored.
+
+
+def _deprecated_offset(page: int, after) -> int:
+    return 0 if after is not None else page * 20
 
 
 @bp.get("/admin/listusers/<int:page>")
 @admin_route
 async def list_users_handler(admin_id, page: int):
     """List users in the service"""
+    after = parse_cursor(request.args.get("after"))
     data = await app.db.fetch(
         """
     SELECT user_id, username, active, admin, domain,
       subdomain, email, paranoid, consented
     FROM users
+    WHERE ($2::bigint IS NULL OR user_id > $2::bigint)
     ORDER BY user_id ASC
     LIMIT 20
-    OFFSET ($1 * 20)
+    OFFSET $1
     """,
-        page,
+        _deprecated_offset(page, after),
+        after,
     )
 
     def _cnv(row):
@@ -269,17 +264,20 @@ async def list_users_handler(admin_id, page: int):
 @bp.get("/admin/list_inactive/<int:page>")
 @admin_route
 async def inactive_users_handler(admin_id, page: int):
+    after = parse_cursor(request.args.get("after"))
     data = await app.db.fetch(
         """
     SELECT user_id, username, active, admin, domain, subdomain,
       email, paranoid, consented
     FROM users
     WHERE active=false
+    AND ($2::bigint IS NULL OR user_id > $2::bigint)
     ORDER BY user_id ASC
     LIMIT 20
-    OFFSET ($1 * 20)
+    OFFSET $1
     """,
-        page,
+        _deprecated_offset(page, after),
+        after,
     )
 
     def _cnv(row):
@@ -304,18 +302,21 @@ async def search_user(user_id: int, page: int):
         raise BadInput("Insert a pattern.")
 
     pattern = f"%{pattern}%"
+    after = parse_cursor(request.args.get("after"))
 
     rows = await app.db.fetch(
         """
     SELECT user_id, username, active, admin, consented
     FROM users
-    WHERE username LIKE $1 OR user_id::text LIKE $1
+    WHERE (username LIKE $1 OR user_id::text LIKE $1)
+    AND ($3::bigint IS NULL OR user_id > $3::bigint)
     ORDER BY user_id ASC
     LIMIT 20
-    OFFSET ($2 * 20)
+    OFFSET $2
     """,
         pattern,
-        page,
+        _deprecated_offset(page, after),
+        after,
     )
 
     res = []
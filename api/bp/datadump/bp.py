@@ -8,7 +8,8 @@ import logging
 from quart import Blueprint, jsonify, send_file, current_app as app, request
 from api.errors import BadInput, FeatureDisabled
 from api.common.auth import token_check, check_admin
-from .tasks import start_janitor, start_worker
+from .tasks import start_janitor, start_worker, dump_streamed
+from .stream import dump_response
 
 log = logging.getLogger(__name__)
 bp = Blueprint("datadump", __name__)
@@ -172,7 +173,11 @@ async def data_dump_global_status():
 
 @bp.get("/dump_get")
 async def get_dump():
-    """Download the dump file."""
+    """Download the dump file.
+
+    With streamed dumps, the zip is generated while it's
+    downloaded, and supports Range requests.
+    """
     try:
         dump_token = str(request.args["key"])
     except (KeyError, TypeError, ValueError):
@@ -199,6 +204,9 @@ async def get_dump():
         user_id,
     )
 
+    if dump_streamed():
+        return await dump_response(user_id, user_name)
+
     zip_path = os.path.join(
         app.econfig.DUMP_FOLDER,
         f"{user_id}_{user_name}.zip",
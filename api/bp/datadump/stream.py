@@ -0,0 +1,119 @@
+# elixire: Image Host software
+# Copyright 2018-2019, elixi.re Team and the elixire contributors
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+elixire - streamed data dumps
+
+With DUMP_MODE = "stream", no zip is written into DUMP_FOLDER. The
+dump is generated from the database and the user's files every time
+/api/dump_get is requested, in the same layout, so downloads can be
+resumed with Range requests.
+"""
+import logging
+import os
+from typing import Optional
+
+from quart import Response, current_app as app, request
+
+from api.snowflake import snowflake_time
+from .tasks import dump_static, iter_file_batches
+from .zipstream import ZipStream
+
+log = logging.getLogger(__name__)
+
+
+class BlobCRCs:
+    """Keeps the CRCs of streamed files in their blobs, for the ones
+    stored before uploads kept them. They are only read once."""
+
+    async def get(self, fspath: str) -> Optional[int]:
+        return await app.db.fetchval(
+            """
+        SELECT crc
+        FROM blobs
+        WHERE fspath = $1
+        """,
+            fspath,
+        )
+
+    async def set(self, fspath: str, crc: int):
+        await app.db.execute(
+            """
+        UPDATE blobs
+        SET crc = $2
+        WHERE fspath = $1
+        """,
+            fspath,
+            crc,
+        )
+
+
+async def build_dump(user_id: int) -> ZipStream:
+    """Lay out the data dump of a user. Sizes and CRCs come from
+    the blobs of the files, nothing is read from them yet."""
+    stream = ZipStream(BlobCRCs(), reader=app.blobs.get_range)
+    await dump_static(stream, user_id)
+
+    async for rows in iter_file_batches(user_id, 0):
+        for row in rows:
+            file_id, filename, fspath = row["file_id"], row["filename"], row["fspath"]
+
+            if row["size"] is None:
+                log.warning(f"File not found: {file_id} {filename}")
+                continue
+
+            ext = os.path.splitext(fspath)[-1]
+            stream.add_file(
+                f"./files/{file_id}_{filename}{ext}",
+                fspath,
+                row["size"],
+                snowflake_time(file_id),
+                crc=row["crc"],
+            )
+
+    return stream
+
+
+async def dump_response(user_id: int, user_name: str) -> Response:
+    """Stream the data dump of a user, or the requested range of it."""
+    stream = await build_dump(user_id)
+    size = stream.size
+    etag = stream.etag
+
+    # a range only applies to the dump the client already has a part of
+    if_range = request.if_range
+    fresh = if_range.etag is None and if_range.date is None
+    fresh = fresh or if_range.etag == etag
+
+    start, stop, status = 0, size, 200
+    byte_range = request.range if fresh else None
+
+    if byte_range is not None and len(byte_range.ranges) == 1:
+        bounds = byte_range.range_for_length(size)
+        if bounds is None:
+            resp = Response("", status=416)
+            resp.headers["Content-Range"] = f"bytes */{size}"
+            return resp
+
+        start, stop = bounds
+        status = 206
+
+    resp = Response(
+        stream.stream(start, stop), status=status, mimetype="application/zip"
+    )
+
+    # big dumps take a while
+    resp.timeout = None
+
+    resp.content_length = stop - start
+    resp.accept_ranges = "bytes"
+    resp.set_etag(etag)
+    resp.headers[
+        "Content-Disposition"
+    ] = f'attachment; filename="{user_id}_{user_name}.zip"'
+
+    if status == 206:
+        resp.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+
+    return resp
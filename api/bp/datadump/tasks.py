@@ -6,12 +6,18 @@
 elixire - datadump API
 """
 
+import asyncio
 import json
 import time
 import logging
 import zipfile
 import pathlib
 import os.path
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 
 from quart import current_app as app
 
@@ -19,10 +25,177 @@ from api.common.email import make_email_token, EmailTokenType, send_user_email
 
 log = logging.getLogger(__name__)
 
+#: how many file rows are fetched at once
+DUMP_BATCH = 1000
+
+#: how many files can be waiting to be written into the zip
+DUMP_MAX_PENDING = 64
+
+#: progress is saved every that many files, or seconds
+DUMP_CHECKPOINT_FILES = 500
+DUMP_CHECKPOINT_PERIOD = 10
+
+#: seconds before a failed dump is tried again, doubled on every retry
+DUMP_RETRY_BACKOFF = 60
+
+#: what the sizes of a zip header are set to when they're in its zip64 field
+ZIP64_MARKER = 0xFFFFFFFF
+
+#: mimetypes worth deflating, everything else (images, audio, video)
+#  is already compressed and gets stored as-is.
+COMPRESSIBLE_MIMES = ("image/svg+xml", "image/bmp", "application/json")
+
+
+def compress_type(mimetype: Optional[str]) -> int:
+    """Pick the compression for a file in the dump, by its mimetype."""
+    if mimetype and (mimetype.startswith("text/") or mimetype in COMPRESSIBLE_MIMES):
+        return zipfile.ZIP_DEFLATED
+
+    return zipfile.ZIP_STORED
+
+
+def dump_streamed() -> bool:
+    """Whether dumps are streamed on download instead of written to disk."""
+    return getattr(app.econfig, "DUMP_MODE", "file") == "stream"
+
+
+def _has_entry(zipdump, name: str) -> bool:
+    """Whether a resumed dump zip already has an entry."""
+    entries = getattr(zipdump, "NameToInfo", {})
+    return os.path.normpath(name).lstrip(os.sep) in entries
+
+
+def _zip64_sizes(extra: bytes, file_size: int, compress_size: int):
+    """Take the sizes of a local header out of its zip64 extra field."""
+    while len(extra) >= 4:
+        kind, length = struct.unpack("<2H", extra[:4])
+        if kind == 1:
+            values = list(struct.unpack(f"<{length // 8}Q", extra[4 : 4 + length]))
+            if file_size == ZIP64_MARKER:
+                file_size = values.pop(0)
+            if compress_size == ZIP64_MARKER:
+                compress_size = values.pop(0)
+
+        extra = extra[4 + length :]
+
+    return file_size, compress_size
+
+
+def _entry_intact(fhandle, info: zipfile.ZipInfo, data_start: int) -> bool:
+    """Check the data of an entry against its CRC and size."""
+    fhandle.seek(data_start)
+    decompressor = zlib.decompressobj(-15)
+    left, crc, size = info.compress_size, 0, 0
+
+    try:
+        while left:
+            chunk = fhandle.read(min(left, 256 * 1024))
+            left -= len(chunk)
+            if info.compress_type == zipfile.ZIP_DEFLATED:
+                chunk = decompressor.decompress(chunk)
+
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+    except zlib.error:
+        return False
+
+    return crc == info.CRC and size == info.file_size
+
+
+def _recover_entries(fhandle) -> Tuple[List[zipfile.ZipInfo], int]:
+    """Read back the entries of a dump zip from their local headers,
+    as its central directory is only there if it was closed.
+
+    Returns the entries that were completely written, and
+    where what comes after them starts."""
+    end = fhandle.seek(0, os.SEEK_END)
+    entries = []
+    offset = 0
+
+    while offset + zipfile.sizeFileHeader <= end:
+        fhandle.seek(offset)
+        (
+            signature,
+            extract_version,
+            _,
+            flags,
+            compression,
+            dos_time,
+            dos_date,
+            crc,
+            compress_size,
+            file_size,
+            name_len,
+            extra_len,
+        ) = struct.unpack(
+            zipfile.structFileHeader, fhandle.read(zipfile.sizeFileHeader)
+        )
+
+        # the central directory, or what the writer was cut off at
+        if signature != zipfile.stringFileHeader or flags & 0x08:
+            break
+
+        name = fhandle.read(name_len).decode("utf-8" if flags & 0x800 else "cp437")
+        extra = fhandle.read(extra_len)
+        file_size, compress_size = _zip64_sizes(extra, file_size, compress_size)
+
+        data_start = offset + zipfile.sizeFileHeader + name_len + extra_len
+        if data_start + compress_size > end:
+            break
+
+        date_time = (
+            (dos_date >> 9) + 1980,
+            (dos_date >> 5) & 0xF,
+            dos_date & 0x1F,
+            dos_time >> 11,
+            (dos_time >> 5) & 0x3F,
+            (dos_time & 0x1F) * 2,
+        )
+
+        info = zipfile.ZipInfo(name, date_time)
+        info.extract_version = extract_version
+        info.flag_bits = flags
+        info.compress_type = compression
+        info.CRC = crc
+        info.compress_size = compress_size
+        info.file_size = file_size
+        info.header_offset = offset
+        info.external_attr = 0o644 << 16
+        info.extra = extra
+
+        entries.append((info, data_start))
+        offset = data_start + compress_size
+
+    # entries are only followed by another one once they're complete,
+    # so the last one is the only one that can be cut off
+    if entries and not _entry_intact(fhandle, *entries[-1]):
+        offset = entries.pop()[0].header_offset
+
+    return [info for info, _ in entries], offset
+
+
+def _reopen_zip(zip_path: str) -> zipfile.ZipFile:
+    """Open the zip of a dump to resume it, without what
+    was left incomplete when it was interrupted."""
+    with open(zip_path, "r+b") as fhandle:
+        entries, offset = _recover_entries(fhandle)
+        fhandle.truncate(offset)
+
+    # without a central directory, the zip is just appended to
+    zipdump = zipfile.ZipFile(zip_path, "a", compression=zipfile.ZIP_DEFLATED)
+    for info in entries:
+        zipdump.filelist.append(info)
+        zipdump.NameToInfo[info.filename] = info
+
+    return zipdump
+
 
 def _dump_json(zipdump, filepath, obj):
+    if _has_entry(zipdump, filepath):
+        return
+
     objstr = json.dumps(obj, indent=4)
-    zipdump.writestr(filepath, objstr)
+    zipdump.writestr(filepath, objstr, compress_type=zipfile.ZIP_DEFLATED)
 
 
 async def open_zipdump(user_id, resume=False) -> zipfile.ZipFile:
@@ -50,7 +223,8 @@ async def open_zipdump(user_id, resume=False) -> zipfile.ZipFile:
             user_name,
         )
 
-    return zipfile.ZipFile(zip_path, "a", compression=zipfile.ZIP_DEFLATED), user_name
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _reopen_zip, zip_path), user_name
 
 
 async def dump_user_data(zipdump, user_id):
@@ -77,6 +251,7 @@ async def dump_user_bans(zipdump, user_id):
     SELECT user_id, reason, end_timestamp
     FROM bans
     WHERE user_id = $1
+    ORDER BY end_timestamp
     """,
         user_id,
     )
@@ -115,6 +290,7 @@ async def dump_user_files(zipdump, user_id):
     SELECT file_id, mimetype, filename, file_size, uploader, domain
     FROM files
     WHERE uploader = $1
+    ORDER BY file_id
     """,
         user_id,
     )
@@ -133,6 +309,7 @@ async def dump_user_shortens(zipdump, user_id):
     SELECT shorten_id, filename, redirto, domain
     FROM shortens
     WHERE uploader = $1
+    ORDER BY shorten_id
     """,
         user_id,
     )
@@ -144,71 +321,184 @@ async def dump_user_shortens(zipdump, user_id):
     _dump_json(zipdump, "shortens.json", all_shortens_l)
 
 
-async def dump_files(zipdump, user_id, minid, files_done):
-    """Dump files into the data dump zip."""
-
-    # start from minimum id
-    current_id = minid
+class DumpCheckpoint:
+    """Saves the progress of a dump every DUMP_CHECKPOINT_FILES files
+    or DUMP_CHECKPOINT_PERIOD seconds, whatever comes first."""
 
-    while True:
-        if files_done % 100 == 0:
-            log.info(f"Worked {files_done} files for user {user_id}")
-
-        if current_id is None:
-            log.info(f"Finished file takeout for {user_id}")
-            break
+    def __init__(self, user_id: int, files_done: int):
+        self.user_id = user_id
+        self.saved_files = files_done
+        self.saved_at = time.monotonic()
 
-        # add current file to dump
-        fdata = await app.db.fetchrow(
+    async def save(self, current_id: int, files_done: int):
+        await app.db.execute(
             """
-        SELECT fspath, filename
-        FROM files
-        WHERE file_id = $1
+        UPDATE current_dump_state
+        SET current_id = $1, files_done = $2
+        WHERE user_id = $3
         """,
             current_id,
+            files_done,
+            self.user_id,
         )
 
-        fspath = fdata["fspath"]
-        filename = fdata["filename"]
-        ext = os.path.splitext(fspath)[-1]
+        self.saved_files = files_done
+        self.saved_at = time.monotonic()
 
-        filepath = f"./files/{current_id}_{filename}{ext}"
-        try:
-            fut = app.loop.run_in_executor(None, zipdump.write, fspath, filepath)
+    async def maybe_save(self, current_id: int, files_done: int):
+        if (
+            files_done - self.saved_files >= DUMP_CHECKPOINT_FILES
+            or time.monotonic() - self.saved_at >= DUMP_CHECKPOINT_PERIOD
+        ):
+            await self.save(current_id, files_done)
+
+
+class ZipWriter:
+    """Writes files into a zip from a dedicated thread.
 
-            await fut
+    Writes happen in the order they're submitted, while the event loop
+    is free to fetch the next files from the database.
+    """
+
+    def __init__(self, zipdump):
+        self.zipdump = zipdump
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="dump_writer"
+        )
+
+    def _write(self, path: str, filepath: str, compression: int) -> bool:
+        try:
+            self.zipdump.write(path, filepath, compress_type=compression)
+            return True
         except FileNotFoundError:
-            log.warning(f"File not found: {current_id} {filename}")
+            return False
 
-        files_done += 1
+    def _write_fetched(self, fetch, filepath: str, compression: int) -> bool:
+        try:
+            data = fetch.result()
+        except FileNotFoundError:
+            return False
+
+        self.zipdump.writestr(filepath, data, compress_type=compression)
+        return True
+
+    def submit(self, fspath: str, filepath: str, compression: int) -> asyncio.Future:
+        """Schedule a file to be written. The future resolves to
+        False if the file was not found."""
+        path = app.blobs.local_path(fspath)
+        if path is not None:
+            return app.loop.run_in_executor(
+                self.executor, self._write, path, filepath, compression
+            )
 
-        # update current_dump_state
-        await app.db.execute(
-            """
-        UPDATE current_dump_state
-        SET current_id = $1, files_done = $2
-        WHERE user_id = $3
-        """,
-            current_id,
-            files_done,
-            user_id,
+        # the contents are fetched right away, but only written
+        # when it's their turn, so writes stay in order
+        fetch = asyncio.run_coroutine_threadsafe(app.blobs.get_range(fspath), app.loop)
+        return app.loop.run_in_executor(
+            self.executor, self._write_fetched, fetch, filepath, compression
         )
 
-        # fetch next id
-        current_id = await app.db.fetchval(
+    async def close(self):
+        """Wait for every pending write to finish."""
+        await app.loop.run_in_executor(None, self.executor.shutdown)
+
+
+async def iter_file_batches(user_id: int, minid: int):
+    """Go through a user's files, starting from minid,
+    in batches of DUMP_BATCH files."""
+    current_id = minid
+
+    while True:
+        rows = await app.db.fetch(
             """
-        SELECT file_id
+        SELECT files.file_id, files.filename, files.fspath, files.mimetype,
+               blobs.size, blobs.crc
         FROM files
-        WHERE uploader = $1
-        AND   file_id > $2
-
-        ORDER BY file_id ASC
-        LIMIT 1
+        LEFT JOIN blobs
+          ON blobs.fspath = files.fspath
+        WHERE files.uploader = $1
+        AND   files.file_id >= $2
+        ORDER BY files.file_id ASC
+        LIMIT $3
         """,
             user_id,
             current_id,
+            DUMP_BATCH,
         )
 
+        if rows:
+            yield rows
+
+        if len(rows) < DUMP_BATCH:
+            return
+
+        current_id = rows[-1]["file_id"] + 1
+
+
+async def dump_files(zipdump, user_id, minid, files_done):
+    """Dump files into the data dump zip.
+
+    Progress is checkpointed into current_dump_state as the id of the
+    last file written and the amount of files done, so resume_dump can
+    continue after it. Files written after the checkpoint are already
+    in a resumed zip, and aren't written again.
+    """
+    if minid is None:
+        log.info(f"Finished file takeout for {user_id}")
+        return
+
+    if files_done:
+        # the checkpointed file is done
+        minid += 1
+
+    writer = ZipWriter(zipdump)
+    checkpoint = DumpCheckpoint(user_id, files_done)
+    pending = deque()
+    current_id = None
+
+    async def _finish_oldest():
+        nonlocal files_done, current_id
+        file_id, filename, fut = pending.popleft()
+
+        if not await fut:
+            log.warning(f"File not found: {file_id} {filename}")
+
+        files_done += 1
+        current_id = file_id
+
+        if files_done % 100 == 0:
+            log.info(f"Worked {files_done} files for user {user_id}")
+
+        await checkpoint.maybe_save(current_id, files_done)
+
+    try:
+        async for rows in iter_file_batches(user_id, minid):
+            for row in rows:
+                file_id, filename = row["file_id"], row["filename"]
+                fspath, mimetype = row["fspath"], row["mimetype"]
+                ext = os.path.splitext(fspath)[-1]
+                filepath = f"./files/{file_id}_{filename}{ext}"
+
+                if _has_entry(zipdump, filepath):
+                    fut = app.loop.create_future()
+                    fut.set_result(True)
+                else:
+                    fut = writer.submit(fspath, filepath, compress_type(mimetype))
+
+                pending.append((file_id, filename, fut))
+                if len(pending) >= DUMP_MAX_PENDING:
+                    await _finish_oldest()
+
+        while pending:
+            await _finish_oldest()
+    finally:
+        await writer.close()
+
+    if current_id is not None:
+        await checkpoint.save(current_id, files_done)
+
+    log.info(f"Finished file takeout for {user_id}")
+
 
 async def dispatch_dump(user_id: int, user_name: str):
     """Dispatch the data dump to a user."""
@@ -267,10 +557,9 @@ async def dump_static(zipdump, user_id):
     await dump_user_shortens(zipdump, user_id)
 
 
-async def do_dump(user_id: int):
-    """Make a data dump for the user."""
-    # insert user in current dump state
-    row = await app.db.fetchrow(
+async def _start_dump(conn, user_id: int):
+    """Insert the user into the current dump state."""
+    row = await conn.fetchrow(
         """
     SELECT MIN(file_id), COUNT(*)
     FROM files
@@ -289,7 +578,7 @@ async def do_dump(user_id: int):
         f"total files {total_files}"
     )
 
-    await app.db.execute(
+    await conn.execute(
         """
     INSERT INTO current_dump_state
         (user_id, current_id, total_files, files_done)
@@ -301,29 +590,12 @@ async def do_dump(user_id: int):
         total_files,
     )
 
-    zipdump, user_name = await open_zipdump(user_id)
-
-    try:
-        # those dumps just get stuff from DB
-        # and write them into JSON files insize the zip
-        await dump_static(zipdump, user_id)
 
-        # this is the longest operation for a dump
-        # and because of that, it is resumable, so in the case
-        # of an application failure, the system should be able to
-        # know where it left off and continue writing to the zip file.
-        await dump_files(zipdump, user_id, minid, 0)
+async def do_dump(user_id: int, resume: bool = False):
+    """Make (or resume) a data dump for the user.
 
-        # Finally, dispatch the ZIP file via email to the user.
-        await dispatch_dump(user_id, user_name)
-    except Exception:
-        log.exception("Error on dumping")
-    finally:
-        zipdump.close()
-
-
-async def resume_dump(user_id: int):
-    """Resume a data dump"""
+    The user must be in the current dump state already.
+    """
     # check the current state
     row = await app.db.fetchrow(
         """
@@ -334,68 +606,160 @@ async def resume_dump(user_id: int):
         user_id,
     )
 
-    log.info(f'Resuming for {user_id} files_done: {row["files_done"]}')
+    if row is None:
+        log.info(f"No dump state for {user_id}, already done")
+        return
 
-    zipdump, user_name = await open_zipdump(user_id, True)
+    if dump_streamed():
+        # nothing to write, the zip is made when it is downloaded
+        try:
+            user_name = await app.db.fetchval_stmt("username", user_id)
+            await dispatch_dump(user_id, user_name)
+        except Exception:
+            log.exception("Error on dispatching dump")
+        return
+
+    if resume:
+        log.info(f'Resuming for {user_id} files_done: {row["files_done"]}')
+
+    zipdump, user_name = await open_zipdump(user_id, resume)
 
     try:
-        # Redump static files.
+        # those dumps just get stuff from DB
+        # and write them into JSON files insize the zip
+        # (a resumed zip keeps the ones it has)
         await dump_static(zipdump, user_id)
 
+        # this is the longest operation for a dump
+        # and because of that, it is resumable, so in the case
+        # of an application failure, the system should be able to
+        # know where it left off and continue writing to the zip file.
         await dump_files(zipdump, user_id, row["current_id"], row["files_done"])
 
+        # Finally, dispatch the ZIP file via email to the user.
         await dispatch_dump(user_id, user_name)
     except Exception:
-        log.exception("error on dump files resume")
+        log.exception("Error on dumping")
     finally:
         zipdump.close()
 
 
-async def dump_worker():
-    """Main dump worker.
+async def resume_dump(user_id: int):
+    """Resume a data dump"""
+    await do_dump(user_id, resume=True)
 
-    Works dump resuming, manages the next user on the queue, etc.
+
+async def _claim_dump(conn) -> Tuple[Optional[int], bool]:
+    """Claim a dump to work on.
+
+    Dumps are claimed with a session-level advisory lock on the user id,
+    held by the worker's connection. That way, no two workers (even in
+    different processes) work on the same dump, and the dump of a worker
+    that died gets resumed by another one.
+
+    Returns the user id and whether the dump is being resumed.
     """
-    # fetch state, if there is, resume
-    user_id = await app.db.fetchval(
+    # dumps that were interrupted, or are being made by another worker.
+    # dumps that failed wait for their next attempt
+    in_progress = await conn.fetch(
         """
     SELECT user_id
     FROM current_dump_state
+    WHERE next_attempt <= (now() at time zone 'utc')
     ORDER BY start_timestamp ASC
     """
     )
 
-    if user_id:
-        await resume_dump(user_id)
+    for row in in_progress:
+        user_id = row["user_id"]
+        if await conn.fetchval("SELECT pg_try_advisory_lock($1)", user_id):
+            return user_id, True
 
-    # get from queue
-    next_id = await app.db.fetchval(
+    async with conn.transaction():
+        user_id = await conn.fetchval(
+            """
+        SELECT user_id
+        FROM dump_queue
+        ORDER BY request_timestamp ASC
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
         """
-    SELECT user_id
-    FROM dump_queue
-    ORDER BY request_timestamp ASC
-    """
-    )
+        )
 
-    if next_id:
-        # remove from the queue
-        await app.db.execute(
+        if user_id is None:
+            return None, False
+
+        # take the lock before the state is visible to other workers
+        await conn.execute("SELECT pg_advisory_lock($1)", user_id)
+
+        await conn.execute(
             """
         DELETE FROM dump_queue
         WHERE user_id = $1
         """,
-            next_id,
+            user_id,
         )
 
-        await do_dump(next_id)
+        await _start_dump(conn, user_id)
+
+    return user_id, False
+
+
+async def _retry_dump(conn, user_id: int):
+    """Back off a dump that is still in the current dump state after
+    being worked on, as it failed somewhere. Gives up on it after
+    DUMP_RETRIES attempts."""
+    attempts = await conn.fetchval(
+        """
+    UPDATE current_dump_state
+    SET attempts = attempts + 1,
+        next_attempt = (now() at time zone 'utc')
+            + make_interval(secs => $2 * 2 ^ attempts)
+    WHERE user_id = $1
+    RETURNING attempts
+    """,
+        user_id,
+        float(DUMP_RETRY_BACKOFF),
+    )
+
+    if attempts is None:
+        return
+
+    if attempts < getattr(app.econfig, "DUMP_RETRIES", 5):
+        log.warning("dump for %d failed, attempt %d", user_id, attempts)
+        return
 
-        # use recursion so that
-        # in the next call, we will fetch
-        # the next user in the queue
+    log.error("giving up on dump for %d after %d attempts", user_id, attempts)
 
-        # if no user is in the queue, the function
-        # will stop.
-        return await dump_worker()
+    # the user can request another one
+    await conn.execute(
+        """
+    DELETE FROM current_dump_state
+    WHERE user_id = $1
+    """,
+        user_id,
+    )
+
+
+async def dump_worker():
+    """Main dump worker.
+
+    Works dump resuming, manages the next user on the queue, etc.
+    Runs until there's nothing left to claim.
+    """
+    async with app.db.acquire() as conn:
+        while True:
+            user_id, resume = await _claim_dump(conn)
+            if user_id is None:
+                return
+
+            try:
+                await do_dump(user_id, resume)
+
+                # dispatched dumps are out of the current dump state
+                await _retry_dump(conn, user_id)
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock($1)", user_id)
 
 
 async def dump_worker_wrapper():
@@ -407,13 +771,16 @@ async def dump_worker_wrapper():
 
 
 def start_worker():
-    """Start the dump worker, but not start more than 1 of them."""
+    """Start the dump workers, but not start more than DUMP_WORKERS of them."""
+    workers = getattr(app.econfig, "DUMP_WORKERS", 1)
 
-    if app.sched.exists("dump_worker_wrapper"):
-        log.info("worker wrapper exists, skipping")
-        return
+    for index in range(workers):
+        name = f"dump_worker_{index}"
+        if app.sched.exists(name):
+            log.info("worker %s exists, skipping", name)
+            continue
 
-    app.sched.spawn_once(dump_worker_wrapper, name="dump_worker_wrapper")
+        app.sched.spawn_once(dump_worker_wrapper, name=name)
 
 
 async def dump_janitor():
@@ -423,7 +790,11 @@ async def dump_janitor():
     of seconds.
 
     If there is a file that is more than 6 hours old, it gets deleted.
+
+    Workers are also started again, for dumps waiting to be retried.
     """
+    start_worker()
+
     dumps = pathlib.Path(app.econfig.DUMP_FOLDER)
 
     # iterate over all zip files inside the dump folder
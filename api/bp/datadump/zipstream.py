@@ -0,0 +1,334 @@
+# elixire: Image Host software
+# Copyright 2018-2019, elixi.re Team and the elixire contributors
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+elixire - streamed zip files
+
+Builds a zip file on the fly, without writing it anywhere. Every entry
+is stored (not compressed), so the size of the whole zip, and where
+each entry starts in it, are known before anything is read. That lets
+any byte range of the zip be generated on its own, for Range requests.
+
+CRCs go in the local header of each entry, so entries are complete
+without a data descriptor, which some unzip tools don't handle for
+stored entries. A file entry is then read for its CRC before its data,
+unless it was given or is in the CRC cache that can be given.
+"""
+import asyncio
+import hashlib
+import os
+import struct
+import time
+import zlib
+from typing import AsyncIterator, List, Optional, Tuple
+
+#: size of file reads
+CHUNK_SIZE = 256 * 1024
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+
+# utf-8 names
+FLAGS = 0x800
+
+LOCAL_HEADER = struct.Struct("<4s2H3H3L2H")
+CENTRAL_HEADER = struct.Struct("<4s4B4H3L5H2L")
+END_RECORD = struct.Struct("<4s4H2LH")
+END_RECORD64 = struct.Struct("<4sQ2H2L4Q")
+END_LOCATOR64 = struct.Struct("<4sLQL")
+
+#: 1980-01-01, the earliest time a zip can hold
+DOS_EPOCH = 315532800
+
+
+def _dos_time(timestamp: float) -> Tuple[int, int]:
+    tm = time.gmtime(max(timestamp, DOS_EPOCH))
+    dos_date = (tm.tm_year - 1980) << 9 | tm.tm_mon << 5 | tm.tm_mday
+    dos_time = tm.tm_hour << 11 | tm.tm_min << 5 | tm.tm_sec // 2
+    return dos_time, dos_date
+
+
+def _arcname(name: str) -> str:
+    return os.path.normpath(name).replace(os.sep, "/").lstrip("/")
+
+
+def _read_chunk(fspath: str, start: int, end: int) -> bytes:
+    with open(fspath, "rb") as fhandle:
+        fhandle.seek(start)
+        return fhandle.read(end - start)
+
+
+async def read_local(fspath: str, start: int, end: int) -> bytes:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _read_chunk, fspath, start, end)
+
+
+class ZipEntry:
+    """An entry of the zip, either from memory or from a file."""
+
+    __slots__ = ("name", "size", "mtime", "data", "fspath", "offset", "crc")
+
+    def __init__(self, name, size, mtime, *, data=None, fspath=None, crc=None):
+        self.name: bytes = _arcname(name).encode()
+        self.size: int = size
+        self.mtime: float = mtime
+        self.data: Optional[bytes] = data
+        self.fspath: Optional[str] = fspath
+
+        #: where the local header of the entry starts
+        self.offset = 0
+
+        self.crc: Optional[int] = crc if data is None else zlib.crc32(data)
+
+    @property
+    def zip64(self) -> bool:
+        return self.size >= ZIP64_LIMIT
+
+    def local_header(self) -> bytes:
+        """Give the local header of the entry. Its CRC must be known."""
+        extra = struct.pack("<2H2Q", 1, 16, self.size, self.size) if self.zip64 else b""
+        sizes = ZIP64_LIMIT if self.zip64 else self.size
+
+        dos_time, dos_date = _dos_time(self.mtime)
+        header = LOCAL_HEADER.pack(
+            b"PK\x03\x04",
+            45 if self.zip64 else 20,
+            FLAGS,
+            0,  # stored
+            dos_time,
+            dos_date,
+            self.crc,
+            sizes,
+            sizes,
+            len(self.name),
+            len(extra),
+        )
+        return header + self.name + extra
+
+    def local_header_size(self) -> int:
+        return LOCAL_HEADER.size + len(self.name) + (20 if self.zip64 else 0)
+
+    def _central_extra(self) -> bytes:
+        fields = []
+        if self.zip64:
+            fields += [self.size, self.size]
+        if self.offset >= ZIP64_LIMIT:
+            fields.append(self.offset)
+
+        if not fields:
+            return b""
+
+        return struct.pack(f"<2H{len(fields)}Q", 1, 8 * len(fields), *fields)
+
+    def central_header(self) -> bytes:
+        extra = self._central_extra()
+        needs64 = bool(extra)
+        dos_time, dos_date = _dos_time(self.mtime)
+
+        header = CENTRAL_HEADER.pack(
+            b"PK\x01\x02",
+            45 if needs64 else 20,
+            3,  # made on unix
+            45 if needs64 else 20,
+            0,
+            FLAGS,
+            0,  # stored
+            dos_time,
+            dos_date,
+            self.crc,
+            ZIP64_LIMIT if self.zip64 else self.size,
+            ZIP64_LIMIT if self.zip64 else self.size,
+            len(self.name),
+            len(extra),
+            0,
+            0,
+            0,
+            0o100644 << 16,
+            min(self.offset, ZIP64_LIMIT),
+        )
+        return header + self.name + extra
+
+    def central_header_size(self) -> int:
+        return CENTRAL_HEADER.size + len(self.name) + len(self._central_extra())
+
+
+class ZipStream:
+    """A zip file generated on the fly, in a deterministic layout.
+
+    Entries are laid out in the order they were added.
+    """
+
+    def __init__(self, crc_cache=None, reader=read_local):
+        self.entries: List[ZipEntry] = []
+
+        #: anything with async get(key) and set(key, crc) methods,
+        #  keyed by the path of file entries
+        self.crc_cache = crc_cache
+
+        #: reads a part of a file entry, given its path, start and end
+        self.reader = reader
+
+    def writestr(self, name: str, data, compress_type=None, mtime: float = 0):
+        """Add an entry from memory. Has the same signature as
+        ZipFile.writestr, but the compression type is ignored."""
+        if isinstance(data, str):
+            data = data.encode()
+
+        self.entries.append(ZipEntry(name, len(data), mtime, data=data))
+
+    def add_file(
+        self,
+        name: str,
+        fspath: str,
+        size: int,
+        mtime: float = 0,
+        crc: Optional[int] = None,
+    ):
+        """Add an entry from a file. Its size must not change,
+        and its CRC is read from it if not given."""
+        self.entries.append(ZipEntry(name, size, mtime, fspath=fspath, crc=crc))
+
+    @property
+    def etag(self) -> str:
+        """Give a tag of the layout and contents of the zip, which
+        changes whenever any byte of it could change."""
+        digest = hashlib.sha256()
+
+        for entry in self.entries:
+            source = entry.fspath if entry.data is None else str(entry.crc)
+            digest.update(f"{entry.size}:{entry.mtime}:{source}:".encode())
+            digest.update(entry.name + b"\0")
+
+        return digest.hexdigest()[:32]
+
+    def _layout(self) -> Tuple[int, int]:
+        """Compute where entries start. Returns the offset
+        and size of the central directory."""
+        offset = 0
+        for entry in self.entries:
+            entry.offset = offset
+            offset += entry.local_header_size() + entry.size
+
+        cd_size = sum(entry.central_header_size() for entry in self.entries)
+        return offset, cd_size
+
+    def _needs_zip64(self, cd_offset: int, cd_size: int) -> bool:
+        return (
+            len(self.entries) >= ZIP_FILECOUNT_LIMIT
+            or cd_offset >= ZIP64_LIMIT
+            or cd_size >= ZIP64_LIMIT
+        )
+
+    @property
+    def size(self) -> int:
+        """Total size of the zip, in bytes."""
+        cd_offset, cd_size = self._layout()
+        size = cd_offset + cd_size + END_RECORD.size
+
+        if self._needs_zip64(cd_offset, cd_size):
+            size += END_RECORD64.size + END_LOCATOR64.size
+
+        return size
+
+    def _end_records(self, cd_offset: int, cd_size: int) -> bytes:
+        count = len(self.entries)
+        records = b""
+
+        if self._needs_zip64(cd_offset, cd_size):
+            end64_offset = cd_offset + cd_size
+            records += END_RECORD64.pack(
+                b"PK\x06\x06", 44, 45, 45, 0, 0, count, count, cd_size, cd_offset
+            )
+            records += END_LOCATOR64.pack(b"PK\x06\x07", 0, end64_offset, 1)
+
+        records += END_RECORD.pack(
+            b"PK\x05\x06",
+            0,
+            0,
+            min(count, ZIP_FILECOUNT_LIMIT),
+            min(count, ZIP_FILECOUNT_LIMIT),
+            min(cd_size, ZIP64_LIMIT),
+            min(cd_offset, ZIP64_LIMIT),
+            0,
+        )
+        return records
+
+    async def _read(
+        self, entry: ZipEntry, start: int, end: int
+    ) -> AsyncIterator[bytes]:
+        """Read the data of an entry, from start to end."""
+        if entry.data is not None:
+            yield entry.data[start:end]
+            return
+
+        while start < end:
+            size = min(CHUNK_SIZE, end - start)
+            chunk = await self.reader(entry.fspath, start, start + size)
+
+            if len(chunk) != size:
+                raise RuntimeError(f"{entry.fspath} changed size while streaming")
+
+            yield chunk
+            start += size
+
+    async def _crc(self, entry: ZipEntry) -> int:
+        """Get the CRC of an entry, reading it if needed."""
+        if entry.crc is not None:
+            return entry.crc
+
+        if self.crc_cache is not None:
+            entry.crc = await self.crc_cache.get(entry.fspath)
+            if entry.crc is not None:
+                return entry.crc
+
+        crc = 0
+        async for chunk in self._read(entry, 0, entry.size):
+            crc = zlib.crc32(chunk, crc)
+
+        await self._set_crc(entry, crc)
+        return crc
+
+    async def _set_crc(self, entry: ZipEntry, crc: int):
+        entry.crc = crc
+        if self.crc_cache is not None and entry.fspath is not None:
+            await self.crc_cache.set(entry.fspath, crc)
+
+    async def stream(self, start: int = 0, end: Optional[int] = None):
+        """Generate the bytes of the zip from start up to
+        (not including) end."""
+        cd_offset, cd_size = self._layout()
+        end = self.size if end is None else end
+
+        position = 0
+        for entry in self.entries:
+            parts = (
+                ("header", entry.local_header_size()),
+                ("data", entry.size),
+            )
+
+            for part, size in parts:
+                part_start, position = position, position + size
+                if position <= start or part_start >= end:
+                    continue
+
+                lo = max(start, part_start) - part_start
+                hi = min(end, position) - part_start
+
+                if part == "header":
+                    await self._crc(entry)
+                    yield entry.local_header()[lo:hi]
+                else:
+                    async for chunk in self._read(entry, lo, hi):
+                        yield chunk
+
+        if end <= cd_offset:
+            return
+
+        central = []
+        for entry in self.entries:
+            await self._crc(entry)
+            central.append(entry.central_header())
+
+        tail = b"".join(central) + self._end_records(cd_offset, cd_size)
+        yield tail[max(start - cd_offset, 0) : end - cd_offset]
@@ -2,6 +2,7 @@
 # Copyright 2018-2019, elixi.re Team and the elixire contributors
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import io
 import logging
 import os
 import time
@@ -10,6 +11,7 @@ from typing import Optional
 from quart import (
     Blueprint,
     current_app as app,
+    redirect,
     request,
     send_file as quart_send_file,
 )
@@ -63,6 +65,19 @@ async def send_file(
     return response
 
 
+async def send_blob(
+    location: str, *, mimetype: Optional[str] = None, domain: Optional[str] = None
+):
+    """Send stored contents, from the local filesystem, or by redirecting
+    to the storage backend if it doesn't keep them locally."""
+    path = app.blobs.local_path(location)
+    if path is not None:
+        return await send_file(path, mimetype=mimetype, domain=domain)
+
+    url = await app.blobs.presign(location, mimetype=mimetype)
+    return redirect(url)
+
+
 def request_is_from_discord() -> bool:
     """Returns if we should generate an HTML response to make Discord links
     not disappear with the message when posted.
@@ -138,7 +153,7 @@ async def file_handler(filename):
     if mimetype == "text/plain":
         mimetype = "text/plain; charset=utf-8"
 
-    return await send_file(filepath, mimetype=mimetype, domain=request.host)
+    return await send_blob(filepath, mimetype=mimetype, domain=request.host)
 
 
 @bp.get("/t/<filename>")
@@ -155,7 +170,7 @@ async def thumbnail_handler(filename):
     # if thumbnails are disabled, just return
     # the same file
     if not appcfg.THUMBNAILS:
-        return await send_file(fspath, domain=request.host)
+        return await send_blob(fspath, domain=request.host)
 
     thb_folder = appcfg.THUMBNAIL_FOLDER
     thumbpath = os.path.join(thb_folder, f"{thumbtype}{filename}")
@@ -163,7 +178,11 @@ async def thumbnail_handler(filename):
     if not os.path.isfile(thumbpath):
         tstart = time.monotonic()
 
-        image = Image.open(fspath)
+        source = app.blobs.local_path(fspath)
+        if source is None:
+            source = io.BytesIO(await app.blobs.get_range(fspath))
+
+        image = Image.open(source)
         image.thumbnail(appcfg.THUMBNAIL_SIZES[thumbtype])
         image.save(thumbpath)
 
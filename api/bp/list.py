@@ -3,10 +3,12 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 
 
+import json
 import logging
 from typing import Dict
 
-from quart import Blueprint, current_app as app, jsonify, request
+from quart import Blueprint, Response, current_app as app, jsonify, request
+from quart import stream_with_context
 from pathlib import Path
 
 from ..common.auth import token_check
@@ -131,3 +133,82 @@ async def list_handler():
         shortens[row["filename"]] = shorten_from_row(domains, row)
 
     return jsonify({"success": True, "files": files, "shortens": shortens})
+
+
+# how many rows are fetched from postgres at a time
+EXPORT_BATCH = 500
+
+# past any snowflake, so the first batch starts from the newest row
+_MAX_ID = (1 << 63) - 1
+
+
+def _ndjson_line(kind: str, data: dict) -> bytes:
+    return (json.dumps({"type": kind, **data}) + "\n").encode()
+
+
+async def _export_batches(query: str, key: str, user_id: int):
+    """Go through the rows of a query, newest first, in batches of
+    EXPORT_BATCH rows. The query is given the user, the key of the
+    last row of the previous batch, and the batch size.
+
+    Every batch is fetched on its own, so no connection is held
+    while the rows are sent out."""
+    last_id = _MAX_ID
+
+    while True:
+        rows = await app.db.fetch(query, user_id, last_id, EXPORT_BATCH)
+        if rows:
+            yield rows
+
+        if len(rows) < EXPORT_BATCH:
+            return
+
+        last_id = rows[-1][key]
+
+
+@bp.get("/list/export")
+async def list_export_handler():
+    """Stream every file and shorten of the user as NDJSON.
+
+    Each line is a JSON object with a "type" key ("file" or "shorten")
+    together with the same fields /api/list gives out. Rows are read in
+    batches so memory usage does not depend on account size.
+    """
+    user_id = await token_check()
+    domains = await domain_list()
+
+    @stream_with_context
+    async def _generate():
+        async for rows in _export_batches(
+            """
+        SELECT file_id, filename, file_size, fspath, domain, mimetype
+        FROM files
+        WHERE uploader = $1
+        AND deleted = false
+        AND file_id < $2
+        ORDER BY file_id DESC
+        LIMIT $3
+        """,
+            "file_id",
+            user_id,
+        ):
+            for row in rows:
+                yield _ndjson_line("file", file_from_row(domains, row))
+
+        async for rows in _export_batches(
+            """
+        SELECT shorten_id, filename, redirto, domain
+        FROM shortens
+        WHERE uploader = $1
+        AND deleted = false
+        AND shorten_id < $2
+        ORDER BY shorten_id DESC
+        LIMIT $3
+        """,
+            "shorten_id",
+            user_id,
+        ):
+            for row in rows:
+                yield _ndjson_line("shorten", shorten_from_row(domains, row))
+
+    return Response(_generate(), mimetype="application/x-ndjson")
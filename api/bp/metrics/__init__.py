@@ -14,6 +14,7 @@ solution to that), all metrics are published to InfluxDB.
 In production, you should use Grafana to visualize the data,
 or anything that connects with InfluxDB, really.
 """
-__all__ = ["bp", "is_consenting"]
+__all__ = ["bp", "is_consenting", "track_uploader"]
 
 from .blueprint import bp, is_consenting
+from .uniq import track_uploader
@@ -0,0 +1,51 @@
+# elixire: Image Host software
+# Copyright 2018-2019, elixi.re Team and the elixire contributors
+# SPDX-License-Identifier: AGPL-3.0-only
+
+from typing import List
+
+from .histogram import Histograms
+
+
+class MetricsBackend:
+    """Base class for metrics backends.
+
+    The rest of the app only talks to app.metrics through these methods,
+    so backends can be swapped with the METRICS_BACKEND setting.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+        #: response latencies, per endpoint and status class
+        self.latency = Histograms("response_latency", ("endpoint", "status"))
+
+        #: every histogram reported by the backend
+        self.histograms: List[Histograms] = [self.latency]
+
+    @property
+    def enabled(self) -> bool:
+        return self.app.econfig.ENABLE_METRICS
+
+    async def setup(self):
+        """Prepare the backend, once the app is starting."""
+
+    def submit(self, title, value):
+        """Submit a new datapoint."""
+        raise NotImplementedError()
+
+    def submit_many(self, values: dict):
+        """Submit multiple datapoints at once."""
+        for title, value in values.items():
+            self.submit(title, value)
+
+    def record_latency(self, endpoint: str, status_class: str, latency: float):
+        """Record a response latency, in milliseconds, into the
+        histogram for its endpoint and status class."""
+        if not self.enabled:
+            return
+
+        self.latency.record((endpoint, status_class), latency)
+
+    async def stop(self):
+        """Stop the backend, once the app is shutting down."""
@@ -2,10 +2,12 @@
 # Copyright 2018-2019, elixi.re Team and the elixire contributors
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import hmac
+import ipaddress
 import logging
 import time
 
-from quart import Blueprint, request, current_app as app
+from quart import Blueprint, Response, request, current_app as app
 from api.bp.metrics.tasks import (
     second_tasks,
     hourly_tasks,
@@ -13,6 +15,9 @@ from api.bp.metrics.tasks import (
 )
 from api.bp.metrics.compactor import compact_task
 from api.bp.metrics.manager import MetricsManager
+from api.bp.metrics.prometheus import PrometheusMetrics
+from api.common import get_ip_addr
+from api.errors import FailedAuth, NotFound
 
 bp = Blueprint("metrics", __name__)
 log = logging.getLogger(__name__)
@@ -30,17 +35,19 @@ async def is_consenting(user_id: int) -> bool:
     )
 
 
-async def create_db():
-    """Create InfluxDB database"""
-    app.metrics = MetricsManager(app, app.loop)
+def _is_prometheus() -> bool:
+    return getattr(app.econfig, "METRICS_BACKEND", "influxdb") == "prometheus"
 
-    if not app.econfig.ENABLE_METRICS:
-        return
 
-    dbname = app.econfig.METRICS_DATABASE
+async def create_db():
+    """Create the metrics backend"""
+    if _is_prometheus():
+        app.metrics = PrometheusMetrics(app)
+    else:
+        app.metrics = MetricsManager(app, app.loop)
 
-    log.info(f"Creating database {dbname}")
-    await app.metrics.influx.create_database(db=dbname)
+    app.metrics.histograms.extend(app.db.histograms)
+    await app.metrics.setup()
 
 
 async def start_tasks():
@@ -48,9 +55,14 @@ async def start_tasks():
     if not app.econfig.ENABLE_METRICS:
         return
 
-    app.sched.spawn_periodic(second_tasks, every=1)
     app.sched.spawn_periodic(hourly_tasks, every=3600)
     app.sched.spawn_periodic(upload_uniq_task, every=86400)
+
+    # prometheus reads counters on its own, and keeps its own history
+    if _is_prometheus():
+        return
+
+    app.sched.spawn_periodic(second_tasks, every=1)
     app.sched.spawn_periodic(compact_task, every=app.econfig.METRICS_COMPACT_GENERALIZE)
 
 
@@ -83,12 +95,52 @@ async def on_response(response):
     except AttributeError:
         return response
 
-    # calculate latency to get a response, and submit that to influx
+    # calculate latency to get a response
     # this field won't help in the case of network failure
     latency = time.monotonic() - request.start_time
 
-    # submit the metric as milliseconds since it is more tangible in
-    # normal scenarios
-    await app.metrics.submit("response_latency", latency * 1000)
+    # record the latency as milliseconds since it is more tangible in
+    # normal scenarios. those are sent as histograms, not as a datapoint
+    # per response.
+    rule = request.url_rule
+    endpoint = rule.endpoint if rule is not None else "unknown"
+    status_class = f"{response.status_code // 100}xx"
+    app.metrics.record_latency(endpoint, status_class, latency * 1000)
 
     return response
+
+
+def _scrape_allowed() -> bool:
+    """If the request may scrape metrics, by giving PROMETHEUS_TOKEN
+    as a bearer token, or by coming from PROMETHEUS_ALLOW."""
+    token = getattr(app.econfig, "PROMETHEUS_TOKEN", None)
+    if token:
+        given = request.headers.get("Authorization", "")
+        if hmac.compare_digest(given.encode(), f"Bearer {token}".encode()):
+            return True
+
+    allowed = getattr(app.econfig, "PROMETHEUS_ALLOW", ())
+    if not allowed:
+        return False
+
+    try:
+        address = ipaddress.ip_address(get_ip_addr())
+    except ValueError:
+        return False
+
+    return any(address in ipaddress.ip_network(network) for network in allowed)
+
+
+@bp.get("/metrics")
+async def prometheus_metrics():
+    """Serve metrics for Prometheus to scrape."""
+    if not app.econfig.ENABLE_METRICS or not _is_prometheus():
+        raise NotFound("Metrics are not served here")
+
+    if not _scrape_allowed():
+        raise FailedAuth("Not allowed to scrape metrics")
+
+    return Response(
+        await app.metrics.exposition(),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
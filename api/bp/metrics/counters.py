@@ -17,8 +17,13 @@ class MetricsCounters:
             "error_ise": 0,
             "file_upload_hour": 0,
             "file_upload_hour_pub": 0,
+            "scan": 0,
+            "scan_cached": 0,
         }
 
+        #: like data, but never reset
+        self.totals = dict.fromkeys(self.data, 0)
+
     def reset_all(self):
         """Initialize/reset all counters."""
         for key in self.data:
@@ -36,9 +41,10 @@ class MetricsCounters:
         """Increment a counter by one."""
         try:
             self.data[counter] += 1
+            self.totals[counter] += 1
         except KeyError:
             log.warning("unknown counter: %s", counter)
 
-    async def auto_submit(self, metrics, counter: str):
-        await metrics.submit(counter, self.data[counter])
+    def auto_submit(self, metrics, counter: str):
+        metrics.submit(counter, self.data[counter])
         self.reset_single(counter)
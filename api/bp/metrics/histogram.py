@@ -0,0 +1,128 @@
+# elixire: Image Host software
+# Copyright 2018-2019, elixi.re Team and the elixire contributors
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+elixire - latency histograms
+
+Instead of sending a datapoint for every response (or query), latencies
+are counted into fixed buckets per set of tags, e.g (endpoint, status
+class), and only the bucket counts plus p50/p90/p99 estimates are sent
+to InfluxDB, once every METRICS_LIMIT period.
+"""
+import bisect
+from typing import Dict, List, Optional, Tuple
+
+#: upper bounds of the latency buckets, in milliseconds.
+#  anything above the last bound goes into an overflow bucket.
+BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+PERCENTILES = (50, 90, 99)
+
+#: tag value of the histogram that takes what goes over max_series
+OVERFLOW = "other"
+
+
+def _escape_tag(value: str) -> str:
+    """Escape a tag value for InfluxDB's line protocol."""
+    return value.replace(",", r"\,").replace("=", r"\=").replace(" ", r"\ ")
+
+
+def series_key(measurement: str, **tags) -> str:
+    """Build a measurement name with tags attached, in line protocol."""
+    if not tags:
+        return measurement
+
+    tagset = ",".join(
+        f"{key}={_escape_tag(str(value))}" for key, value in sorted(tags.items())
+    )
+
+    return f"{measurement},{tagset}"
+
+
+class Histogram:
+    """Fixed-bucket latency histogram."""
+
+    __slots__ = ("counts", "total", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, pct: float) -> float:
+        """Estimate a percentile, interpolating inside the
+        bucket it falls in."""
+        rank = self.total * pct / 100
+        seen = 0
+
+        for index, count in enumerate(self.counts):
+            if not count or seen + count < rank:
+                seen += count
+                continue
+
+            lower = BUCKETS[index - 1] if index > 0 else 0
+            upper = BUCKETS[index] if index < len(BUCKETS) else self.max
+            upper = min(upper, self.max)
+            return lower + (upper - lower) * (rank - seen) / count
+
+        return self.max
+
+
+class Histograms:
+    """Histograms of a single measurement, keyed by their tag values."""
+
+    def __init__(
+        self,
+        measurement: str,
+        tags: Tuple[str, ...],
+        max_series: Optional[int] = None,
+    ):
+        self.measurement = measurement
+        self.tags = tags
+        self.histograms: Dict[tuple, Histogram] = {}
+
+        #: most histograms kept at once. past that, values of new tag
+        #  values are counted under OVERFLOW for every tag
+        self.max_series = max_series
+
+    def record(self, key: tuple, value: float):
+        try:
+            histogram = self.histograms[key]
+        except KeyError:
+            if self.max_series is not None and len(self.histograms) >= self.max_series:
+                key = (OVERFLOW,) * len(self.tags)
+
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+
+        histogram.record(value)
+
+    def flush(self) -> Dict[str, float]:
+        """Give the datapoints for every histogram, then reset them."""
+        histograms, self.histograms = self.histograms, {}
+        values: Dict[str, float] = {}
+        meas = self.measurement
+
+        for key, histogram in histograms.items():
+            tags = dict(zip(self.tags, key))
+            values[series_key(f"{meas}_count", **tags)] = histogram.total
+            values[series_key(f"{meas}_max", **tags)] = histogram.max
+
+            for pct in PERCENTILES:
+                values[series_key(f"{meas}_p{pct}", **tags)] = histogram.percentile(pct)
+
+            bounds: List[str] = [str(bound) for bound in BUCKETS] + ["+Inf"]
+            for bound, count in zip(bounds, histogram.counts):
+                if count:
+                    values[series_key(f"{meas}_bucket", bucket=bound, **tags)] = count
+
+        return values
@@ -4,11 +4,17 @@
 
 import logging
 import time
+from collections import deque
 
 from aioinflux import InfluxDBClient
 
+from .backend import MetricsBackend
+
 log = logging.getLogger(__name__)
 
+#: most histogram datapoints sent in a single write
+HISTOGRAM_BATCH = 5000
+
 
 # from https://stackoverflow.com/a/312464
 def chunks(l, n):
@@ -17,7 +23,7 @@ def chunks(l, n):
         yield l[i : i + n]
 
 
-class MetricsManager:
+class MetricsManager(MetricsBackend):
     """Manager class for metric-related functions.
 
     This class manages the metric queue and makes sure the
@@ -25,11 +31,16 @@ class MetricsManager:
     """
 
     def __init__(self, app, loop):
-        self.app = app
+        super().__init__(app)
         self.loop = loop
 
-        #: all datapoints to be sent
-        self.points = {}
+        #: all datapoints to be sent, as (measurement, value, timestamp)
+        #  tuples. when full, the oldest datapoints are dropped.
+        buffer_size = getattr(app.econfig, "METRICS_BUFFER_SIZE", 10000)
+        self.points = deque(maxlen=buffer_size)
+
+        #: how many datapoints were dropped since the last flush
+        self.dropped = 0
 
         #: InfluxDB connection
         self.influx = None
@@ -47,6 +58,16 @@ class MetricsManager:
                 self._work, every=self._period, name="metrics_worker"
             )
 
+    async def setup(self):
+        """Create the InfluxDB database."""
+        if not self.enabled:
+            return
+
+        dbname = self.app.econfig.METRICS_DATABASE
+
+        log.info(f"Creating database {dbname}")
+        await self.influx.create_database(db=dbname)
+
     def _start_influx(self):
         cfg = self.app.econfig
 
@@ -80,45 +101,63 @@ class MetricsManager:
         self.influx = InfluxDBClient(db=cfg.METRICS_DATABASE, loop=self.loop)
 
     def _fetch_points(self, limit=None) -> list:
-        """Fetch datapoints to properly send to InfluxDB."""
+        """Fetch datapoints to properly send to InfluxDB,
+        in the order they were submitted."""
         if limit is None:
             limit = self._timestamps
 
-        # sort timestamps from oldest to youngest
-        timestamps = sorted(self.points.keys())
+        if limit == 0 or limit > len(self.points):
+            limit = len(self.points)
+
+        log.debug(f"{limit} datapoints found...")
+        popleft = self.points.popleft
+        return [popleft() for _ in range(limit)]
 
-        if limit != 0:
-            timestamps = timestamps[: self._timestamps]
+    def _serialize(self, points: list) -> str:
+        """Convert datapoints to InfluxDB's line protocol."""
+        if self.dropped:
+            points.append(("metrics_dropped", self.dropped, self._timestamp()))
+            self.dropped = 0
 
-        log.debug(f"{len(timestamps)} datapoints found...")
+        convert = self._convert_value
+        return "\n".join(
+            f"{title} value={convert(value)} {timestamp}"
+            for title, value, timestamp in points
+        )
 
-        # fetch the respective points, in the order they were put in.
-        points = []
-        for tstamp in timestamps:
-            try:
-                point = self.points.pop(tstamp)
-                points.append(point)
-            except ValueError:
-                pass
+    async def _write(self, points: list):
+        try:
+            await self.influx.write(self._serialize(points))
+        except Exception as err:
+            log.warning(f"failed to submit datapoint: {err!r}")
 
-        return points
+    def _flush_histograms(self) -> list:
+        """Give the datapoints of every histogram, all with the same
+        timestamp, and reset them."""
+        timestamp = self._timestamp()
+        return [
+            (title, value, timestamp)
+            for histograms in self.histograms
+            for title, value in histograms.flush().items()
+        ]
+
+    async def _write_histograms(self):
+        # histograms are sent once per period, in writes of their own,
+        # instead of taking the room of other datapoints in the buffer
+        points = self._flush_histograms()
+        for batch in chunks(points, HISTOGRAM_BATCH):
+            await self._write(batch)
 
     async def _work(self):
+        await self._write_histograms()
+
         # if there aren't any datapoints to
         # submit, do nothing
         if not self.points:
             log.debug("no points")
             return
 
-        points = self._fetch_points()
-        all_points = "\n".join(points)
-        try:
-            await self.influx.write(all_points)
-        except Exception as err:
-            log.warning(f"failed to submit datapoint: {err!r}")
-
-        del points
-        del all_points
+        await self._write(self._fetch_points())
 
     def _convert_value(self, value):
         if isinstance(value, int):
@@ -126,29 +165,34 @@ class MetricsManager:
 
         return f"{value}"
 
-    async def submit(self, title, value):
+    def _timestamp(self) -> int:
+        """Give the current time as a nanosecond timestamp,
+        which is what the line format uses."""
+        return time.time_ns()
+
+    def submit(self, title, value):
         """Submit a new datapoint to be sent
         to InfluxDB."""
-        if not self.app.econfig.ENABLE_METRICS:
+        if not self.enabled:
             return
 
-        #: this is relative to the app, NOT
-        #  to be dispatched to InfluxDB.
-        timestamp = str(time.monotonic())
+        if len(self.points) == self.points.maxlen:
+            self.dropped += 1
 
-        # line format uses a nanosecond timestamp, so
-        # we generate one from time.time().
-        current = time.time()
+        self.points.append((title, value, self._timestamp()))
 
-        # extract all precision we can, then convert to int
-        current = int(current * (10**6))
+    def submit_many(self, values: dict):
+        """Submit multiple datapoints at once, all with the same
+        timestamp. They are sent to InfluxDB in the same write."""
+        if not self.enabled:
+            return
 
-        # then raise it to how many missing orders
-        # of magnitude to get a nanosecond timestamp
-        current = current * (10**3)
+        timestamp = self._timestamp()
+        for title, value in values.items():
+            if len(self.points) == self.points.maxlen:
+                self.dropped += 1
 
-        value_converted = self._convert_value(value)
-        self.points[timestamp] = f"{title} value={value_converted} {current}"
+            self.points.append((title, value, timestamp))
 
     async def _close(self):
         if self.influx:
@@ -157,18 +201,14 @@ class MetricsManager:
 
     async def finish_all(self):
         """Finish all remaining datapoints"""
+        await self._write_histograms()
+
         if not self.points:
             log.warning("no points to finish")
             await self._close()
             return
 
-        points = self._fetch_points(0)
-        full_str = "\n".join(points)
-        try:
-            await self.influx.write(full_str)
-        except Exception as err:
-            log.warning(f"failed to submit datapoint: {err!r}")
-
+        await self._write(self._fetch_points(0))
         await self._close()
 
     async def stop(self):
@@ -0,0 +1,214 @@
+# elixire: Image Host software
+# Copyright 2018-2019, elixi.re Team and the elixire contributors
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+elixire - prometheus metrics backend
+
+Instead of pushing datapoints somewhere, everything is kept in memory
+and served in the Prometheus text exposition format on /metrics.
+
+With multiple workers, a scrape only reaches one of them. When
+PROMETHEUS_MULTIWORKER is enabled, every worker publishes its samples
+to Redis, and /metrics serves the samples of all live workers, each
+with a "worker" label.
+"""
+import json
+import logging
+import os
+import re
+from typing import Dict, List, Optional
+
+from .backend import MetricsBackend
+from .histogram import BUCKETS, Histograms
+
+log = logging.getLogger(__name__)
+
+PREFIX = "elixire_"
+WORKER_KEY = "prometheus:worker:"
+
+_INVALID_NAME = re.compile(r"[^a-zA-Z0-9_:]")
+
+
+def _name(title: str) -> str:
+    return PREFIX + _INVALID_NAME.sub("_", title)
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+class Families:
+    """Metric families, in a JSON-friendly shape.
+
+    Each family is keyed by name and holds its type and a list of
+    [suffix, labels, value] samples.
+    """
+
+    def __init__(self):
+        self.data: Dict[str, dict] = {}
+
+    def add(self, name: str, typ: str, value, *, suffix="", **labels):
+        family = self.data.setdefault(name, {"type": typ, "samples": []})
+        family["samples"].append([suffix, labels, value])
+
+
+def render(families: Dict[str, dict]) -> str:
+    """Render metric families in the text exposition format."""
+    lines = []
+
+    for name, family in families.items():
+        lines.append(f"# TYPE {name} {family['type']}")
+
+        for suffix, labels, value in family["samples"]:
+            labelset = ",".join(
+                f'{key}="{_escape_label(val)}"' for key, val in labels.items()
+            )
+            labelset = f"{{{labelset}}}" if labelset else ""
+            lines.append(f"{name}{suffix}{labelset} {_format_value(value)}")
+
+    lines.append("")
+    return "\n".join(lines)
+
+
+def merge(workers: Dict[str, Dict[str, dict]]) -> Dict[str, dict]:
+    """Merge the families of multiple workers, adding a worker label."""
+    merged: Dict[str, dict] = {}
+
+    for worker, families in workers.items():
+        for name, family in families.items():
+            target = merged.setdefault(name, {"type": family["type"], "samples": []})
+            target["samples"].extend(
+                [suffix, {**labels, "worker": worker}, value]
+                for suffix, labels, value in family["samples"]
+            )
+
+    return merged
+
+
+class PrometheusMetrics(MetricsBackend):
+    """Metrics backend that is scraped by Prometheus."""
+
+    def __init__(self, app):
+        super().__init__(app)
+
+        #: last value of every submitted datapoint
+        self.gauges: Dict[str, float] = {}
+
+        self.multiworker = getattr(app.econfig, "PROMETHEUS_MULTIWORKER", False)
+        self.worker = str(os.getpid())
+
+        # published samples expire after a few periods, so that
+        # workers that went away stop being served
+        _, self.period = getattr(app.econfig, "METRICS_LIMIT", (100, 3))
+
+    def submit(self, title, value):
+        if not self.enabled:
+            return
+
+        self.gauges[title] = value
+
+    def _collect_histograms(self, families: Families, histograms: Histograms):
+        name = _name(f"{histograms.measurement}_milliseconds")
+
+        for key, histogram in histograms.histograms.items():
+            labels = dict(zip(histograms.tags, key))
+
+            cumulative = 0
+            for bound, count in zip(BUCKETS + (float("inf"),), histogram.counts):
+                cumulative += count
+                families.add(
+                    name,
+                    "histogram",
+                    cumulative,
+                    suffix="_bucket",
+                    le=_format_value(float(bound)),
+                    **labels,
+                )
+
+            families.add(name, "histogram", histogram.sum, suffix="_sum", **labels)
+            families.add(name, "histogram", histogram.total, suffix="_count", **labels)
+
+    def _collect_runtime(self, families: Families):
+        app = self.app
+
+        pool = getattr(app, "db", None)
+        if pool is not None:
+            for title, value in pool.pool_stats().items():
+                families.add(_name(title), "gauge", value)
+
+        executor = getattr(app, "executor", None)
+        if executor is not None:
+            families.add(
+                _name("executor_queue_depth"), "gauge", executor._work_queue.qsize()
+            )
+
+        storage = getattr(app, "storage", None)
+        if storage is not None:
+            families.add(_name("cache_hits_total"), "counter", storage.hits)
+            families.add(_name("cache_misses_total"), "counter", storage.misses)
+
+    def collect(self) -> Dict[str, dict]:
+        """Collect every metric of this worker."""
+        families = Families()
+
+        for counter, value in self.app.counters.totals.items():
+            families.add(_name(f"{counter}_total"), "counter", value)
+
+        for title, value in self.gauges.items():
+            families.add(_name(title), "gauge", value)
+
+        for histograms in self.histograms:
+            self._collect_histograms(families, histograms)
+
+        self._collect_runtime(families)
+        return families.data
+
+    async def publish(self):
+        """Publish this worker's metrics for the other workers to serve."""
+        await self.app.redis.set(
+            f"{WORKER_KEY}{self.worker}",
+            json.dumps(self.collect()),
+            ex=self.period * 3,
+        )
+
+    async def setup(self):
+        if self.enabled and self.multiworker:
+            self.app.sched.spawn_periodic(
+                self.publish, every=self.period, name="prometheus_publish"
+            )
+
+    async def stop(self):
+        if self.multiworker:
+            self.app.sched.stop_job("prometheus_publish")
+            await self.app.redis.delete(f"{WORKER_KEY}{self.worker}")
+
+    async def _fetch_workers(self) -> Dict[str, Dict[str, dict]]:
+        keys: List[str] = [
+            key async for key in self.app.redis.scan_iter(match=f"{WORKER_KEY}*")
+        ]
+        values: List[Optional[str]] = await self.app.redis.mget(keys) if keys else []
+
+        workers = {
+            key[len(WORKER_KEY) :]: json.loads(value)
+            for key, value in zip(keys, values)
+            if value is not None
+        }
+
+        # our own samples are always the freshest
+        workers[self.worker] = self.collect()
+        return workers
+
+    async def exposition(self) -> str:
+        """Give the metrics in the text exposition format."""
+        if not self.multiworker:
+            return render(self.collect())
+
+        return render(merge(await self._fetch_workers()))
@@ -2,10 +2,13 @@
 # Copyright 2018-2019, elixi.re Team and the elixire contributors
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import datetime
 import logging
 
 from quart import current_app as app
 
+from api.bp.metrics.uniq import count_uploaders
+
 log = logging.getLogger(__name__)
 
 
@@ -19,7 +22,9 @@ async def second_tasks():
         if counter in ("file_upload_hour", "file_upload_hour_pub"):
             continue
 
-        await counters.auto_submit(metrics, counter)
+        counters.auto_submit(metrics, counter)
+
+    metrics.submit_many(app.db.pool_stats())
 
 
 async def file_upload_counts():
@@ -27,125 +32,64 @@ async def file_upload_counts():
     metrics = app.metrics
     counters = app.counters
 
-    await counters.auto_submit(metrics, "file_upload_hour")
-    await counters.auto_submit(metrics, "file_upload_hour_pub")
+    counters.auto_submit(metrics, "file_upload_hour")
+    counters.auto_submit(metrics, "file_upload_hour_pub")
 
 
-async def file_total_counts():
-    """Submit total file count."""
-    total_files = await app.db.fetchval(
-        """
-    SELECT COUNT(*)
-    FROM files
-    """
-    )
+async def instance_counts():
+    """Submit instance-wide file, size and user counts.
 
-    total_files_public = await app.db.fetchval(
-        """
-    SELECT COUNT(*)
-    FROM files
-    JOIN users on files.uploader = users.user_id
-    WHERE users.consented = true
+    Everything is taken in a single pass over users joined with the
+    user_stats counters, instead of aggregating over the files table.
     """
-    )
-
-    metrics = app.metrics
-    await metrics.submit("total_files", total_files)
-    await metrics.submit("total_files_public", total_files_public)
-
-
-async def file_size_counts():
-    """Submit file sizes in megabytes."""
-    total_size = (
-        await app.db.fetchval(
-            """
-    SELECT SUM(file_size) / 1048576
-    FROM files
-    """
-        )
-        or 0.0
-    )
-
-    total_size_public = (
-        await app.db.fetchval(
-            """
-    SELECT SUM(file_size) / 1048576
-    FROM files
-    JOIN users ON files.uploader = users.user_id
-    WHERE users.consented = true
-    """
-        )
-        or 0.0
-    )
-
-    metrics = app.metrics
-    await metrics.submit("total_size", total_size)
-    await metrics.submit("total_size_public", total_size_public)
-
-
-async def user_counts():
-    """Submit information related to our users."""
-    active = await app.db.fetchval(
-        """
-    SELECT COUNT(*)
-    FROM users
-    WHERE active = true
-    """
-    )
-
-    consented = await app.db.fetchval(
-        """
-    SELECT COUNT(*)
-    FROM users
-    WHERE active = true AND consented = true
-    """
-    )
-
-    inactive = await app.db.fetchval(
+    row = await app.db.fetchrow(
         """
-    SELECT COUNT(*)
+    SELECT
+        COALESCE(SUM(user_stats.total_files), 0) AS total_files,
+        COALESCE(SUM(user_stats.total_files)
+            FILTER (WHERE users.consented = true), 0) AS total_files_public,
+        COALESCE(SUM(user_stats.total_bytes), 0) / 1048576 AS total_size,
+        COALESCE(SUM(user_stats.total_bytes)
+            FILTER (WHERE users.consented = true), 0) / 1048576
+            AS total_size_public,
+        COUNT(*) FILTER (WHERE users.active = true) AS active_users,
+        COUNT(*) FILTER (WHERE users.active = true AND users.consented = true)
+            AS consented_users,
+        COUNT(*) FILTER (WHERE users.active = false) AS inactive_users
     FROM users
-    WHERE active = false
+    LEFT JOIN user_stats
+      ON user_stats.user_id = users.user_id
     """
     )
 
-    metrics = app.metrics
-    await metrics.submit("active_users", active)
-    await metrics.submit("consented_users", consented)
-    await metrics.submit("inactive_users", inactive)
+    app.metrics.submit_many(dict(row))
 
 
 async def hourly_tasks():
     """Functions to be run hourly."""
     await file_upload_counts()
-    await file_total_counts()
-    await file_size_counts()
-    await user_counts()
+    await instance_counts()
 
 
 async def upload_uniq_task():
-    """Count the amount of unique uploads and uploaders
-    in the past 24 hours."""
-    metrics = app.metrics
+    """Count the amount of unique uploaders in the
+    last day, week and month.
 
-    count = await app.db.fetchval(
-        """
-    SELECT COUNT(DISTINCT uploader)
-    FROM files
-    WHERE file_id > time_snowflake(now() - interval '24 hours')
+    Those are read from the HyperLogLogs filled on upload, so
+    the database isn't touched.
     """
-    )
+    metrics = app.metrics
 
-    await metrics.submit("uniq_uploaders_day", count)
+    # the previous day is the last one that is complete
+    yesterday = datetime.datetime.utcnow().date() - datetime.timedelta(days=1)
 
-    countpub = await app.db.fetchval(
-        """
-    SELECT COUNT(DISTINCT uploader)
-    FROM files
-    JOIN users ON users.user_id = files.uploader
-    WHERE file_id > time_snowflake(now() - interval '24 hours')
-        AND users.consented = true
-    """
-    )
+    for name, days in (("day", 1), ("week", 7), ("month", 30)):
+        count = await count_uploaders(yesterday, days)
+        countpub = await count_uploaders(yesterday, days, public=True)
 
-    await metrics.submit("uniq_uploaders_day_pub", countpub)
+        metrics.submit_many(
+            {
+                f"uniq_uploaders_{name}": count,
+                f"uniq_uploaders_{name}_pub": countpub,
+            }
+        )
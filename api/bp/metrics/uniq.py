@@ -0,0 +1,57 @@
+# elixire: Image Host software
+# Copyright 2018-2019, elixi.re Team and the elixire contributors
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+elixire - unique uploader tracking
+
+Unique uploaders are tracked on upload with Redis HyperLogLogs, one per
+UTC day (and another one for consenting users only). Counting them is
+then a PFCOUNT, and since HyperLogLogs are mergeable, counting uniques
+over a week or a month is a PFCOUNT over multiple day keys.
+"""
+import datetime
+from typing import List
+
+from quart import current_app as app
+
+# keep a bit over a month of days so monthly counts work
+KEY_TTL = 32 * 86400
+
+
+def _day_key(day: datetime.date, public: bool = False) -> str:
+    prefix = "uniq_uploaders_pub" if public else "uniq_uploaders"
+    return f"{prefix}:{day.isoformat()}"
+
+
+def _day_keys(last_day: datetime.date, days: int, public: bool) -> List[str]:
+    return [
+        _day_key(last_day - datetime.timedelta(days=offset), public)
+        for offset in range(days)
+    ]
+
+
+async def track_uploader(user_id: int, consenting: bool):
+    """Add an uploader to today's unique uploader sets."""
+    if not app.econfig.ENABLE_METRICS:
+        return
+
+    today = datetime.datetime.utcnow().date()
+    keys = [_day_key(today)]
+    if consenting:
+        keys.append(_day_key(today, True))
+
+    async with app.redis.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.pfadd(key, user_id)
+            pipe.expire(key, KEY_TTL)
+
+        await pipe.execute()
+
+
+async def count_uploaders(
+    last_day: datetime.date, days: int = 1, *, public: bool = False
+) -> int:
+    """Count unique uploaders over the given amount of days,
+    ending at (and including) last_day."""
+    return await app.redis.pfcount(*_day_keys(last_day, days, public))
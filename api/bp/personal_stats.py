@@ -7,51 +7,36 @@ import logging
 from quart import Blueprint, jsonify, current_app as app
 
 from api.decorators import auth_route
-from api.common.domain import get_domain_public
+from api.common.domain import get_owned_domains
 
 
 bp = Blueprint("personal_stats", __name__)
 log = logging.getLogger(__name__)
 
 
-async def _get_counts(table: str, user_id: int, extra: str = "") -> int:
-    res = await app.db.fetchval(
-        f"""
-    SELECT COUNT(*)
-    FROM {table}
-    WHERE uploader = $1
-    {extra}
-    """,
-        user_id,
-    )
-
-    return res or 0
-
-
 async def get_counts(user_id: int) -> dict:
-    """Get count information about a user."""
-    total_files = await _get_counts("files", user_id)
-    total_shortens = await _get_counts("shortens", user_id)
-    total_deleted = await _get_counts("files", user_id, "AND deleted = true")
+    """Get count information about a user.
 
-    total_bytes = (
-        await app.db.fetchval(
-            """
-    SELECT SUM(file_size)
-    FROM files
-    WHERE uploader = $1
+    Those come from the user_stats table, kept up to date by triggers.
+    """
+    row = await app.db.fetchrow(
+        """
+    SELECT total_files, total_deleted_files, total_bytes, total_shortens
+    FROM user_stats
+    WHERE user_id = $1
     """,
-            user_id,
-        )
-        or 0
+        user_id,
     )
 
-    return {
-        "total_files": int(total_files),
-        "total_deleted_files": int(total_deleted),
-        "total_bytes": int(total_bytes),
-        "total_shortens": int(total_shortens),
-    }
+    if row is None:
+        return {
+            "total_files": 0,
+            "total_deleted_files": 0,
+            "total_bytes": 0,
+            "total_shortens": 0,
+        }
+
+    return dict(row)
 
 
 @bp.get("", strict_slashes=False)
@@ -66,38 +51,4 @@ async def personal_stats_handler(user_id):
 @auth_route
 async def personal_domain_stats(user_id):
     """Fetch information about the domains you own."""
-    db = app.db
-
-    domain_ids = await db.fetch(
-        """
-    SELECT domain_id
-    FROM domain_owners
-    WHERE user_id = $1
-    """,
-        user_id,
-    )
-
-    res = {}
-
-    for row in domain_ids:
-        domain_id = row["domain_id"]
-
-        domain_info = await db.fetchrow(
-            """
-        SELECT domain, official, admin_only, permissions
-        FROM domains
-        WHERE domain_id = $1
-        """,
-            domain_id,
-        )
-
-        dinfo = dict(domain_info)
-        dinfo["cf_enabled"] = False
-
-        public = await get_domain_public(domain_id)
-        res[domain_id] = {
-            "info": dinfo,
-            "stats": public,
-        }
-
-    return jsonify(res)
+    return jsonify(await get_owned_domains(user_id))
@@ -3,12 +3,10 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 
 import logging
-import asyncio
 
 import asyncpg
 
 from quart import Blueprint, jsonify, request, current_app as app
-from quart.ctx import copy_current_app_context
 
 from ..errors import FailedAuth, FeatureDisabled, BadInput
 from ..common.auth import (
@@ -32,8 +30,8 @@ from ..schema import (
     PASSWORD_RESET_SCHEMA,
     PASSWORD_RESET_CONFIRM_SCHEMA,
 )
-from ..common import delete_file
-from ..common.utils import int_
+from ..common import delete_user_files
+from ..common.usage import get_usage
 
 bp = Blueprint("profile", __name__)
 log = logging.getLogger(__name__)
@@ -56,45 +54,15 @@ async def _update_password(user_id, new_pwd):
     await app.storage.invalidate(user_id, "password_hash")
 
 
-async def get_limits(db, user_id) -> dict:
+async def get_limits(user_id) -> dict:
     """Get a user's limit information."""
-    limits = await db.fetchrow(
-        """
-    SELECT blimit, shlimit
-    FROM limits
-    WHERE user_id = $1
-    """,
-        user_id,
-    )
-
-    if not limits:
-        return {"limit": None, "used": None, "shortenlimit": None, "shortenused": None}
-
-    bytes_used = await db.fetchval(
-        """
-    SELECT SUM(file_size)
-    FROM files
-    WHERE uploader = $1
-    AND file_id > time_snowflake(now() - interval '7 days')
-    """,
-        user_id,
-    )
-
-    shortens_used = await db.fetchval(
-        """
-    SELECT COUNT(*)
-    FROM shortens
-    WHERE uploader = $1
-    AND shorten_id > time_snowflake(now() - interval '7 days')
-    """,
-        user_id,
-    )
+    usage = await get_usage(user_id)
 
     return {
-        "limit": limits["blimit"],
-        "used": int_(bytes_used, 0),
-        "shortenlimit": limits["shlimit"],
-        "shortenused": shortens_used,
+        "limit": usage["blimit"],
+        "used": usage["bytes_used"],
+        "shortenlimit": usage["shlimit"],
+        "shortenused": usage["shortens_used"],
     }
 
 
@@ -116,7 +84,7 @@ async def profile_handler():
     if not user:
         raise FailedAuth("unknown user")
 
-    limits = await get_limits(app.db, user_id)
+    limits = await get_limits(user_id)
 
     duser = dict(user)
     duser["user_id"] = str(duser["user_id"])
@@ -152,157 +120,163 @@ async def change_profile():
     if password:
         await password_check(user_id, password)
 
-    if password and new_username is not None:
-        new_username = new_username.lower()
-
-        # query the old username from database
-        # instead of relying in Storage
-        old_username = await app.db.fetchval(
-            """
-        SELECT username
-        FROM users
-        WHERE user_id = $1
-        """,
-            user_id,
-        )
+    # the cached profile goes as soon as anything was written,
+    # even if a later change fails
+    try:
+        if password and new_username is not None:
+            new_username = new_username.lower()
 
-        try:
-            await app.db.execute(
+            # query the old username from database
+            # instead of relying in Storage
+            old_username = await app.db.fetchval(
                 """
-            UPDATE users
-            SET username = $1
-            WHERE user_id = $2
+            SELECT username
+            FROM users
+            WHERE user_id = $1
             """,
-                new_username,
                 user_id,
             )
-        except asyncpg.exceptions.UniqueViolationError:
-            raise BadInput("Username already selected")
-
-        # if this worked, we should invalidate the old keys
-        await app.storage.raw_invalidate(f"uid:{old_username}", f"uname:{user_id}")
 
-        # also invalidate the new one representing the future username
-        await app.storage.raw_invalidate(f"uid:{new_username}")
+            try:
+                await app.db.execute(
+                    """
+                UPDATE users
+                SET username = $1
+                WHERE user_id = $2
+                """,
+                    new_username,
+                    user_id,
+                )
+            except asyncpg.exceptions.UniqueViolationError:
+                raise BadInput("Username already selected")
+
+            # if this worked, we should invalidate the old keys
+            await app.storage.raw_invalidate(f"uid:{old_username}", f"uname:{user_id}")
+
+            # also invalidate the new one representing the future username
+            await app.storage.raw_invalidate(f"uid:{new_username}")
+
+            updated.append("username")
+
+        if new_domain is not None:
+            # Check if domain exists
+            domain_info = await check_domain_id(new_domain)
+
+            # Check if user has perms for getting that domain
+            is_admin = await check_admin(user_id, False)
+            if domain_info["admin_only"] and not is_admin:
+                raise FailedAuth(
+                    "You're not an admin but you're "
+                    "trying to switch to an admin-only domain."
+                )
 
-        updated.append("username")
-
-    if new_domain is not None:
-        # Check if domain exists
-        domain_info = await check_domain_id(new_domain)
-
-        # Check if user has perms for getting that domain
-        is_admin = await check_admin(user_id, False)
-        if domain_info["admin_only"] and not is_admin:
-            raise FailedAuth(
-                "You're not an admin but you're "
-                "trying to switch to an admin-only domain."
+            await app.db.execute(
+                """
+                UPDATE users
+                SET domain = $1
+                WHERE user_id = $2
+            """,
+                new_domain,
+                user_id,
             )
 
-        await app.db.execute(
-            """
-            UPDATE users
-            SET domain = $1
-            WHERE user_id = $2
-        """,
-            new_domain,
-            user_id,
-        )
+            updated.append("domain")
 
-        updated.append("domain")
-
-    if new_subdomain is not None:
-        await app.db.execute(
-            """
-            UPDATE users
-            SET subdomain = $1
-            WHERE user_id = $2
-        """,
-            new_subdomain,
-            user_id,
-        )
+        if new_subdomain is not None:
+            await app.db.execute(
+                """
+                UPDATE users
+                SET subdomain = $1
+                WHERE user_id = $2
+            """,
+                new_subdomain,
+                user_id,
+            )
 
-        updated.append("subdomain")
+            updated.append("subdomain")
 
-    # shorten_subdomain CAN be None.
-    # when it is None, backend will assume the user wants the same domain
-    # for both uploads and shortens
-    try:
-        new_shorten_domain = payload["shorten_domain"]
-        await app.db.execute(
-            """
-            UPDATE users
-            SET shorten_domain = $1
-            WHERE user_id = $2
-        """,
-            new_shorten_domain,
-            user_id,
-        )
+        # shorten_subdomain CAN be None.
+        # when it is None, backend will assume the user wants the same domain
+        # for both uploads and shortens
+        try:
+            new_shorten_domain = payload["shorten_domain"]
+            await app.db.execute(
+                """
+                UPDATE users
+                SET shorten_domain = $1
+                WHERE user_id = $2
+            """,
+                new_shorten_domain,
+                user_id,
+            )
 
-        updated.append("shorten_domain")
-    except KeyError:
-        pass
+            updated.append("shorten_domain")
+        except KeyError:
+            pass
 
-    if new_shorten_subdomain is not None:
-        await app.db.execute(
-            """
-            UPDATE users
-            SET shorten_subdomain = $1
-            WHERE user_id = $2
-        """,
-            new_shorten_subdomain,
-            user_id,
-        )
+        if new_shorten_subdomain is not None:
+            await app.db.execute(
+                """
+                UPDATE users
+                SET shorten_subdomain = $1
+                WHERE user_id = $2
+            """,
+                new_shorten_subdomain,
+                user_id,
+            )
 
-        updated.append("shorten_subdomain")
+            updated.append("shorten_subdomain")
 
-    if password and new_email is not None:
-        await app.db.execute(
-            """
-            UPDATE users
-            SET email = $1
-            WHERE user_id = $2
-        """,
-            new_email,
-            user_id,
-        )
+        if password and new_email is not None:
+            await app.db.execute(
+                """
+                UPDATE users
+                SET email = $1
+                WHERE user_id = $2
+            """,
+                new_email,
+                user_id,
+            )
 
-        updated.append("email")
+            updated.append("email")
 
-    if new_paranoid is not None:
-        await app.db.execute(
-            """
-            UPDATE users
-            SET paranoid = $1
-            WHERE user_id = $2
-        """,
-            new_paranoid,
-            user_id,
-        )
+        if new_paranoid is not None:
+            await app.db.execute(
+                """
+                UPDATE users
+                SET paranoid = $1
+                WHERE user_id = $2
+            """,
+                new_paranoid,
+                user_id,
+            )
 
-        updated.append("paranoid")
+            updated.append("paranoid")
 
-    try:
-        new_consent_state = payload["consented"]
+        try:
+            new_consent_state = payload["consented"]
 
-        await app.db.execute(
-            """
-            UPDATE users
-            SET consented = $1
-            WHERE user_id = $2
-        """,
-            new_consent_state,
-            user_id,
-        )
+            await app.db.execute(
+                """
+                UPDATE users
+                SET consented = $1
+                WHERE user_id = $2
+            """,
+                new_consent_state,
+                user_id,
+            )
 
-        updated.append("consented")
-    except KeyError:
-        pass
+            updated.append("consented")
+        except KeyError:
+            pass
 
-    if password and new_pwd and new_pwd != password:
-        # we are already good from password_check call
-        await _update_password(user_id, new_pwd)
-        updated.append("password")
+        if password and new_pwd and new_pwd != password:
+            # we are already good from password_check call
+            await _update_password(user_id, new_pwd)
+            updated.append("password")
+    finally:
+        if updated:
+            await app.storage.invalidate(user_id, "upload_profile")
 
     return jsonify(
         {
@@ -316,7 +290,7 @@ async def limits_handler():
     """Query a user's limits."""
     user_id = await token_check()
 
-    limits = await get_limits(app.db, user_id)
+    limits = await get_limits(user_id)
 
     return jsonify(limits)
 
@@ -363,18 +337,6 @@ Do not reply to this email specifically, it will not work.
     return jsonify({"success": True})
 
 
-async def _delete_file_wrapper(shortname, user_id):
-    lock = app.locks["delete_files"][user_id]
-    await lock.acquire()
-
-    try:
-        await delete_file(shortname, user_id, False)
-    finally:
-        lock.release()
-
-    return None
-
-
 async def delete_file_task(user_id: int, delete=False):
     """Delete all the files from the user.
 
@@ -387,32 +349,10 @@ async def delete_file_task(user_id: int, delete=False):
     delete, optional: bool
         If delete the user when all files are deleted
     """
-    file_shortnames = await app.db.fetch(
-        """
-    SELECT filename
-    FROM files
-    WHERE uploader = $1
-    """,
-        user_id,
-    )
-
-    log.info(f"Deleting ALL {len(file_shortnames)} files")
-
-    tasks = []
-
-    @copy_current_app_context
-    async def _wrap(*args):
-        await _delete_file_wrapper(*args)
-
-    for row in file_shortnames:
-        shortname = row["filename"]
-        task = app.loop.create_task(_wrap(shortname, user_id))
-        tasks.append(task)
-
-    if tasks:
-        await asyncio.gather(*tasks)
+    async with app.locks["delete_files"][user_id]:
+        deleted = await delete_user_files(user_id)
 
-    log.info(f"finished waiting for {len(tasks)} tasks")
+    log.info(f"Deleted {deleted} files for user {user_id}")
     log.info(f"delete? {delete}")
 
     if delete:
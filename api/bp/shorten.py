@@ -7,11 +7,17 @@ import urllib.parse
 from quart import Blueprint, jsonify, redirect, current_app as app, request
 
 from ..common.utils import service_url
-from ..common.auth import gen_shortname, token_check, check_admin
+from ..common.auth import check_admin, gen_shortname, token_check
 from ..errors import NotFound, QuotaExploded, BadInput, FeatureDisabled
-from ..common import get_domain_info, transform_wildcard, FileNameType
+from ..common import (
+    get_upload_profile,
+    profile_domain,
+    transform_wildcard,
+    FileNameType,
+)
+from ..common.usage import get_usage
 from ..snowflake import get_snowflake
-from ..permissions import Permissions, domain_permissions
+from ..permissions import Permissions, check_permissions
 
 bp = Blueprint("shorten", __name__)
 
@@ -59,36 +65,20 @@ async def shorten_handler():
     # If it is set, and the admin value is truthy, do not do checks
     do_checks = not ("admin" in request.args and request.args["admin"])
 
-    # Let's actually check if the user is an admin
-    # and raise an error if they're not an admin
+    profile = await get_upload_profile(user_id)
+
+    # admin status is not cached, see get_upload_profile
     if not do_checks:
-        await check_admin(user_id, True)
+        await check_admin(user_id)
 
     # Skip checks for admins
     if do_checks:
         if not app.econfig.SHORTENS_ENABLED:
             raise FeatureDisabled("shortens are currently disabled")
 
-        shortens_used = await app.db.fetch(
-            """
-        SELECT shorten_id
-        FROM shortens
-        WHERE uploader = $1
-        AND shorten_id > time_snowflake(now() - interval '7 days')
-        """,
-            user_id,
-        )
-
-        shortens_used = len(shortens_used)
-
-        shorten_limit = await app.db.fetchval(
-            """
-        SELECT shlimit
-        FROM limits
-        WHERE user_id = $1
-        """,
-            user_id,
-        )
+        usage = await get_usage(user_id)
+        shortens_used = usage["shortens_used"]
+        shorten_limit = usage["shlimit"]
 
         if shortens_used and shortens_used > shorten_limit:
             raise QuotaExploded(
@@ -100,15 +90,17 @@ async def shorten_handler():
                 "This shorten blows the weekly limit of" f" {shorten_limit} shortens"
             )
 
-    redir_rname, tries = await gen_shortname(user_id, "shortens")
-    await app.metrics.submit("shortname_gen_tries", tries)
+    redir_rname, tries = await gen_shortname(
+        user_id, "shortens", paranoid=profile["paranoid"]
+    )
+    app.metrics.submit("shortname_gen_tries", tries)
 
     redir_id = get_snowflake()
-    domain_id, subdomain_name, domain = await get_domain_info(
-        user_id, FileNameType.SHORTEN
+    domain_id, subdomain_name, domain, perms = profile_domain(
+        profile, FileNameType.SHORTEN
     )
 
-    await domain_permissions(domain_id, Permissions.SHORTEN)
+    check_permissions(perms, Permissions.SHORTEN)
     domain = transform_wildcard(domain, subdomain_name)
 
     # make sure cache doesn't fuck up
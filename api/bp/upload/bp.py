@@ -2,23 +2,31 @@
 # Copyright 2018-2019, elixi.re Team and the elixire contributors
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import asyncio
 import logging
+import os
 import time
-from typing import Any, Dict, Optional
+import zlib
+from typing import Any, Dict, Optional, Tuple
 
 from quart import Blueprint, jsonify, request, current_app as app
 
-from api.common import get_domain_info, get_random_domain, transform_wildcard
+from api.common import (
+    get_upload_profile,
+    get_random_domain,
+    profile_domain,
+    transform_wildcard,
+)
 from api.common.auth import check_admin, gen_shortname
 from api.decorators import auth_route
-from api.permissions import Permissions, domain_permissions
+from api.permissions import Permissions, check_permissions, domain_permissions
 from api.snowflake import get_snowflake
 from api.common.common import delete_file
-from api.errors import BadImage
 from api.common.utils import service_url
 from .context import UploadContext
 from .file import UploadFile
-from ..metrics import is_consenting
+from .scan_queue import queue_scan, start_scan_workers
+from ..metrics import track_uploader
 
 bp = Blueprint("upload", __name__)
 log = logging.getLogger(__name__)
@@ -32,14 +40,7 @@ async def check_repeat(
     fspath: str, extension: str, ctx: UploadContext
 ) -> Optional[Dict[str, Any]]:
     # check which files have the same fspath (the same hash)
-    files = await app.db.fetch(
-        """
-    SELECT filename, uploader, domain
-    FROM files
-    WHERE fspath = $1 AND files.deleted = false
-    """,
-        fspath,
-    )
+    files = await app.db.fetch_stmt("file_repeats", fspath)
 
     # get the first file, if any, from the uploader
     try:
@@ -49,14 +50,7 @@ async def check_repeat(
         return
 
     # fetch domain info about that file
-    domain = await app.db.fetchval(
-        """
-    SELECT domain
-    FROM domains
-    WHERE domain_id = $1
-    """,
-        ufile["domain"],
-    )
+    domain = await app.db.fetchval_stmt("domain_name", ufile["domain"])
 
     # use 'i' as subdomain by default
     # since files.subdomain isn't a thing.
@@ -78,7 +72,35 @@ async def upload_metrics(ctx):
     metrics = app.metrics
     delta = round((end - ctx.start_timestamp) * 1000, 5)
 
-    await metrics.submit("upload_latency", delta)
+    metrics.submit("upload_latency", delta)
+
+
+def _checksum(path: str) -> Tuple[int, int]:
+    """Give the size and crc32 of a file."""
+    size, crc = 0, 0
+    with open(path, "rb") as fhandle:
+        for chunk in iter(lambda: fhandle.read(256 * 1024), b""):
+            size += len(chunk)
+            crc = zlib.crc32(chunk, crc)
+
+    return size, crc
+
+
+async def _stage(ctx: UploadContext) -> Tuple[str, int, int]:
+    """Write the contents of an upload to a temporary file, stripped
+    of exif. Returns its path, and the size and crc32 of what's
+    to be stored."""
+    temp_path = await ctx.file.save_temporary()
+
+    try:
+        await ctx.strip_exif(temp_path)
+        loop = asyncio.get_running_loop()
+        size, crc = await loop.run_in_executor(None, _checksum, temp_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+    return temp_path, size, crc
 
 
 def _fetch_domain():
@@ -106,10 +128,12 @@ async def upload_handler(user_id):
     random_domain = "random" in request.args and request.args["random"]
     given_domain, given_subdomain = _fetch_domain()
 
-    # if the user is admin and they wanted an admin
-    # upload, check if they're actually an admin
+    # everything we need to know about the user, in a single (cached) query
+    profile = await get_upload_profile(user_id)
+
+    # admin status is not cached, see get_upload_profile
     if not do_checks:
-        await check_admin(user_id, True)
+        await check_admin(user_id)
 
     file = await UploadFile.from_request()
 
@@ -122,8 +146,8 @@ async def upload_handler(user_id):
 
     # generate a filename so we can identify later when removing it
     # because of virus scanning.
-    shortname, tries = await gen_shortname(user_id)
-    await app.metrics.submit("shortname_gen_tries", tries)
+    shortname, tries = await gen_shortname(user_id, paranoid=profile["paranoid"])
+    app.metrics.submit("shortname_gen_tries", tries)
 
     # construct an upload context, which holds the file and other data about
     # the current upload
@@ -156,7 +180,7 @@ async def upload_handler(user_id):
     ctx.file.id = file_id
 
     # file already exists? let's just return the existing one
-    if file.path.exists():
+    if file.stored:
         res = await check_repeat(file.raw_path, extension, ctx)
         if res is not None:
             await upload_metrics(ctx)
@@ -176,7 +200,7 @@ async def upload_handler(user_id):
     # account settings.
 
     # get the user's domain settings
-    user_domain_id, user_subdomain, user_domain = await get_domain_info(user_id)
+    user_domain_id, user_subdomain, user_domain, user_perms = profile_domain(profile)
 
     if random_domain:
         # let's get a random domain and pretend that it was specified in the
@@ -191,7 +215,10 @@ async def upload_handler(user_id):
         subdomain_name = given_subdomain or user_subdomain
 
     # check if domain is uploadable
-    await domain_permissions(domain_id, Permissions.UPLOAD)
+    if domain_id == user_domain_id:
+        check_permissions(user_perms, Permissions.UPLOAD)
+    else:
+        await domain_permissions(domain_id, Permissions.UPLOAD)
 
     # if we don't have a domain yet, we need to resolve it:
     if given_domain is None:
@@ -199,14 +226,7 @@ async def upload_handler(user_id):
         domain = user_domain
     else:
         # a specific domain was specified, fetch that one from database
-        domain = await app.db.fetchval(
-            """
-        SELECT domain
-        FROM domains
-        WHERE domain_id = $1
-        """,
-            given_domain,
-        )
+        domain = await app.db.fetchval_stmt("domain_name", given_domain)
 
     # the domain might have *. at the beginning, let's replace that with the
     # provided subdomain's name
@@ -214,41 +234,101 @@ async def upload_handler(user_id):
 
     # upload counter
     app.counters.inc("file_upload_hour")
-    if await is_consenting(user_id):
+    consenting = profile["consented"]
+    if consenting:
         app.counters.inc("file_upload_hour_pub")
 
-    # calculate the new file size, with the dupe decrease factor multiplied in
-    # if necessary
-    file_size = ctx.file.calculate_size(app.econfig.DUPE_DECREASE_FACTOR)
-
-    # invalidating any existing file before
-    await app.storage.raw_invalidate(f"fspath:{domain_id}:{shortname}")
-
-    # insert into database
-    await app.db.execute(
-        """
-        INSERT INTO files (
-            file_id, mimetype, filename,
-            file_size, uploader, fspath, domain
-        )
-        VALUES ($1, $2, $3, $4, $5, $6, $7)
-        """,
-        file_id,
-        mime,
-        shortname,
-        file_size,
-        user_id,
-        file.raw_path,
-        domain_id,
-    )
+    await track_uploader(user_id, consenting)
+
+    # new contents are written to a temporary file first, so that exif
+    # can be stripped before they go to the storage backend
+    if file.stored:
+        temp_path, blob_size, blob_crc = None, file.size, None
+    else:
+        temp_path, blob_size, blob_crc = await _stage(ctx)
 
-    # write to fs
-    await ctx.file.storage.save(file.raw_path)
     try:
-        await ctx.strip_exif(file.raw_path)
-    except BadImage as exc:
-        await delete_file(shortname, user_id)
-        raise exc
+        # invalidating any existing file before
+        await app.storage.raw_invalidate(f"fspath:{domain_id}:{shortname}")
+
+        # insert into database. the blob goes first, so
+        # the file is counted as a reference to it
+        async with app.db.acquire() as conn:
+            async with conn.transaction():
+                # locking the blob also waits for any move of it
+                # (see api.blobstore.reshard)
+                blob = await conn.fetchrow(
+                    """
+                    INSERT INTO blobs (
+                        hash, extension, fspath, size, mimetype, crc
+                    )
+                    VALUES ($1, $2, $3, $4, $5, $6)
+                    ON CONFLICT (hash, extension) DO UPDATE
+                        SET hash = EXCLUDED.hash
+                    RETURNING fspath, (xmax = 0) AS inserted
+                    """,
+                    file.hash,
+                    extension,
+                    app.blobs.location(file.hash, extension),
+                    blob_size,
+                    mime,
+                    blob_crc,
+                )
+
+                file.fspath = blob["fspath"]
+
+                if blob["inserted"] and file.stored:
+                    # the blob was released since it was looked up,
+                    # and its contents went with it
+                    file.stored = False
+                    temp_path, blob_size, blob_crc = await _stage(ctx)
+                    await conn.execute(
+                        """
+                        UPDATE blobs
+                        SET size = $2, crc = $3
+                        WHERE fspath = $1
+                        """,
+                        file.fspath,
+                        blob_size,
+                        blob_crc,
+                    )
+
+                # calculate the new file size, with the dupe decrease
+                # factor multiplied in if necessary
+                file_size = file.calculate_size(app.econfig.DUPE_DECREASE_FACTOR)
+
+                await conn.execute(
+                    """
+                    INSERT INTO files (
+                        file_id, mimetype, filename,
+                        file_size, uploader, fspath, domain
+                    )
+                    VALUES ($1, $2, $3, $4, $5, $6, $7)
+                    """,
+                    file_id,
+                    mime,
+                    shortname,
+                    file_size,
+                    user_id,
+                    file.raw_path,
+                    domain_id,
+                )
+
+                if ctx.scan_pending:
+                    await queue_scan(conn, file_id)
+
+        if temp_path is not None:
+            try:
+                await app.blobs.put(file.raw_path, temp_path)
+            except Exception:
+                await delete_file(shortname, user_id)
+                raise
+    finally:
+        if temp_path is not None and os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+    if ctx.scan_pending:
+        start_scan_workers()
 
     # upload file latency metrics
     await upload_metrics(ctx)
@@ -14,6 +14,7 @@ from quart import current_app as app
 
 from api.bp.upload.exif import clear_exif
 from api.bp.upload.virus import scan_file
+from api.common.usage import get_usage
 from api.common.webhook import jpeg_toobig_webhook
 from api.errors import BadImage, FeatureDisabled, QuotaExploded
 from .file import UploadFile
@@ -29,6 +30,10 @@ class UploadContext:
     shortname: str
     do_checks: bool
     start_timestamp: int
+
+    #: if the scan took too long, and the file is to be scanned in the background
+    scan_pending: bool = False
+
     _computed_mime: Optional[str] = None
 
     async def strip_exif(self, filepath: str) -> None:
@@ -84,7 +89,9 @@ class UploadContext:
         # check file upload limits
         await self.check_limits()
 
-        # check the file for viruses
+        # check the file for viruses. it's hashed first,
+        # so contents that were already scanned aren't again
+        await self.file.hash_file()
         await scan_file(self)
 
         # default to last part of mimetype
@@ -114,24 +121,9 @@ class UploadContext:
         user_id = self.user_id
 
         # check user's limits
-        used = await app.db.fetchval(
-            """
-        SELECT SUM(file_size)
-        FROM files
-        WHERE uploader = $1
-        AND file_id > time_snowflake(now() - interval '7 days')
-        """,
-            user_id,
-        )
-
-        byte_limit = await app.db.fetchval(
-            """
-        SELECT blimit
-        FROM limits
-        WHERE user_id = $1
-        """,
-            user_id,
-        )
+        usage = await get_usage(user_id)
+        used = usage["bytes_used"]
+        byte_limit = usage["blimit"]
 
         # convert to megabytes so we display to the user
         cnv_limit = byte_limit / 1024 / 1024
@@ -3,7 +3,7 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 
 import os
-from pathlib import Path
+import tempfile
 from typing import Optional
 
 from quart import request, current_app as app
@@ -33,7 +33,10 @@ class UploadFile:
         self.mime: str = data.mimetype
 
         self.hash: Optional[str] = None
-        self.path: Optional[Path] = None
+        self.fspath: Optional[str] = None
+
+        #: if the contents are already stored, as a blob
+        self.stored: bool = False
 
         # initialize size with real stream position
         with self.save_file_stream_position:
@@ -51,10 +54,10 @@ class UploadFile:
     @property
     def raw_path(self) -> str:
         """
-        Returns the path to this file on the filesystem as a str.
+        Returns the location of this file in the storage backend.
         """
-        assert self.path
-        return str(self.path.resolve())
+        assert self.fspath
+        return self.fspath
 
     def calculate_size(self, multiplier) -> int:
         """
@@ -62,8 +65,7 @@ class UploadFile:
         necessary.
         """
         file_size = self.size
-        assert self.path
-        if self.path.exists():
+        if self.stored:
             file_size *= multiplier
         return file_size
 
@@ -78,16 +80,32 @@ class UploadFile:
 
         return cls(files[key])
 
-    async def _hash_file(self):
-        with self.save_file_stream_position:
-            self.hash = await calculate_hash(self.stream)
+    async def hash_file(self) -> str:
+        """Hash the contents of this file, once."""
+        if self.hash is None:
+            with self.save_file_stream_position:
+                self.hash = await calculate_hash(self.stream)
+
+        return self.hash
 
     async def resolve(self, extension: str) -> None:
-        await self._hash_file()
-        assert self.hash is not None
-        folder = app.econfig.IMAGE_FOLDER
-        raw_path = f"{folder}/{self.hash[0]}/{self.hash}{extension}"
-        self.path = Path(raw_path)
+        await self.hash_file()
+
+        # the same contents are only stored once
+        fspath = await app.db.fetchval_stmt("blob_fspath", self.hash, extension)
+        self.stored = fspath is not None
+        self.fspath = fspath or app.blobs.location(self.hash, extension)
+
+    async def save_temporary(self) -> str:
+        """Write the file to a temporary path in IMAGE_FOLDER,
+        before it goes to the storage backend."""
+        fd, path = tempfile.mkstemp(prefix=".upload-", dir=app.econfig.IMAGE_FOLDER)
+        os.close(fd)
+
+        with self.save_file_stream_position:
+            await self.storage.save(path)
+
+        return path
 
     @property
     def save_file_stream_position(self) -> SavedFilePositionContext:
@@ -0,0 +1,245 @@
+# elixire: Image Host software
+# Copyright 2018-2019, elixi.re Team and the elixire contributors
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+elixire - background scan queue
+
+Files whose scan takes longer than SCAN_WAIT_THRESHOLD while uploading
+are put in the scan_queue table, and scanned from storage by up to
+SCAN_WORKERS workers per process. Being in the database, queued scans
+survive restarts, and are shared by every process.
+
+Workers lease the files they claim instead of holding a transaction
+open while scanning, so files of a worker that died get claimed again
+once their lease is over. Scans that fail are retried with a backoff,
+up to SCAN_RETRIES times.
+"""
+import io
+import logging
+from typing import BinaryIO, Optional
+
+from quart import current_app as app
+
+from api.clamd import ClamdConnectionError, ClamdError
+from api.common import delete_file
+from api.common.webhook import scan_webhook
+from .virus import CLEAN, get_verdict, set_verdict, signature_version
+
+log = logging.getLogger(__name__)
+
+#: seconds between checks of the queue, for retries
+#  and files queued by other processes
+SCAN_QUEUE_PERIOD = 10
+
+#: seconds before the first retry of a scan, doubled on every retry
+RETRY_BACKOFF = 30
+
+
+def _workers() -> int:
+    return getattr(app.econfig, "SCAN_WORKERS", 2)
+
+
+async def queue_scan(conn, file_id: int):
+    """Queue a file to be scanned in the background,
+    in the transaction of conn."""
+    await conn.execute(
+        """
+    INSERT INTO scan_queue (file_id)
+    VALUES ($1)
+    ON CONFLICT DO NOTHING
+    """,
+        file_id,
+    )
+
+
+async def _claim_scan() -> Optional[dict]:
+    """Claim a queued file that is ready to be scanned."""
+    # long enough for any scan to be finished
+    lease = app.clamd.timeout * 2
+
+    return await app.db.fetchrow(
+        """
+    UPDATE scan_queue
+    SET attempts = attempts + 1,
+        next_attempt = (now() at time zone 'utc') + make_interval(secs => $1)
+    WHERE file_id = (
+        SELECT file_id
+        FROM scan_queue
+        WHERE next_attempt <= (now() at time zone 'utc')
+        ORDER BY next_attempt ASC
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING file_id, attempts
+    """,
+        float(lease),
+    )
+
+
+async def _finish_scan(file_id: int):
+    await app.db.execute(
+        """
+    DELETE FROM scan_queue
+    WHERE file_id = $1
+    """,
+        file_id,
+    )
+
+
+async def _retry_scan(file_id: int, attempts: int):
+    if attempts >= getattr(app.econfig, "SCAN_RETRIES", 5):
+        # same as scans while uploading, files are kept
+        # when they can't be scanned
+        log.error("giving up scanning file %d after %d attempts", file_id, attempts)
+        await _finish_scan(file_id)
+        return
+
+    await app.db.execute(
+        """
+    UPDATE scan_queue
+    SET next_attempt = (now() at time zone 'utc') + make_interval(secs => $2)
+    WHERE file_id = $1
+    """,
+        file_id,
+        float(RETRY_BACKOFF * 2 ** (attempts - 1)),
+    )
+
+
+def _open_local(blobs, fspath: str) -> Optional[BinaryIO]:
+    path = blobs.local_path(fspath)
+    return open(path, "rb") if path is not None else None
+
+
+async def _scan_contents(fspath: str) -> Optional[str]:
+    blobs = app.blobs
+    stream = await app.loop.run_in_executor(None, _open_local, blobs, fspath)
+    if stream is None:
+        stream = io.BytesIO(await blobs.get_range(fspath))
+
+    with stream:
+        return await app.clamd.scan_stream(stream)
+
+
+async def _scan_stored(fspath: str, file_hash: Optional[str]) -> Optional[str]:
+    """Scan stored contents, unless they were already
+    scanned with the same signatures."""
+    # blobs are keyed by the hash of the uploaded contents, like verdicts
+    # of scans while uploading. what's stored is derived from those alone
+    version = await signature_version() if file_hash else None
+    verdict = await get_verdict(version, file_hash)
+
+    if verdict is not None:
+        app.counters.inc("scan_cached")
+        return None if verdict == CLEAN else verdict
+
+    app.counters.inc("scan")
+    signature = await _scan_contents(fspath)
+    await set_verdict(version, file_hash, signature)
+    return signature
+
+
+async def _reject(shortname: str):
+    """Delete a file that didn't pass its scan."""
+    await delete_file(shortname, None, False)
+    log.info(f"Deleted file {shortname}")
+
+
+async def _process(file_id: int, attempts: int):
+    row = await app.db.fetchrow(
+        """
+    SELECT files.filename, files.fspath, files.uploader, files.domain,
+           files.file_size, files.deleted, blobs.hash
+    FROM files
+    LEFT JOIN blobs
+      ON blobs.fspath = files.fspath
+    WHERE files.file_id = $1
+    """,
+        file_id,
+    )
+
+    if row is None or row["deleted"]:
+        log.info("file %d was deleted before being scanned", file_id)
+        await _finish_scan(file_id)
+        return
+
+    shortname = row["filename"]
+
+    try:
+        signature = await _scan_stored(row["fspath"], row["hash"])
+    except ClamdConnectionError as exc:
+        log.warning("scan of %s failed, attempt %d: %s", shortname, attempts, exc)
+        await _retry_scan(file_id, attempts)
+        return
+    except ClamdError as exc:
+        log.warning("clamd FAILED on %s: %r", shortname, str(exc))
+        await _reject(shortname)
+    except Exception:
+        log.exception("Error scanning %s", shortname)
+        await _retry_scan(file_id, attempts)
+        return
+    else:
+        if signature is None:
+            log.info("Background scan of %s completed without problems", shortname)
+        else:
+            log.warning("user id %d got caught in virus scan", row["uploader"])
+            await scan_webhook(
+                row["uploader"],
+                shortname,
+                row["file_size"],
+                f"stream: {signature} FOUND",
+            )
+            await _reject(shortname)
+
+    await _finish_scan(file_id)
+
+    # the file may not be served while pending, see SERVE_UNSCANNED
+    await app.storage.raw_invalidate(f"fspath:{row['domain']}:{shortname}")
+
+
+async def scan_worker():
+    """Scan queued files until none is ready."""
+    while True:
+        row = await _claim_scan()
+        if row is None:
+            return
+
+        await _process(row["file_id"], row["attempts"])
+
+
+def start_scan_workers():
+    """Start scan workers, up to SCAN_WORKERS of them."""
+    for index in range(_workers()):
+        name = f"scan_worker_{index}"
+        if not app.sched.exists(name):
+            app.sched.spawn_once(scan_worker, name=name)
+
+
+async def scan_queue_tick():
+    start_scan_workers()
+
+    row = await app.db.fetchrow(
+        """
+    SELECT
+        COUNT(*) AS scan_queue_depth,
+        COUNT(*) FILTER (
+            WHERE next_attempt <= (now() at time zone 'utc')
+        ) AS scan_queue_ready,
+        COALESCE(EXTRACT(EPOCH FROM
+            (now() at time zone 'utc') - MIN(queued_at)
+        ), 0)::float AS scan_queue_oldest_seconds
+    FROM scan_queue
+    """
+    )
+
+    busy = sum(app.sched.exists(f"scan_worker_{i}") for i in range(_workers()))
+    app.metrics.submit_many({**dict(row), "scan_workers_busy": busy})
+
+
+async def spawn_scan_queue():
+    if not app.econfig.UPLOAD_SCAN:
+        return
+
+    app.sched.spawn_periodic(
+        scan_queue_tick, every=SCAN_QUEUE_PERIOD, name="scan_queue"
+    )
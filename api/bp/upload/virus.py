@@ -4,157 +4,131 @@
 
 import asyncio
 import logging
-import os
 import time
+from typing import Optional
 
 from quart import current_app as app
-from quart.ctx import copy_current_app_context
 
-from api.common import delete_file
+from api.clamd import ClamdConnectionError, ClamdError
 from api.common.webhook import scan_webhook
 from api.errors import BadImage
 
 log = logging.getLogger(__name__)
 
 
-async def _run_scan(ctx):
-    """Scan a file for viruses using clamdscan.
+#: what verdicts of clean contents are
+CLEAN = "OK"
 
-    Raises BadImage on any non-successful scan.
-    """
+#: how long scan verdicts are kept, in seconds. they are
+#  keyed by signature version, so updates make them go away anyway
+VERDICT_TTL = 7 * 24 * 60 * 60
 
-    scan_start_timestamp = time.monotonic()
 
-    log.debug("running clamdscan")
-    process = await asyncio.create_subprocess_shell(
-        "clamdscan -i -m --no-summary -",
-        stderr=asyncio.subprocess.PIPE,
-        stdout=asyncio.subprocess.PIPE,
-        stdin=asyncio.subprocess.PIPE,
-    )
+async def signature_version() -> Optional[str]:
+    """Give the version of the signatures clamd scans with,
+    or None if it can't be known."""
+    try:
+        return await app.clamd.version()
+    except ClamdError as exc:
+        log.warning("failed to get the signature version: %s", exc)
+        return None
 
-    # if returncode is set before we submit the file bytes, it's possible
-    # there is a deeper system problem, likely an unavailable clamdscan.
-    #
-    # we could still send the entirety of the file and still get an invalid
-    # returncode (out of the 0,1,2 range), so we must also verify such values
-    # afterwards
-    if process.returncode is not None:
-        log.error(
-            "return code %d before clamdscan, is it installed?", process.returncode
-        )
-
-        out, err = map(lambda s: s.decode(), await process.communicate())
-        log.error("output: %r", f"{out}{err}")
-        return
 
-    log.debug("writing file body to clamdscan")
-    with ctx.file.save_file_stream_position:
-        buffer_size = 16384
-        data = ctx.file.stream.read(buffer_size)
-        while data:
-            log.debug("write %d byte chunk", len(data))
-            process.stdin.write(data)
-            await process.stdin.drain()
-            data = ctx.file.stream.read(buffer_size)
+def _verdict_key(version: str, file_hash: str) -> str:
+    return f"scan:verdict:{version}:{file_hash}"
 
-        process.stdin.write_eof()
 
-    # stdout and stderr here are for the webhook, not for parsing
-    out, err = map(lambda s: s.decode(), await process.communicate())
-    total_out = f"{out}{err}"
-    log.debug("output: %r", total_out)
+async def get_verdict(version: Optional[str], file_hash: str) -> Optional[str]:
+    """Give the verdict of an earlier scan of the same contents, with the
+    same signatures: CLEAN, the name of the signature found, or None if
+    they weren't scanned."""
+    if version is None:
+        return None
 
-    scan_end_timestamp = time.monotonic()
+    return await app.redis.get(_verdict_key(version, file_hash))
 
-    assert process.returncode is not None
 
-    # from clamdscan manual:
-    # RETURN CODES
-    #    0 : No virus found.
-    #    1 : Virus(es) found.
-    #    2 : An error occurred.
+async def set_verdict(version: Optional[str], file_hash: str, signature):
+    """Keep the result of a scan, as a verdict for the same contents."""
+    if version is None:
+        return
+
+    await app.redis.set(
+        _verdict_key(version, file_hash), signature or CLEAN, ex=VERDICT_TTL
+    )
+
+
+async def _scan_upload(ctx) -> Optional[str]:
+    """Scan an uploaded file with clamd, giving the signature found."""
+    scan_start_timestamp = time.monotonic()
+
+    with ctx.file.save_file_stream_position:
+        signature = await app.clamd.scan_stream(ctx.file.stream)
+
+    scan_end_timestamp = time.monotonic()
 
     log.info(
-        "Scanning %.2f MB took %.2fms (return value = %d)",
+        "Scanning %.2f MB took %.2fms (signature = %r)",
         ctx.file.size / 1024 / 1024,
-        (scan_end_timestamp - scan_start_timestamp),
-        process.returncode,
+        (scan_end_timestamp - scan_start_timestamp) * 1000,
+        signature,
     )
 
-    if process.returncode == 0:
-        log.debug("clamdscan said ok")
-        return
-    elif process.returncode == 1:
-        log.warning("user id %d got caught in virus scan", ctx.user_id)
-        await scan_webhook(ctx, total_out)
-        raise BadImage("Image contains a virus.")
-    elif process.returncode == 2:
-        log.warning("clamdscan FAILED: %r", total_out)
-        raise BadImage(f"clamdscan failed: {total_out}")
-    else:
-        log.error(
-            "clamdscan ERRORED with exit code %d (preserving file), output is %r",
-            process.returncode,
-            total_out,
-        )
+    return signature
 
-        # we let the upload pass on clamdscan errors
-        return
 
+async def _run_scan(ctx):
+    """Scan a file for viruses with clamd, unless the same
+    contents were already scanned with the same signatures.
 
-async def scan_background(ctx):
-    """Run an existing scanning task in the background."""
-    try:
-        await scan_file(ctx)
-    except BadImage:
-        # let's nuke this image
-
-        fspath = await app.db.fetchval(
-            """
-        SELECT fspath
-        FROM files
-        WHERE filename = $1
-        """,
-            ctx.shortname,
-        )
-
-        if not fspath:
-            log.warning(f"File {ctx.shortname} was deleted when scan finished")
+    Raises BadImage on any non-successful scan.
+    """
+    version = await signature_version()
+    verdict = await get_verdict(version, ctx.file.hash)
 
-        try:
-            os.remove(fspath)
-        except OSError:
-            log.warning(f"File path {fspath!r} was already deleted when scan finished")
-
-        await delete_file(ctx.shortname, None, False)
-        log.info(f"Deleted file {ctx.shortname}")
-    except Exception:
-        log.exception("Error during background scan")
+    if verdict is not None:
+        log.debug("contents were scanned before, verdict %r", verdict)
+        app.counters.inc("scan_cached")
+        signature = None if verdict == CLEAN else verdict
     else:
-        log.info("Background scan completed without problems")
+        app.counters.inc("scan")
+
+        try:
+            signature = await _scan_upload(ctx)
+        except ClamdConnectionError as exc:
+            # we let the upload pass when clamd is unavailable
+            log.error("clamd ERRORED (preserving file): %s", exc)
+            return
+        except ClamdError as exc:
+            log.warning("clamd FAILED: %r", str(exc))
+            raise BadImage(f"clamd failed: {exc}")
+
+        await set_verdict(version, ctx.file.hash, signature)
+
+    if signature is None:
+        log.debug("clamd said ok")
+        return
+
+    log.warning("user id %d got caught in virus scan", ctx.user_id)
+    await scan_webhook(
+        ctx.user_id, ctx.file.name, ctx.file.size, f"stream: {signature} FOUND"
+    )
+    raise BadImage("Image contains a virus.")
 
 
 async def scan_file(ctx) -> None:
     """Run a scan on a file.
 
-    This function schedules the scanning on the background if it takes too
-    long to scan.
+    If it takes too long, the file is marked as pending a scan instead,
+    and queued when it's inserted (see api.bp.upload.scan_queue).
     """
     if not app.econfig.UPLOAD_SCAN:
         log.debug("Scans are disabled, not scanning this file.")
         return
 
-    @copy_current_app_context
-    async def wrapper_task(scan_function, ctx):
-        await scan_function(ctx)
-
     try:
-        await asyncio.wait_for(
-            wrapper_task(_run_scan, ctx), timeout=app.econfig.SCAN_WAIT_THRESHOLD
-        )
+        await asyncio.wait_for(_run_scan(ctx), timeout=app.econfig.SCAN_WAIT_THRESHOLD)
         log.info("scan file done")
     except asyncio.TimeoutError:
-        # the scan took too long, reschedule it on the background
-        log.info(f"Scheduled background scan on {ctx.file.name} ({ctx.shortname})")
-        app.loop.create_task(wrapper_task(scan_background, ctx))
+        log.info(f"Queueing background scan of {ctx.file.name} ({ctx.shortname})")
+        ctx.scan_pending = True
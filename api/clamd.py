@@ -0,0 +1,214 @@
+# elixire: Image Host software
+# Copyright 2018-2019, elixi.re Team and the elixire contributors
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+elixire - clamd client
+
+Talks to clamd over its socket, instead of spawning clamdscan for every
+scan. Connections are kept open in IDSESSION mode and reused, and files
+are sent with INSTREAM, in chunks, waiting for clamd to read each one.
+
+See clamd(8) for the protocol.
+"""
+import asyncio
+import io
+import logging
+import struct
+import time
+from typing import List, Optional, Tuple, Union
+
+log = logging.getLogger(__name__)
+
+#: where clamd listens by default on most distributions
+DEFAULT_ADDRESS = "/var/run/clamav/clamd.ctl"
+
+#: size of the chunks files are sent in
+CHUNK_SIZE = 64 * 1024
+
+#: how long the signature version is kept for before asking again, in seconds
+VERSION_TTL = 300
+
+Address = Union[str, Tuple[str, int]]
+
+
+class ClamdError(Exception):
+    """Raised when clamd fails to scan something."""
+
+
+class ClamdConnectionError(ClamdError):
+    """Raised when clamd can't be reached, or stops answering."""
+
+
+async def _read(stream, size: int) -> bytes:
+    """Read from a file-like object. Reads of anything but in-memory
+    files go through the executor, so they don't block the loop."""
+    if isinstance(stream, io.BytesIO):
+        return stream.read(size)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, stream.read, size)
+
+
+class _Session:
+    """A connection to clamd, in IDSESSION mode."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+        #: clamd numbers the commands of a session, from 1
+        self.commands = 0
+
+    async def send(self, data: bytes):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def instream(self, stream) -> str:
+        """Send the rest of a file-like object, giving clamd's reply."""
+        await self.send(b"zINSTREAM\0")
+        self.commands += 1
+
+        try:
+            while True:
+                chunk = await _read(stream, CHUNK_SIZE)
+                if not chunk:
+                    break
+
+                await self.send(struct.pack(">L", len(chunk)) + chunk)
+
+            await self.send(struct.pack(">L", 0))
+        except ConnectionError:
+            # clamd stops reading once a stream goes over its limits,
+            # and answers with an error
+            pass
+
+        reply = (await self.reader.readuntil(b"\0"))[:-1].decode()
+
+        command_id, _, reply = reply.partition(": ")
+        if command_id != str(self.commands):
+            raise ClamdConnectionError(f"Unexpected reply from clamd: {reply!r}")
+
+        return reply
+
+    def close(self):
+        if not self.writer.is_closing():
+            self.writer.write(b"zEND\0")
+        self.writer.close()
+
+
+class ClamdClient:
+    """Scans files with clamd, keeping up to pool_size
+    connections to it, which are also the most scans at once."""
+
+    def __init__(
+        self, address: Address = DEFAULT_ADDRESS, *, pool_size: int = 4, timeout=60
+    ):
+        self.address = address
+
+        #: how long a scan can take, in seconds
+        self.timeout = timeout
+
+        self.semaphore = asyncio.Semaphore(pool_size)
+        self.idle: List[_Session] = []
+
+        #: the signature version, and when to ask for it again
+        self._version: Optional[Tuple[str, float]] = None
+        self._version_lock = asyncio.Lock()
+
+    async def _open(self):
+        if isinstance(self.address, str):
+            return await asyncio.open_unix_connection(self.address)
+
+        return await asyncio.open_connection(*self.address)
+
+    async def _connect(self) -> _Session:
+        session = _Session(*await self._open())
+        await session.send(b"zIDSESSION\0")
+        return session
+
+    async def _scan(self, stream) -> str:
+        start = stream.tell()
+
+        # pooled sessions may have been closed by clamd since they
+        # were last used, those are retried on a new one
+        while True:
+            reused = bool(self.idle)
+            session = self.idle.pop() if reused else await self._connect()
+
+            try:
+                reply = await session.instream(stream)
+            except (ConnectionError, asyncio.IncompleteReadError) as exc:
+                session.close()
+                if not reused:
+                    raise ClamdConnectionError(f"clamd closed the connection: {exc}")
+
+                stream.seek(start)
+                continue
+            except BaseException:
+                session.close()
+                raise
+
+            self.idle.append(session)
+            return reply
+
+    async def scan_stream(self, stream) -> Optional[str]:
+        """Scan the rest of a seekable file-like object.
+
+        Returns the name of the signature found, or None if it's clean.
+        """
+        async with self.semaphore:
+            try:
+                reply = await asyncio.wait_for(self._scan(stream), self.timeout)
+            except asyncio.TimeoutError:
+                raise ClamdConnectionError(f"clamd took over {self.timeout}s to scan")
+            except OSError as exc:
+                raise ClamdConnectionError(f"Failed to connect to clamd: {exc}")
+
+        if reply == "stream: OK":
+            return None
+
+        if reply.endswith(" FOUND"):
+            return reply[len("stream: ") : -len(" FOUND")]
+
+        raise ClamdError(reply)
+
+    async def _fetch_version(self) -> str:
+        reader, writer = await self._open()
+        try:
+            writer.write(b"zVERSION\0")
+            await writer.drain()
+            reply = (await reader.readuntil(b"\0"))[:-1].decode()
+        finally:
+            writer.close()
+
+        # e.g "ClamAV 0.103.8/26830/Mon Mar  6 08:22:42 2023"
+        fields = reply.split("/")
+        if len(fields) < 2:
+            raise ClamdError(f"Unexpected version from clamd: {reply!r}")
+
+        return fields[1]
+
+    async def version(self) -> str:
+        """Give the version of the signatures clamd scans with.
+        It changes whenever they're updated."""
+        async with self._version_lock:
+            if self._version is not None and time.monotonic() < self._version[1]:
+                return self._version[0]
+
+            try:
+                version = await asyncio.wait_for(self._fetch_version(), self.timeout)
+            except asyncio.TimeoutError:
+                raise ClamdConnectionError("clamd took too long to give its version")
+            except (OSError, asyncio.IncompleteReadError) as exc:
+                raise ClamdConnectionError(f"Failed to get clamd's version: {exc}")
+
+            self._version = version, time.monotonic() + VERSION_TTL
+            return version
+
+    async def close(self):
+        """Close the pooled connections."""
+        sessions, self.idle = self.idle, []
+        for session in sessions:
+            session.close()
+            await session.writer.wait_closed()
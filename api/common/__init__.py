@@ -9,8 +9,13 @@ from .common import (
     gen_filename,
     calculate_hash,
     delete_file,
+    delete_user_files,
+    release_blobs,
     delete_shorten,
     get_domain_info,
+    get_upload_profile,
+    invalidate_upload_profiles,
+    profile_domain,
     get_random_domain,
     transform_wildcard,
     thumbnail_janitor_tick,
@@ -24,8 +29,13 @@ __all__ = [
     "gen_filename",
     "calculate_hash",
     "delete_file",
+    "delete_user_files",
+    "release_blobs",
     "delete_shorten",
     "get_domain_info",
+    "get_upload_profile",
+    "invalidate_upload_profiles",
+    "profile_domain",
     "get_random_domain",
     "transform_wildcard",
     "spawn_thumbnail_janitor",
@@ -20,12 +20,17 @@ from ..schema import validate, LOGIN_SCHEMA
 log = logging.getLogger(__name__)
 
 
-async def gen_shortname(user_id: int, table: str = "files") -> tuple:
+async def gen_shortname(
+    user_id: int, table: str = "files", *, paranoid: bool = None
+) -> tuple:
     """Generate a shortname for a file.
 
-    Checks if the user is in paranoid mode.
+    Checks if the user is in paranoid mode, unless
+    that is already given.
     """
-    is_paranoid = await check_paranoid(user_id)
+    is_paranoid = paranoid
+    if is_paranoid is None:
+        is_paranoid = await check_paranoid(user_id)
     shortname_len = 8 if is_paranoid else app.econfig.SHORTNAME_LEN
     return await gen_filename(shortname_len, table)
 
@@ -95,14 +100,7 @@ async def check_admin(user_id: int, error_on_nonadmin: bool = True) -> bool:
     FailedAuth
         When user is not an admin and error_on_nonadmin is set to True.
     """
-    is_admin = await app.db.fetchval(
-        """
-        select admin
-        from users
-        where user_id = $1
-    """,
-        user_id,
-    )
+    is_admin = await app.db.fetchval_stmt("user_admin", user_id)
 
     if error_on_nonadmin and not is_admin:
         raise FailedAuth("User is not an admin.")
@@ -115,14 +113,7 @@ async def check_paranoid(user_id: int) -> bool:
 
     Returns None if user does not exist.
     """
-    is_paranoid = await app.db.fetchval(
-        """
-        select paranoid
-        from users
-        where user_id = $1
-    """,
-        user_id,
-    )
+    is_paranoid = await app.db.fetchval_stmt("user_paranoid", user_id)
 
     return is_paranoid
 
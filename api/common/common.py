@@ -2,19 +2,28 @@
 # Copyright 2018-2019, elixi.re Team and the elixire contributors
 # SPDX-License-Identifier: AGPL-3.0-only
 
-import string
-import secrets
 import hashlib
 import logging
 import time
+import json
 from pathlib import Path
+from typing import List
 
 from quart import current_app as app, request
 import asyncpg
 
 from ..errors import NotFound
+from ..storage import prefix
+
+#: how long upload profiles are cached for, in seconds
+UPLOAD_PROFILE_TTL = 600
+
+#: bumped to invalidate every cached upload profile at once
+UPLOAD_PROFILE_GENERATION = "upload_profile:generation"
+
+#: how many files are deleted at once when deleting all of a user's files
+DELETE_BATCH = 500
 
-ALPHABET = string.ascii_lowercase + string.digits
 CF_HEADER = "CF-Connecting-IP"
 log = logging.getLogger(__name__)
 
@@ -50,23 +59,18 @@ def get_ip_addr() -> str:
         return remote_addr
 
 
-def _gen_fname(length) -> str:
-    """Generate a random filename."""
-    return "".join(secrets.choice(ALPHABET) for _ in range(length))
-
-
-async def gen_filename(length=3, table="files", _curc=0) -> str:
+async def gen_filename(length=3, table="files") -> tuple:
     """Generate a unique random filename.
 
-    To guarantee that the generated shortnames will
-    be unique, we query our DB if the generated
-    shortname already exists, and retry if it does.
+    Names come from the app's ShortnameAllocator, which reserves
+    batches of names that are free in the database, and grows their
+    length as the namespace fills up.
 
     Parameters
     ----------
     length, optional: int
         Minimal amount of characters to use, default 3.
-        Grows with the amount of failed generations.
+        Grows as shorter names get taken.
 
     table, optional: str
         The table to generate a unique shortname for,
@@ -76,39 +80,14 @@ async def gen_filename(length=3, table="files", _curc=0) -> str:
     -------
     tuple
         Containing the generated shortname
-        and how many tries happened to generate it.
+        and how many batches of names had to be reserved for it.
 
     Raises
     ------
     RuntimeError
         If it tried to generate a shortname with more than 10 letters.
     """
-    if length > 10:
-        raise RuntimeError("Failed to generate a filename")
-
-    try_count = 0
-
-    field = "file_id" if table == "files" else "shorten_id"
-
-    for try_count in range(10):
-        random_fname = _gen_fname(length)
-
-        filerow = await app.db.fetchrow(
-            f"""
-        SELECT {field}
-        FROM {table}
-        WHERE filename = $1
-        """,
-            random_fname,
-        )
-
-        if not filerow:
-            total = _curc + try_count
-            log.info(f"Took {total} retries to " f"generate {random_fname!r}")
-            return random_fname, total
-
-    # if 10 tries didnt work, try generating with length+1
-    return await gen_filename(length + 1, table, _curc + try_count + 1)
+    return await app.shortnames.allocate(length, table)
 
 
 def _calculate_hash(fhandler) -> str:
@@ -154,46 +133,105 @@ async def calculate_hash(fhandle) -> str:
     return await fut
 
 
-async def remove_fspath(shortname: str):
-    if shortname is None:
-        return
-
-    fspath = await app.db.fetchval(
+async def ensure_dummy_user():
+    """Create the dummy user, which owns files that were
+    fully deleted, if it doesn't exist yet."""
+    try:
+        await app.db.execute(
+            """
+        INSERT INTO users (user_id, username, active, password_hash, email)
+        VALUES (0, 'dummy', false, 'blah', 'd u m m y')
         """
-    SELECT fspath
-    FROM files
-    WHERE filename = $1
-    """,
-        shortname,
-    )
+        )
+    except asyncpg.UniqueViolationError:
+        pass
 
-    if fspath is None:
+
+async def release_blobs(fspaths: List[str]):
+    """Delete the blobs at the given fspaths that no file refers to
+    anymore, along with their contents."""
+    if not fspaths:
         return
 
-    # fetch all files with the same fspath
-    # and on the hash system, means the same hash
-    same_fspath = await app.db.fetchval(
+    async with app.db.acquire() as conn:
+        async with conn.transaction():
+            # refcounts are kept by a trigger on files, see schema.sql
+            rows = await conn.fetch(
+                """
+            DELETE FROM blobs
+            WHERE fspath = ANY($1::text[])
+              AND refcount = 0
+            RETURNING fspath
+            """,
+                fspaths,
+            )
+
+            if not rows:
+                return
+
+            # contents go while the rows are locked. uploads of the same
+            # contents wait for them to be gone before storing them again
+            try:
+                await app.blobs.delete_many([row["fspath"] for row in rows])
+            except Exception:
+                # better leftover contents than blobs without them
+                log.exception("failed to delete the contents of released blobs")
+
+
+async def _delete_files_batch(user_id: int) -> int:
+    """Delete a batch of a user's files. Returns how many were deleted."""
+    # the old domain and fspath are needed after the update
+    rows = await app.db.fetch(
         """
-    SELECT COUNT(*)
-    FROM files
-    WHERE fspath = $1 AND deleted = false
+    WITH batch AS (
+        SELECT file_id, domain, fspath
+        FROM files
+        WHERE uploader = $1
+        ORDER BY file_id
+        LIMIT $2
+        FOR UPDATE
+    )
+    UPDATE files
+    SET uploader = 0,
+        file_size = 0,
+        fspath = '',
+        deleted = true,
+        domain = 0
+    FROM batch
+    WHERE files.file_id = batch.file_id
+    RETURNING files.filename, batch.domain, batch.fspath
     """,
-        fspath,
+        user_id,
+        DELETE_BATCH,
     )
 
-    if same_fspath == 0:
-        path = Path(fspath)
-        try:
-            path.unlink()
-            log.info(f"Deleted {fspath!s} since no files refer to it")
-        except FileNotFoundError:
-            log.warning(f"fspath {fspath!s} does not exist")
-    else:
-        log.info(
-            f"there are still {same_fspath} files with the "
-            f"same fspath {fspath!s}, not deleting"
+    # files with the same hash share their blob,
+    # which can only go once no file refers to it
+    await release_blobs(list({row["fspath"] for row in rows if row["fspath"]}))
+
+    if rows:
+        await app.storage.raw_invalidate(
+            *(f"fspath:{row['domain']}:{row['filename']}" for row in rows)
         )
 
+    return len(rows)
+
+
+async def delete_user_files(user_id: int) -> int:
+    """Delete all the files of a user, in batches.
+
+    Returns how many files were deleted.
+    """
+    await ensure_dummy_user()
+
+    total = 0
+    while True:
+        deleted = await _delete_files_batch(user_id)
+        total += deleted
+
+        if deleted < DELETE_BATCH:
+            return total
+
 
 async def delete_file(file_name: str, user_id, set_delete=True):
     """Delete a file, purging it from Cloudflare's cache.
@@ -217,36 +255,33 @@ async def delete_file(file_name: str, user_id, set_delete=True):
         If no file is found.
     """
     domain_id = await app.storage.get_domain_file(file_name)
-
-    try:
-        await app.db.execute(
-            """
-        INSERT INTO users (user_id, username, active, password_hash, email)
-        VALUES (0, 'dummy', false, 'blah', 'd u m m y')
-        """
-        )
-    except asyncpg.UniqueViolationError:
-        pass
+    await ensure_dummy_user()
 
     if set_delete:
-        exec_out = await app.db.execute(
+        fspath = await app.db.fetchval(
             """
         UPDATE files
         SET deleted = true
         WHERE uploader = $1
           AND filename = $2
           AND deleted = false
+        RETURNING fspath
         """,
             user_id,
             file_name,
         )
 
-        if exec_out == "UPDATE 0":
+        if fspath is None:
             raise NotFound("You have no files with this name.")
-
-        await remove_fspath(file_name)
     else:
-        await remove_fspath(file_name)
+        fspath = await app.db.fetchval(
+            """
+        SELECT fspath
+        FROM files
+        WHERE filename = $1
+        """,
+            file_name,
+        )
 
         if user_id:
             await app.db.execute(
@@ -278,6 +313,9 @@ async def delete_file(file_name: str, user_id, set_delete=True):
                 file_name,
             )
 
+    if fspath:
+        await release_blobs([fspath])
+
     await app.storage.raw_invalidate(f"fspath:{domain_id}:{file_name}")
 
 
@@ -304,13 +342,82 @@ async def delete_shorten(shortname: str, user_id: int):
     await app.storage.raw_invalidate(f"redir:{domain_id}:{shortname}")
 
 
+async def get_upload_profile(user_id: int) -> dict:
+    """Get what uploads and shortens need to know about a user.
+
+    That is their paranoid and consent flags, and their file and shorten
+    domains (id, subdomain, domain string and permission bits), loaded
+    with a single query and cached in Redis.
+
+    Whether they're an admin is not part of it, as that must not
+    outlive a demotion. Use check_admin for that.
+
+    The cache is invalidated by profile changes, and by changes
+    to domains (see invalidate_upload_profiles).
+    """
+    key = f"{prefix(user_id)}:upload_profile"
+    cached, generation = await app.redis.mget(key, UPLOAD_PROFILE_GENERATION)
+    generation = int(generation or 0)
+
+    if cached is not None:
+        profile = json.loads(cached)
+        if profile.pop("generation", None) == generation:
+            return profile
+
+    row = await app.db.fetchrow_stmt("upload_profile", user_id)
+    if row is None:
+        raise NotFound("User not found")
+
+    profile = dict(row)
+    await app.redis.set(
+        key,
+        json.dumps({**profile, "generation": generation}),
+        ex=UPLOAD_PROFILE_TTL,
+    )
+    return profile
+
+
+async def invalidate_upload_profiles():
+    """Invalidate the upload profiles of every user.
+
+    Used when a domain changes, as any user might be using it. Profiles
+    are cached along with the generation they were loaded in, so this
+    only bumps the generation, and the stale ones expire by themselves.
+    """
+    await app.redis.incr(UPLOAD_PROFILE_GENERATION)
+
+
+def profile_domain(profile: dict, dtype=FileNameType.FILE) -> tuple:
+    """Get the domain a user uploads (or shortens) to, out of
+    their upload profile.
+
+    Returns
+    -------
+    tuple
+        with 4 values: domain id, subdomain, the domain string
+        and the domain's permission bits
+    """
+    if dtype == FileNameType.SHORTEN and profile["shorten_domain"] is not None:
+        return (
+            profile["shorten_domain"],
+            profile["shorten_subdomain"],
+            profile["shorten_domain_name"],
+            profile["shorten_domain_permissions"],
+        )
+
+    return (
+        profile["domain"],
+        profile["subdomain"],
+        profile["domain_name"],
+        profile["domain_permissions"],
+    )
+
+
 async def get_domain_info(user_id: int, dtype=FileNameType.FILE) -> tuple:
     """Get information about a user's selected domain.
 
     Parameters
     ----------
-    request: sanic.Request
-        Request object for database access.
     user_id: int
         User's snowflake ID.
     dtype, optional: FileNameType
@@ -322,48 +429,8 @@ async def get_domain_info(user_id: int, dtype=FileNameType.FILE) -> tuple:
     tuple
         with 3 values: domain id, subdomain and the domain string
     """
-    domain_id, subdomain_name = await app.db.fetchrow(
-        """
-    SELECT domain, subdomain
-    FROM users
-    WHERE user_id = $1
-    """,
-        user_id,
-    )
-
-    domain = await app.db.fetchval(
-        """
-    SELECT domain
-    FROM domains
-    WHERE domain_id = $1
-    """,
-        domain_id,
-    )
-
-    if dtype == FileNameType.SHORTEN:
-        shorten_domain_id, shorten_subdomain = await app.db.fetchrow(
-            """
-        SELECT shorten_domain, shorten_subdomain
-        FROM users
-        WHERE user_id = $1
-        """,
-            user_id,
-        )
-
-        if shorten_domain_id is not None:
-            shorten_domain = await app.db.fetchval(
-                """
-            SELECT domain
-            FROM domains
-            WHERE domain_id = $1
-            """,
-                shorten_domain_id,
-            )
-
-            # if we have all the data on shorten subdomain, return it
-            return shorten_domain_id, shorten_subdomain, shorten_domain
-
-    return domain_id, subdomain_name, domain
+    profile = await get_upload_profile(user_id)
+    return profile_domain(profile, dtype)[:3]
 
 
 async def get_random_domain() -> int:
@@ -5,128 +5,119 @@
 from quart import current_app as app
 
 
-async def _domain_file_stats(domain_id, *, ignore_consented: bool = False) -> tuple:
-    """Get domain file stats (count and sum of all bytes)."""
+def _public_stats(row) -> dict:
+    return {
+        "users": row["public_users"],
+        "files": row["public_files"],
+        "size": row["public_bytes"],
+        "shortens": row["public_shortens"],
+    }
 
-    consented_clause = "" if ignore_consented else "AND users.consented = true"
 
-    row = await app.db.fetchrow(
-        f"""
-    SELECT COUNT(*), SUM(file_size)
-    FROM files
-    JOIN users
-      ON users.user_id = files.uploader
-    WHERE files.domain = $1
-      AND files.deleted = false
-      {consented_clause}
-    """,
-        domain_id,
-    )
-
-    return row["count"], int(row["sum"] or 0)
+# domain statistics come from the domain_stats table, which is maintained
+# by triggers (see schema.sql), instead of counting over files and shortens.
+_STATS_COLUMNS = """
+    COALESCE(SUM(domain_stats.users), 0)::bigint AS users,
+    COALESCE(SUM(domain_stats.files), 0)::bigint AS files,
+    COALESCE(SUM(domain_stats.bytes), 0)::bigint AS bytes,
+    COALESCE(SUM(domain_stats.shortens), 0)::bigint AS shortens,
+    COALESCE(SUM(domain_stats.users)
+        FILTER (WHERE domain_stats.consented), 0)::bigint AS public_users,
+    COALESCE(SUM(domain_stats.files)
+        FILTER (WHERE domain_stats.consented), 0)::bigint AS public_files,
+    COALESCE(SUM(domain_stats.bytes)
+        FILTER (WHERE domain_stats.consented), 0)::bigint AS public_bytes,
+    COALESCE(SUM(domain_stats.shortens)
+        FILTER (WHERE domain_stats.consented), 0)::bigint AS public_shortens
+"""
 
 
 async def get_domain_info(domain_id) -> dict:
     """Get domain information."""
-    raw_info = await app.db.fetchrow(
-        """
-    SELECT domain, official, admin_only, permissions
+    row = await app.db.fetchrow(
+        f"""
+    SELECT domains.domain, domains.official, domains.admin_only,
+           domains.permissions,
+           domain_owners.user_id AS owner_id,
+           users.username, users.active, users.consented,
+           users.admin, users.paranoid,
+           {_STATS_COLUMNS}
     FROM domains
-    WHERE domain_id = $1
-    """,
-        domain_id,
-    )
-
-    dinfo = dict(raw_info)
-    dinfo["cf_enabled"] = False
-
-    stats = {}
-
-    stats["users"] = await app.db.fetchval(
-        """
-    SELECT COUNT(*)
-    FROM users
-    WHERE domain = $1
+    LEFT JOIN domain_owners
+      ON domain_owners.domain_id = domains.domain_id
+    LEFT JOIN users
+      ON users.user_id = domain_owners.user_id
+    LEFT JOIN domain_stats
+      ON domain_stats.domain_id = domains.domain_id
+    WHERE domains.domain_id = $1
+    GROUP BY domains.domain_id, domain_owners.user_id, users.user_id
     """,
         domain_id,
     )
 
-    stats["files"] = await app.db.fetchval(
-        """
-    SELECT COUNT(*)
-    FROM files
-    WHERE domain = $1
-    """,
-        domain_id,
-    )
-
-    filestats = await _domain_file_stats(domain_id, ignore_consented=True)
-    stats["files"], stats["size"] = filestats
-
-    stats["shortens"] = await app.db.fetchval(
-        """
-    SELECT COUNT(*)
-    FROM shortens
-    WHERE domain = $1
-    """,
-        domain_id,
-    )
-
-    owner_id = await app.db.fetchval(
-        """
-    SELECT user_id
-    FROM domain_owners
-    WHERE domain_id = $1
-    """,
-        domain_id,
-    )
-
-    owner_data = await app.db.fetchrow(
-        """
-    SELECT username, active, consented, admin, paranoid
-    FROM users
-    WHERE user_id = $1
-    """,
-        owner_id,
-    )
+    dinfo = {
+        "domain": row["domain"],
+        "official": row["official"],
+        "admin_only": row["admin_only"],
+        "permissions": row["permissions"],
+        "cf_enabled": False,
+    }
 
-    if owner_data:
-        downer = {**dict(owner_data), **{"user_id": str(owner_id)}}
+    if row["username"] is not None:
+        downer = {
+            "username": row["username"],
+            "active": row["active"],
+            "consented": row["consented"],
+            "admin": row["admin"],
+            "paranoid": row["paranoid"],
+            "user_id": str(row["owner_id"]),
+        }
     else:
         downer = None
 
+    stats = {
+        "users": row["users"],
+        "files": row["files"],
+        "size": row["bytes"],
+        "shortens": row["shortens"],
+    }
+
     return {
         "info": {**dinfo, **{"owner": downer}},
         "stats": stats,
-        "public_stats": await get_domain_public(domain_id),
+        "public_stats": _public_stats(row),
     }
 
 
-async def get_domain_public(domain_id) -> dict:
-    """Get public information about a domain."""
-    public_stats = {}
-
-    public_stats["users"] = await app.db.fetchval(
-        """
-    SELECT COUNT(*)
-    FROM users
-    WHERE domain = $1 AND consented = true
+async def get_owned_domains(user_id: int) -> dict:
+    """Get information and public stats of all domains owned by a user."""
+    rows = await app.db.fetch(
+        f"""
+    SELECT domains.domain_id, domains.domain, domains.official,
+           domains.admin_only, domains.permissions,
+           {_STATS_COLUMNS}
+    FROM domain_owners
+    JOIN domains
+      ON domains.domain_id = domain_owners.domain_id
+    LEFT JOIN domain_stats
+      ON domain_stats.domain_id = domains.domain_id
+    WHERE domain_owners.user_id = $1
+    GROUP BY domains.domain_id
     """,
-        domain_id,
+        user_id,
     )
 
-    filestats = await _domain_file_stats(domain_id)
-    public_stats["files"], public_stats["size"] = filestats
+    res = {}
 
-    public_stats["shortens"] = await app.db.fetchval(
-        """
-    SELECT COUNT(*)
-    FROM shortens
-    JOIN users
-      ON users.user_id = shortens.uploader
-    WHERE shortens.domain = $1 AND users.consented = true
-    """,
-        domain_id,
-    )
+    for row in rows:
+        dinfo = {
+            "domain": row["domain"],
+            "official": row["official"],
+            "admin_only": row["admin_only"],
+            "permissions": row["permissions"],
+            "cf_enabled": False,
+        }
+
+        res[row["domain_id"]] = {"info": dinfo, "stats": _public_stats(row)}
 
-    return public_stats
+    return res
@@ -3,33 +3,111 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 
 import math
+from typing import Optional
 
-from quart import request
+from quart import request, current_app as app
 from api.errors import BadInput
 
+# tables smaller than this get an exact (cached) count instead of
+# the planner's estimate, as the estimate is way off on small tables.
+ESTIMATE_THRESHOLD = 10000
+
+
+def parse_cursor(after: Optional[str]) -> Optional[int]:
+    """Parse an ?after cursor, which is the last ID the client saw."""
+    if after is None:
+        return None
+
+    try:
+        cursor = int(after)
+    except ValueError:
+        raise BadInput("Invalid after cursor")
+
+    # IDs are bigints
+    if not 0 <= cursor < 2**63:
+        raise BadInput("Invalid after cursor")
+
+    return cursor
+
 
 class Pagination:
-    """A utility class that helps with pagination."""
+    """A utility class that helps with pagination.
+
+    Two modes are supported: the classic ?page=N, which is translated
+    into an OFFSET, and keyset pagination with ?after=<id>, where the
+    client gives the last ID it saw. Keyset pagination keeps latency
+    constant regardless of how deep the client is paging.
+    """
 
     def __init__(self):
         self._raw_args = request.args
         self.page = self._int_arg("page")
         self.per_page = self._int_arg("per_page", 20)
 
+        self.after = parse_cursor(self._raw_args.get("after"))
+
         if self.page < 0:
             raise BadInput("Invalid page number")
         if self.per_page < 0:
             raise BadInput("Invalid per_page number")
 
-    def response(self, results, *, total_count):
+    @property
+    def offset(self) -> int:
+        """The OFFSET to give to the query.
+
+        Always zero when paginating by keyset, as the cursor
+        already tells where to start.
+        """
+        if self.after is not None:
+            return 0
+
+        return self.page * self.per_page
+
+    def next_cursor(self, ids: list):
+        """Give the cursor for the next page, given the IDs in this page."""
+        if len(ids) < self.per_page:
+            return None
+
+        return str(max(ids))
+
+    def response(self, results, *, total_count, next_cursor=None):
         """Return the resulting JSON object that the request should return."""
         return {
             "results": results,
             "pagination": {
                 "total": math.ceil(total_count / self.per_page),
                 "current": self.page,
+                "next": next_cursor,
             },
         }
 
     def _int_arg(self, name, default=0):
         return int(self._raw_args.get(name, default))
+
+
+async def estimate_count(table: str, count_key: str) -> int:
+    """Give the total row count of a table.
+
+    Uses the planner statistics in pg_class, which are free to fetch,
+    falling back to a cached exact count on small (or never analyzed)
+    tables.
+    """
+    estimate = await app.db.fetchval(
+        """
+    SELECT reltuples::bigint
+    FROM pg_class
+    WHERE oid = $1::regclass
+    """,
+        table,
+    )
+
+    if estimate is not None and estimate >= ESTIMATE_THRESHOLD:
+        return estimate
+
+    return await app.storage.get_count(
+        count_key,
+        f"""
+    SELECT COUNT(*)
+    FROM {table}
+    """,
+    )
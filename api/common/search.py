@@ -0,0 +1,165 @@
+# elixire: Image Host software
+# Copyright 2018-2019, elixi.re Team and the elixire contributors
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+elixi.re - admin search
+    Searching users and domains.
+
+With no query given, the functions here browse the table with keyset
+pagination (ordered by ID). With a query, matches are served from the
+pg_trgm GIN indexes (see the 3_add_trigram_search_indexes migration) and
+ranked: prefix matches first, then by trigram similarity.
+
+Ranked results can't be paginated by ID, so they always use OFFSET,
+and an ?after cursor is refused. That is fine since a search narrows
+down the result set.
+"""
+from typing import List, Optional, Tuple
+
+from quart import current_app as app
+
+from api.common.pagination import Pagination, estimate_count
+from api.errors import BadInput
+
+
+#: ranked search of users, by activity, query, limit and offset
+USER_SEARCH = """
+    SELECT user_id, username, active, admin, consented
+    FROM users
+    WHERE active = $1
+    AND (username LIKE '%'||$2||'%' OR user_id::text LIKE '%'||$2||'%')
+    ORDER BY
+        (username LIKE $2||'%') DESC,
+        similarity(username, $2) DESC,
+        user_id ASC
+    LIMIT $3
+    OFFSET $4
+"""
+
+
+def _check_ranked(pagination: Pagination):
+    if pagination.after is not None:
+        raise BadInput("Searches are paginated with page, not after")
+
+
+async def search_users(
+    query: str, *, active: bool, pagination: Pagination
+) -> Tuple[List[dict], int, Optional[str]]:
+    """Search users by username or ID.
+
+    Returns the rows, the total amount of matching users and
+    the cursor for the next page, if any.
+    """
+    if not query:
+        rows = await app.db.fetch(
+            """
+        SELECT user_id, username, active, admin, consented
+        FROM users
+        WHERE active = $1
+        AND ($2::bigint IS NULL OR user_id > $2::bigint)
+        ORDER BY user_id ASC
+        LIMIT $3
+        OFFSET $4
+        """,
+            active,
+            pagination.after,
+            pagination.per_page,
+            pagination.offset,
+        )
+
+        total_count = await app.storage.get_count(
+            f"users_search:{active}:",
+            """
+        SELECT COUNT(*)
+        FROM users
+        WHERE active = $1
+        """,
+            active,
+        )
+
+        next_cursor = pagination.next_cursor([r["user_id"] for r in rows])
+        return rows, total_count, next_cursor
+
+    _check_ranked(pagination)
+
+    rows = await app.db.fetch(
+        USER_SEARCH,
+        active,
+        query,
+        pagination.per_page,
+        pagination.page * pagination.per_page,
+    )
+
+    total_count = await app.storage.get_count(
+        f"users_search:{active}:{query}",
+        """
+    SELECT COUNT(*)
+    FROM users
+    WHERE active = $1
+    AND (username LIKE '%'||$2||'%' OR user_id::text LIKE '%'||$2||'%')
+    """,
+        active,
+        query,
+    )
+
+    return rows, total_count, None
+
+
+async def search_domains(
+    query: str, *, pagination: Pagination
+) -> Tuple[List[int], int, Optional[str]]:
+    """Search domains by name.
+
+    Returns the matching domain IDs, the total amount of matching domains
+    and the cursor for the next page, if any.
+    """
+    if not query:
+        rows = await app.db.fetch(
+            """
+        SELECT domain_id
+        FROM domains
+        WHERE ($1::bigint IS NULL OR domain_id > $1::bigint)
+        ORDER BY domain_id ASC
+        LIMIT $2
+        OFFSET $3
+        """,
+            pagination.after,
+            pagination.per_page,
+            pagination.offset,
+        )
+
+        domain_ids = [r["domain_id"] for r in rows]
+        total_count = await estimate_count("domains", "domains")
+        return domain_ids, total_count, pagination.next_cursor(domain_ids)
+
+    _check_ranked(pagination)
+
+    rows = await app.db.fetch(
+        """
+    SELECT domain_id
+    FROM domains
+    WHERE domain LIKE '%'||$1||'%'
+    ORDER BY
+        (domain LIKE $1||'%') DESC,
+        similarity(domain, $1) DESC,
+        domain_id ASC
+    LIMIT $2
+    OFFSET $3
+    """,
+        query,
+        pagination.per_page,
+        pagination.page * pagination.per_page,
+    )
+
+    total_count = await app.storage.get_count(
+        f"domains_search:{query}",
+        """
+    SELECT COUNT(*)
+    FROM domains
+    WHERE domain LIKE '%'||$1||'%'
+    """,
+        query,
+    )
+
+    return [r["domain_id"] for r in rows], total_count, None
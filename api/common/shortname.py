@@ -0,0 +1,154 @@
+# elixire: Image Host software
+# Copyright 2018-2019, elixi.re Team and the elixire contributors
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+elixi.re - shortname allocator
+
+Instead of checking random shortnames against the database one at a
+time, each worker reserves batches of them: a batch of random names is
+checked with a single query, and the free ones are claimed in Redis so
+that other workers won't hand them out too.
+
+The share of taken names in a batch tells how full the namespace is at
+that length. Once it goes over OCCUPANCY_THRESHOLD, names get one
+character longer, so allocating stays cheap as the namespace fills up.
+"""
+import asyncio
+import logging
+import secrets
+import string
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+ALPHABET = string.ascii_lowercase + string.digits
+
+#: how many names are checked at once
+BATCH_SIZE = 32
+
+#: grow names once more than this share of a batch was taken
+OCCUPANCY_THRESHOLD = 0.5
+
+#: how long reserved names are claimed for in Redis, in seconds.
+#  they're only handed out for half of that.
+CLAIM_TTL = 600
+
+MAX_LENGTH = 10
+
+TABLES = ("files", "shortens")
+
+
+def _gen_fname(length) -> str:
+    """Generate a random filename."""
+    return "".join(secrets.choice(ALPHABET) for _ in range(length))
+
+
+class ShortnameAllocator:
+    """Hands out shortnames that are free in the database
+    and not handed out by any other worker."""
+
+    def __init__(self, app):
+        self.app = app
+
+        #: reserved names, with the time they stop being valid
+        self.pools: Dict[Tuple[str, int], Deque[Tuple[str, float]]] = {}
+
+        #: length currently in use for a (table, minimum length) pair
+        self.lengths: Dict[Tuple[str, int], int] = {}
+
+        self.locks: Dict[Tuple[str, int], asyncio.Lock] = {}
+
+    async def _reserve(self, table: str, length: int) -> Tuple[list, float]:
+        """Reserve a batch of names.
+
+        Returns the reserved names and the share of names
+        that were already taken, or reserved by another worker.
+        """
+        candidates = list({_gen_fname(length) for _ in range(BATCH_SIZE)})
+
+        taken = await self.app.db.fetch(
+            f"""
+        SELECT filename
+        FROM {table}
+        WHERE filename = ANY($1::text[])
+        """,
+            candidates,
+        )
+        taken = {row["filename"] for row in taken}
+        free = [name for name in candidates if name not in taken]
+
+        # claim them, so other workers don't reserve the same ones
+        pipe = self.app.redis.pipeline()
+        for name in free:
+            pipe.set(f"shortname:{table}:{name}", "1", nx=True, ex=CLAIM_TTL)
+        claims = await pipe.execute() if free else []
+
+        reserved = [name for name, claimed in zip(free, claims) if claimed]
+        return reserved, 1 - len(reserved) / len(candidates)
+
+    async def _refill(self, table: str, min_length: int) -> int:
+        """Reserve names until there are some available,
+        growing their length if needed.
+
+        Returns how many batches had to be reserved.
+        """
+        key = (table, min_length)
+        batches = 0
+
+        while True:
+            length = self.lengths.get(key, min_length)
+            if length > MAX_LENGTH:
+                raise RuntimeError("Failed to generate a filename")
+
+            reserved, occupancy = await self._reserve(table, length)
+            batches += 1
+
+            if occupancy > OCCUPANCY_THRESHOLD or not reserved:
+                log.info(
+                    "%s names of length %d are %.0f%% taken, growing",
+                    table,
+                    length,
+                    occupancy * 100,
+                )
+                self.lengths[key] = length + 1
+
+            if reserved:
+                deadline = time.monotonic() + CLAIM_TTL / 2
+                self.pools[key].extend((name, deadline) for name in reserved)
+                return batches
+
+    def _pop(self, key) -> Optional[str]:
+        pool = self.pools[key]
+        now = time.monotonic()
+
+        while pool:
+            name, deadline = pool.popleft()
+            if deadline > now:
+                return name
+
+        return None
+
+    async def allocate(self, min_length: int, table: str = "files") -> Tuple[str, int]:
+        """Allocate a shortname.
+
+        Returns the shortname, and how many batches had
+        to be reserved to get it.
+        """
+        if table not in TABLES:
+            raise ValueError(f"Invalid table: {table!r}")
+
+        key = (table, min_length)
+        self.pools.setdefault(key, deque())
+        lock = self.locks.setdefault(key, asyncio.Lock())
+
+        batches = 0
+        async with lock:
+            name = self._pop(key)
+            while name is None:
+                batches += await self._refill(table, min_length)
+                name = self._pop(key)
+
+        return name, batches
@@ -0,0 +1,49 @@
+# elixire: Image Host software
+# Copyright 2018-2019, elixi.re Team and the elixire contributors
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+elixi.re - statistics reconciliation
+    The user_stats and domain_stats tables, and blob refcounts, are kept
+    up to date by triggers (see schema.sql). Every STATS_RECONCILE_PERIOD
+    seconds they get checked against what they count, and any drift gets
+    fixed, without locking the tables.
+"""
+import logging
+import time
+
+from quart import current_app as app
+
+log = logging.getLogger(__name__)
+
+
+def _reconcile_period() -> int:
+    return getattr(app.econfig, "STATS_RECONCILE_PERIOD", 86400)
+
+
+async def reconcile_stats_tick():
+    # reconciling goes over whole tables, so make sure only one worker
+    # does it per period, and that restarts don't cause extra runs.
+    claimed = await app.redis.set(
+        "stats:reconciled", "1", nx=True, ex=_reconcile_period()
+    )
+
+    if not claimed:
+        log.debug("statistics were reconciled recently, skipping")
+        return
+
+    start = time.monotonic()
+    await app.db.execute("SELECT reconcile_stats()")
+    await app.db.execute("SELECT reconcile_blobs()")
+    delta = round(time.monotonic() - start, 3)
+    log.info("reconciled statistics in %.3f seconds", delta)
+
+
+async def spawn_stats_reconciler():
+    # the tick itself is cheap when skipped, so check often
+    # enough that the period is respected across restarts.
+    app.sched.spawn_periodic(
+        reconcile_stats_tick,
+        every=min(_reconcile_period(), 3600),
+        name="stats_reconciler",
+    )
@@ -0,0 +1,68 @@
+# elixire: Image Host software
+# Copyright 2018-2019, elixi.re Team and the elixire contributors
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+elixi.re - usage ledger
+    Weekly usage of users, for quota checks.
+
+The user_usage table holds hourly buckets of uploaded bytes and created
+shortens per user. It is kept up to date by triggers on the files and
+shortens tables (see schema.sql), so that quota checks don't need to
+aggregate over every file the user uploaded in the last week.
+
+Buckets are counted whole, so usage from the oldest hour of the window
+is counted for up to an hour longer than the exact 7 days.
+"""
+import logging
+
+from quart import current_app as app
+
+log = logging.getLogger(__name__)
+
+#: limits of users without a limits row, same as the column defaults
+DEFAULT_BLIMIT = 104857600
+DEFAULT_SHLIMIT = 100
+
+
+async def get_usage(user_id: int) -> dict:
+    """Get a user's limits together with their usage in the last week.
+
+    Users without limits get the default ones.
+    """
+    row = await app.db.fetchrow(
+        """
+    SELECT COALESCE(limits.blimit, $2)::bigint AS blimit,
+           COALESCE(limits.shlimit, $3)::bigint AS shlimit,
+           COALESCE(SUM(user_usage.bytes_used), 0)::bigint AS bytes_used,
+           COALESCE(SUM(user_usage.shortens_used), 0)::bigint AS shortens_used
+    FROM (SELECT $1::bigint AS user_id) AS target
+    LEFT JOIN limits
+      ON limits.user_id = target.user_id
+    LEFT JOIN user_usage
+      ON user_usage.user_id = target.user_id
+     AND user_usage.bucket >= usage_bucket(time_snowflake(now() - interval '7 days'))
+    GROUP BY limits.blimit, limits.shlimit
+    """,
+        user_id,
+        DEFAULT_BLIMIT,
+        DEFAULT_SHLIMIT,
+    )
+
+    return dict(row)
+
+
+async def usage_janitor_tick():
+    """Remove usage buckets that went out of the weekly window."""
+    res = await app.db.execute(
+        """
+    DELETE FROM user_usage
+    WHERE bucket < usage_bucket(time_snowflake(now() - interval '7 days'))
+    """
+    )
+
+    log.info("usage janitor: %s", res)
+
+
+async def spawn_usage_janitor():
+    app.sched.spawn_periodic(usage_janitor_tick, every=3600, name="usage_janitor")
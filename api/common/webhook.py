@@ -204,7 +204,7 @@ async def jpeg_toobig_webhook(ctx, size_after):
     await _post_webhook(wh_url, embed=payload)
 
 
-async def scan_webhook(ctx, scan_out: str):
+async def scan_webhook(user_id: int, filename: str, file_size: int, scan_out: str):
     """Execute a discord webhook with information about the virus scan."""
     uname = await app.db.fetchval(
         """
@@ -212,19 +212,19 @@ async def scan_webhook(ctx, scan_out: str):
         FROM users
         WHERE user_id = $1
     """,
-        ctx.user_id,
+        user_id,
     )
 
     payload = {
         "title": "Elixire Virus Scanning",
         "color": 0xFF0000,
         "fields": [
-            {"name": "user", "value": f"id: {ctx.user_id}, username: {uname}"},
+            {"name": "user", "value": f"id: {user_id}, username: {uname}"},
             {
                 "name": "file info",
-                "value": f"filename: `{ctx.file.name}`, {ctx.file.size} bytes",
+                "value": f"filename: `{filename}`, {file_size} bytes",
             },
-            {"name": "clamdscan out", "value": f"```\n{scan_out}\n```"},
+            {"name": "clamd out", "value": f"```\n{scan_out}\n```"},
         ],
     }
 
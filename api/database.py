@@ -0,0 +1,241 @@
+# elixire: Image Host software
+# Copyright 2018-2019, elixi.re Team and the elixire contributors
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+elixire - instrumented database pool
+
+Wraps the asyncpg pool so that acquire wait times and query latencies
+(per query fingerprint) end up in the metrics backend, and queries
+slower than DB_SLOW_QUERY_THRESHOLD get logged.
+
+Every connection also prepares the statements in api.statements
+when it is created.
+"""
+import functools
+import logging
+import re
+import time
+from typing import Dict, Optional
+
+import asyncpg
+
+from api.bp.metrics.histogram import Histograms
+from api.statements import STATEMENTS
+
+log = logging.getLogger(__name__)
+
+#: longest fingerprint kept, so tags stay readable
+FINGERPRINT_LEN = 120
+
+#: most query fingerprints with a latency histogram of their own,
+#  the rest are counted together
+QUERY_SERIES = 100
+
+_WHITESPACE = re.compile(r"\s+")
+_LITERALS = re.compile(r"'(?:[^']|'')*'|(?<![$\w])\d+\b")
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(query: str) -> str:
+    """Give a normalized version of a query, with whitespace collapsed
+    and literals replaced, to group latencies of the same statement."""
+    query = _LITERALS.sub("?", query)
+    query = _WHITESPACE.sub(" ", query).strip()
+    return query[:FINGERPRINT_LEN]
+
+
+class PoolStats:
+    """Latency histograms of a pool, in milliseconds."""
+
+    def __init__(self, slow_threshold: Optional[float]):
+        self.slow_threshold = slow_threshold
+        self.acquire_wait = Histograms("db_acquire_wait", ())
+        self.queries = Histograms("db_query", ("query",), QUERY_SERIES)
+
+    def record_query(self, query: str, started: float):
+        elapsed = (time.monotonic() - started) * 1000
+        self.queries.record((fingerprint(query),), elapsed)
+
+        if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+            log.warning("slow query (%.2fms): %s", elapsed, fingerprint(query))
+
+
+class InstrumentedConnection(asyncpg.Connection):
+    """Connection that times every query it runs."""
+
+    #: set by the pool's init callback
+    stats: Optional[PoolStats] = None
+
+    #: prepared statements from api.statements, by name
+    statements: Dict[str, asyncpg.prepared_stmt.PreparedStatement] = {}
+
+    async def prepare_statements(self):
+        statements = {}
+
+        for name, query in STATEMENTS.items():
+            try:
+                statements[name] = await self.prepare(query)
+            except asyncpg.PostgresError as err:
+                # the statement is then run unprepared, which will
+                # most likely give the same error where it is used.
+                log.warning("failed to prepare statement %r: %r", name, err)
+
+        self.statements = statements
+
+    async def _timed(self, method, query: str, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            return await method(query, *args, **kwargs)
+        finally:
+            if self.stats is not None:
+                self.stats.record_query(query, started)
+
+    async def execute(self, query: str, *args, **kwargs):
+        return await self._timed(super().execute, query, *args, **kwargs)
+
+    async def executemany(self, command: str, args, **kwargs):
+        return await self._timed(super().executemany, command, args, **kwargs)
+
+    async def fetch(self, query, *args, **kwargs):
+        return await self._timed(super().fetch, query, *args, **kwargs)
+
+    async def fetchval(self, query, *args, **kwargs):
+        return await self._timed(super().fetchval, query, *args, **kwargs)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        return await self._timed(super().fetchrow, query, *args, **kwargs)
+
+
+class _AcquireContext:
+    def __init__(self, pool, timeout):
+        self.pool = pool
+        self.timeout = timeout
+        self.conn = None
+
+    async def __aenter__(self):
+        started = time.monotonic()
+        self.conn = await self.pool.pool.acquire(timeout=self.timeout)
+        elapsed = (time.monotonic() - started) * 1000
+        self.pool.stats.acquire_wait.record((), elapsed)
+        return self.conn
+
+    async def __aexit__(self, *exc):
+        conn, self.conn = self.conn, None
+        await self.pool.pool.release(conn)
+
+
+class InstrumentedPool:
+    """asyncpg pool wrapper that measures connection acquire wait times.
+
+    Anything not defined here is passed through to the asyncpg pool.
+    """
+
+    def __init__(self, pool: asyncpg.pool.Pool, stats: PoolStats):
+        self.pool = pool
+        self.stats = stats
+
+    @property
+    def histograms(self) -> list:
+        return [self.stats.acquire_wait, self.stats.queries]
+
+    def pool_stats(self) -> dict:
+        """Give the current connection counts of the pool."""
+        size = self.pool.get_size()
+        idle = self.pool.get_idle_size()
+        return {
+            "db_pool_size": size,
+            "db_pool_idle": idle,
+            "db_pool_in_use": size - idle,
+        }
+
+    def acquire(self, *, timeout=None):
+        return _AcquireContext(self, timeout)
+
+    async def execute(self, query: str, *args, timeout=None):
+        async with self.acquire() as conn:
+            return await conn.execute(query, *args, timeout=timeout)
+
+    async def executemany(self, command: str, args, *, timeout=None):
+        async with self.acquire() as conn:
+            return await conn.executemany(command, args, timeout=timeout)
+
+    async def fetch(self, query, *args, timeout=None, record_class=None):
+        async with self.acquire() as conn:
+            return await conn.fetch(
+                query, *args, timeout=timeout, record_class=record_class
+            )
+
+    async def fetchval(self, query, *args, column=0, timeout=None):
+        async with self.acquire() as conn:
+            return await conn.fetchval(query, *args, column=column, timeout=timeout)
+
+    async def fetchrow(self, query, *args, timeout=None, record_class=None):
+        async with self.acquire() as conn:
+            return await conn.fetchrow(
+                query, *args, timeout=timeout, record_class=record_class
+            )
+
+    async def _run_stmt(self, method: str, name: str, *args):
+        query = STATEMENTS[name]
+
+        async with self.acquire() as conn:
+            stmt = conn.statements.get(name)
+            if stmt is None:
+                return await getattr(conn, method)(query, *args)
+
+            started = time.monotonic()
+            try:
+                try:
+                    return await getattr(stmt, method)(*args)
+                except asyncpg.InvalidCachedStatementError:
+                    # the tables it uses changed (e.g by a migration)
+                    # since it was prepared, so it's prepared again
+                    log.info("statement %r is outdated, preparing it again", name)
+                    stmt = conn.statements[name] = await conn.prepare(query)
+                    return await getattr(stmt, method)(*args)
+            finally:
+                self.stats.record_query(query, started)
+
+    async def fetch_stmt(self, name: str, *args):
+        """Run a prepared statement from api.statements, by name."""
+        return await self._run_stmt("fetch", name, *args)
+
+    async def fetchrow_stmt(self, name: str, *args):
+        """Run a prepared statement from api.statements, by name."""
+        return await self._run_stmt("fetchrow", name, *args)
+
+    async def fetchval_stmt(self, name: str, *args):
+        """Run a prepared statement from api.statements, by name."""
+        return await self._run_stmt("fetchval", name, *args)
+
+    def __getattr__(self, attr):
+        return getattr(self.pool, attr)
+
+
+async def create_pool(config) -> InstrumentedPool:
+    """Create the app's database pool, with its tuning settings
+    taken from the config."""
+    stats = PoolStats(getattr(config, "DB_SLOW_QUERY_THRESHOLD", 500))
+
+    options = {
+        "min_size": getattr(config, "DB_POOL_MIN_SIZE", 10),
+        "max_size": getattr(config, "DB_POOL_MAX_SIZE", 10),
+        "statement_cache_size": getattr(config, "DB_STATEMENT_CACHE_SIZE", 100),
+        # settings in the db dict win over the ones above
+        **config.db,
+    }
+
+    # named server-side statements don't survive poolers like pgbouncer
+    # in transaction mode, which also need the statement cache disabled
+    prepare = options["statement_cache_size"] > 0
+
+    async def _init(conn):
+        conn.stats = stats
+        if prepare:
+            await conn.prepare_statements()
+
+    pool = await asyncpg.create_pool(
+        connection_class=InstrumentedConnection, init=_init, **options
+    )
+    return InstrumentedPool(pool, stats)
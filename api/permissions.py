@@ -23,15 +23,12 @@ async def domain_permissions(
 
     This is used to check if you can upload/shorten to a domain.
     """
-    perm = await app.db.fetchval(
-        """
-    SELECT permissions
-    FROM domains
-    WHERE domain_id = $1
-    """,
-        domain_id,
-    )
+    perm = await app.db.fetchval_stmt("domain_permissions", domain_id)
+    return check_permissions(perm, permission, raise_on_err)
 
+
+def check_permissions(perm: int, permission: Permissions, raise_on_err=True) -> bool:
+    """Check if a domain's permission bits match a given permission."""
     if not perm:
         raise BadInput("Domain not found")
 
@@ -0,0 +1,141 @@
+# elixire: Image Host software
+# Copyright 2018-2019, elixi.re Team and the elixire contributors
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+elixire - prepared statements
+
+Queries on the hot path, by name. Every connection in the app's pool
+prepares all of them as soon as it is created (see api.database), so
+that requests don't pay for parsing and planning them.
+
+Run them with app.db.fetch_stmt / fetchrow_stmt / fetchval_stmt.
+"""
+
+STATEMENTS = {
+    # users
+    "user_id_by_name": """
+        SELECT user_id
+        FROM users
+        WHERE username = $1
+        LIMIT 1
+    """,
+    "username": """
+        SELECT username
+        FROM users
+        WHERE user_id = $1
+        LIMIT 1
+    """,
+    "user_password_hash": """
+        SELECT password_hash
+        FROM users
+        WHERE user_id = $1
+    """,
+    "user_active": """
+        SELECT active
+        FROM users
+        WHERE user_id = $1
+    """,
+    "user_admin": """
+        SELECT admin
+        FROM users
+        WHERE user_id = $1
+    """,
+    "user_paranoid": """
+        SELECT paranoid
+        FROM users
+        WHERE user_id = $1
+    """,
+    "upload_profile": """
+        SELECT users.paranoid, users.consented,
+               users.domain, users.subdomain,
+               domains.domain AS domain_name,
+               domains.permissions AS domain_permissions,
+               users.shorten_domain, users.shorten_subdomain,
+               shorten_domains.domain AS shorten_domain_name,
+               shorten_domains.permissions AS shorten_domain_permissions
+        FROM users
+        LEFT JOIN domains
+          ON domains.domain_id = users.domain
+        LEFT JOIN domains AS shorten_domains
+          ON shorten_domains.domain_id = users.shorten_domain
+        WHERE users.user_id = $1
+    """,
+    # bans
+    "user_ban": """
+        SELECT reason, end_timestamp
+        FROM bans
+        WHERE user_id = $1 AND end_timestamp > now()
+        LIMIT 1
+    """,
+    "ip_ban": """
+        SELECT reason, end_timestamp
+        FROM ip_bans
+        WHERE ip_address = $1 AND end_timestamp > now()
+        LIMIT 1
+    """,
+    # domains
+    "domain_by_names": """
+        SELECT domain, domain_id
+        FROM domains
+        WHERE domain = $1
+            OR domain = $2
+            OR domain = $3
+    """,
+    "domain_name": """
+        SELECT domain
+        FROM domains
+        WHERE domain_id = $1
+    """,
+    "domain_permissions": """
+        SELECT permissions
+        FROM domains
+        WHERE domain_id = $1
+    """,
+    # files and shortens
+    "file_fspath": """
+        SELECT fspath
+        FROM files
+        WHERE filename = $1
+          AND deleted = false
+          AND domain = $2
+        LIMIT 1
+    """,
+    "file_fspath_scanned": """
+        SELECT fspath
+        FROM files
+        WHERE filename = $1
+          AND deleted = false
+          AND domain = $2
+          AND NOT EXISTS (
+            SELECT 1
+            FROM scan_queue
+            WHERE scan_queue.file_id = files.file_id
+          )
+        LIMIT 1
+    """,
+    "file_mime": """
+        SELECT mimetype
+        FROM files
+        WHERE filename = $1
+          AND deleted = false
+        LIMIT 1
+    """,
+    "file_repeats": """
+        SELECT filename, uploader, domain
+        FROM files
+        WHERE fspath = $1 AND files.deleted = false
+    """,
+    "blob_fspath": """
+        SELECT fspath
+        FROM blobs
+        WHERE hash = $1 AND extension = $2
+    """,
+    "shorten_redirto": """
+        SELECT redirto
+        FROM shortens
+        WHERE filename = $1
+        AND deleted = false
+        AND domain = $2
+    """,
+}
@@ -81,6 +81,10 @@ class Storage:
         self.db = app.db
         self.redis = app.redis
 
+        #: cache hits and misses of _generic_1, for metrics
+        self.hits = 0
+        self.misses = 0
+
     async def get(self, key, typ=str):
         """Get one key from Redis.
 
@@ -188,8 +192,8 @@ class Storage:
     async def _generic_1(
         self, key: str, key_type, ttl: int, query: str, *query_args: tuple
     ):
-        """Generic storage function for Storage.get_uid
-        and Storage.get_username.
+        """Generic storage function, caching the result
+        of a single-value query.
 
         Parameters
         ----------
@@ -213,45 +217,43 @@ class Storage:
         any
             Any value that is cached, or found in database.
         """
+        return await self._cached(
+            key, key_type, ttl, lambda: self.db.fetchval(query, *query_args)
+        )
+
+    async def _generic_stmt(self, key: str, key_type, ttl: int, name: str, *args):
+        """Like Storage._generic_1, but running a prepared
+        statement from api.statements instead of a query."""
+        return await self._cached(
+            key, key_type, ttl, lambda: self.db.fetchval_stmt(name, *args)
+        )
+
+    async def _cached(self, key: str, key_type, ttl: int, fetch):
         val = await self.get(key, key_type)
 
+        if val is not None:
+            self.hits += 1
+
         if val is False:
             return
 
         if val is None:
-            val = await self.db.fetchval(query, *query_args)
+            self.misses += 1
+            val = await fetch()
             await self.set_with_ttl(key, val or "false", ttl)
 
         return val
 
     async def get_uid(self, username: str) -> int:
         """Get an user ID given a username."""
-        return await self._generic_1(
-            f"uid:{username}",
-            int,
-            600,
-            """
-            SELECT user_id
-            FROM users
-            WHERE username = $1
-            LIMIT 1
-        """,
-            username,
+        return await self._generic_stmt(
+            f"uid:{username}", int, 600, "user_id_by_name", username
         )
 
     async def get_username(self, user_id: int) -> str:
         """Get a username given user ID."""
-        return await self._generic_1(
-            f"uname:{user_id}",
-            str,
-            600,
-            """
-            SELECT username
-            FROM users
-            WHERE user_id = $1
-            LIMIT 1
-        """,
-            user_id,
+        return await self._generic_stmt(
+            f"uname:{user_id}", str, 600, "username", user_id
         )
 
     async def actx_username(self, username: str) -> dict:
@@ -304,27 +306,13 @@ class Storage:
         active = await self.get(f"{ukey}:active", bool)
 
         if password_hash is None:
-            password_hash = await self.db.fetchval(
-                """
-            SELECT password_hash
-            FROM users
-            WHERE user_id = $1
-            """,
-                user_id,
-            )
+            password_hash = await self.db.fetchval_stmt("user_password_hash", user_id)
 
             # keep this cached for 10 minutes
             await self.set_with_ttl(f"{ukey}:password_hash", password_hash, 600)
 
         if active is None:
-            active = await self.db.fetchval(
-                """
-            SELECT active
-            FROM users
-            WHERE user_id = $1
-            """,
-                user_id,
-            )
+            active = await self.db.fetchval_stmt("user_active", user_id)
 
             # keep this cached as well
             await self.set_with_ttl(f"{ukey}:active", active, 600)
@@ -337,42 +325,35 @@ class Storage:
         )
 
     async def get_fspath(self, shortname: str, domain_id: int) -> str:
-        """Get the filesystem path of an image."""
+        """Get the filesystem path of an image.
+
+        Files pending a background scan are only
+        found if SERVE_UNSCANNED is enabled.
+        """
         key = f"fspath:{domain_id}:{shortname}"
-        return await self._generic_1(
-            key,
-            str,
-            600,
-            """
-            SELECT fspath
-            FROM files
-            WHERE filename = $1
-              AND deleted = false
-              AND domain = $2
-            LIMIT 1
-        """,
-            shortname,
-            domain_id,
+        statement = (
+            "file_fspath"
+            if getattr(self.app.econfig, "SERVE_UNSCANNED", True)
+            else "file_fspath_scanned"
         )
+        return await self._generic_stmt(key, str, 600, statement, shortname, domain_id)
 
     async def get_urlredir(self, filename: str, domain_id: int) -> str:
         """Get a redirection of an URL."""
         key = f"redir:{domain_id}:{filename}"
-        return await self._generic_1(
-            key,
-            str,
-            600,
-            """
-            SELECT redirto
-            FROM shortens
-            WHERE filename = $1
-            AND deleted = false
-            AND domain = $2
-        """,
-            filename,
-            domain_id,
+        return await self._generic_stmt(
+            key, str, 600, "shorten_redirto", filename, domain_id
         )
 
+    async def get_count(self, key: str, query: str, *query_args) -> int:
+        """Get the result of a COUNT query, caching it for a minute.
+
+        Used by paginated listings so they don't need to
+        count the whole table on every page.
+        """
+        count = await self._generic_1(f"count:{key}", int, 60, query, *query_args)
+        return count or 0
+
     async def get_ipban(self, ip_address: str) -> str:
         """Get the reason for a specific IP ban."""
         key = f"ipban:{ip_address}"
@@ -382,15 +363,7 @@ class Storage:
             return
 
         if ban_reason is None:
-            row = await self.db.fetchrow(
-                """
-            SELECT reason, end_timestamp
-            FROM ip_bans
-            WHERE ip_address = $1 AND end_timestamp > now()
-            LIMIT 1
-            """,
-                ip_address,
-            )
+            row = await self.db.fetchrow_stmt("ip_ban", ip_address)
 
             if row is None:
                 await self.set(key, None)
@@ -414,15 +387,7 @@ class Storage:
             return
 
         if ban_reason is None:
-            row = await self.db.fetchrow(
-                """
-            SELECT reason, end_timestamp
-            FROM bans
-            WHERE user_id = $1 AND end_timestamp > now()
-            LIMIT 1
-            """,
-                user_id,
-            )
+            row = await self.db.fetchrow_stmt("user_ban", user_id)
 
             if row is None:
                 await self.set(key, None)
@@ -465,16 +430,7 @@ class Storage:
 
         keys_db = solve_domain(domain_name, False)
 
-        row = await self.db.fetchrow(
-            """
-        SELECT domain, domain_id
-        FROM domains
-        WHERE domain = $1
-            OR domain = $2
-            OR domain = $3
-        """,
-            *keys_db,
-        )
+        row = await self.db.fetchrow_stmt("domain_by_names", *keys_db)
 
         if row is None:
             # maybe we set only f'domain_id:{domain_name}' to false
@@ -520,16 +476,4 @@ class Storage:
         """Get the File's mimetype stored on the database."""
 
         key = f"mime:{shortname}"
-        return await self._generic_1(
-            key,
-            str,
-            600,
-            """
-            SELECT mimetype
-            FROM files
-            WHERE filename = $1
-              AND deleted = false
-            LIMIT 1
-        """,
-            shortname,
-        )
+        return await self._generic_stmt(key, str, 600, "file_mime", shortname)
@@ -3,11 +3,12 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 
 from os.path import splitext
-from pathlib import Path
 from decimal import Decimal
 
 from quart import current_app as app
-from api.common import delete_file
+from api.blobstore import LocalBlobStore
+from api.blobstore.reshard import get_cursor, reset_cursor, reshard_batch
+from api.common import delete_file, release_blobs
 from manage.errors import PrintException
 
 
@@ -25,33 +26,44 @@ def byte_to_mibstring(bytecount: int) -> str:
 
 
 async def deletefiles(_args):
-    """Clean files marked as deleted on the db."""
-    to_delete = await app.db.fetch(
+    """Delete the contents of files no file refers to anymore."""
+    orphans = await app.db.fetch(
         """
     SELECT fspath
-    FROM files
-    WHERE files.deleted = true
+    FROM blobs
+    WHERE refcount = 0
     """
     )
 
-    print(f"deleting {len(to_delete)} files")
-    completed = 0
+    print(f"deleting {len(orphans)} files")
+    await release_blobs([row["fspath"] for row in orphans])
+    print("OK")
 
-    for row in to_delete:
-        fspath = row["fspath"]
-        path = Path(fspath)
-        try:
-            path.unlink()
-            completed += 1
-        except FileNotFoundError:
-            print(f"fspath {fspath!r} not found")
 
-    print(
-        f"""
-    out of {len(to_delete)} files to be deleted
-    {completed} were actually deleted
-    """
-    )
+async def reshard_files(args):
+    """Move stored files to the layout set in IMAGE_SHARDS."""
+    if not isinstance(app.blobs, LocalBlobStore):
+        raise PrintException("files are only sharded in the local storage backend")
+
+    if args.restart:
+        await reset_cursor()
+
+    cursor = await get_cursor()
+    if cursor is not None:
+        print(f"resuming after blob {cursor[0]}{cursor[1]}")
+
+    total = 0
+    while True:
+        cursor, moved = await reshard_batch(cursor, args.batch_size)
+        if cursor is None:
+            break
+
+        total += moved
+        print(f"moved {moved} files, {total} total, at {cursor[0]}{cursor[1]}")
+
+    await reset_cursor()
+    print(f"moved {total} files")
+    print("OK")
 
 
 async def rename_file(args):
@@ -345,13 +357,36 @@ def setup(subparsers):
         "cleanup_files",
         help="Delete files from the image folder",
         description="""
-Delete all files that are marked as deleted in the image directory.
-This is a legacy operation for instances that did not update
-to a version of the backend that deletes files.
+Delete the contents of all files that no file refers to anymore,
+from the storage backend. This is a legacy operation for instances
+that did not update to a version of the backend that deletes files.
         """,
     )
     parser_cleanup.set_defaults(func=deletefiles)
 
+    parser_reshard = subparsers.add_parser(
+        "reshard_files",
+        help="Move files to the folder layout in IMAGE_SHARDS",
+        description="""
+Move the files in the image folder to the layout set in IMAGE_SHARDS,
+in batches, while the instance is running. Files keep being served
+from either layout until they are moved. If interrupted, running it
+again resumes where it stopped.
+        """,
+    )
+    parser_reshard.add_argument(
+        "--batch-size",
+        type=int,
+        default=200,
+        help="how many files are moved per transaction",
+    )
+    parser_reshard.add_argument(
+        "--restart",
+        action="store_true",
+        help="start from the first file, instead of resuming",
+    )
+    parser_reshard.set_defaults(func=reshard_files)
+
     parser_rename = subparsers.add_parser("rename_file", help="Rename a single file")
 
     parser_rename.add_argument("shortname", help="old shortname for the file")
@@ -0,0 +1,13 @@
+-- trigram indexes so that admin searches (LIKE '%query%') don't
+-- need to scan the whole users and domains tables.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS users_username_trgm_idx
+    ON users USING gin (username gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS users_user_id_trgm_idx
+    ON users USING gin ((user_id::text) gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS domains_domain_trgm_idx
+    ON domains USING gin (domain gin_trgm_ops);
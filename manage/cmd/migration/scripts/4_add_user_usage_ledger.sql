@@ -0,0 +1,96 @@
+-- rolling per-user usage ledger, so quota checks don't have to
+-- SUM() over the last week of files on every upload.
+
+BEGIN;
+
+-- no writes to files/shortens while we create the triggers and backfill,
+-- or rows could be counted twice (or not at all).
+LOCK TABLE files, shortens IN SHARE ROW EXCLUSIVE MODE;
+
+-- hour number of a snowflake, used to bucket the usage ledger
+CREATE OR REPLACE FUNCTION usage_bucket (snowflake BIGINT)
+    RETURNS BIGINT AS $$
+BEGIN
+    RETURN (snowflake >> 22) / 3600000;
+END; $$
+LANGUAGE PLPGSQL IMMUTABLE;
+
+-- rolling usage ledger, in hourly buckets (see api/common/usage.py)
+-- maintained by the triggers below.
+CREATE TABLE IF NOT EXISTS user_usage (
+    user_id bigint REFERENCES users (user_id) ON DELETE CASCADE,
+    bucket bigint NOT NULL,
+    bytes_used bigint NOT NULL DEFAULT 0,
+    shortens_used bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, bucket)
+);
+
+CREATE OR REPLACE FUNCTION files_usage_update ()
+    RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE user_usage
+        SET bytes_used = bytes_used - COALESCE(OLD.file_size, 0)
+        WHERE user_id = OLD.uploader
+          AND bucket = usage_bucket(OLD.file_id);
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.uploader IS NOT NULL THEN
+        INSERT INTO user_usage (user_id, bucket, bytes_used)
+        VALUES (NEW.uploader, usage_bucket(NEW.file_id), COALESCE(NEW.file_size, 0))
+        ON CONFLICT (user_id, bucket) DO UPDATE
+            SET bytes_used = user_usage.bytes_used + EXCLUDED.bytes_used;
+    END IF;
+
+    RETURN NULL;
+END; $$
+LANGUAGE PLPGSQL;
+
+CREATE OR REPLACE FUNCTION shortens_usage_update ()
+    RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE user_usage
+        SET shortens_used = shortens_used - 1
+        WHERE user_id = OLD.uploader
+          AND bucket = usage_bucket(OLD.shorten_id);
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.uploader IS NOT NULL THEN
+        INSERT INTO user_usage (user_id, bucket, shortens_used)
+        VALUES (NEW.uploader, usage_bucket(NEW.shorten_id), 1)
+        ON CONFLICT (user_id, bucket) DO UPDATE
+            SET shortens_used = user_usage.shortens_used + 1;
+    END IF;
+
+    RETURN NULL;
+END; $$
+LANGUAGE PLPGSQL;
+
+DROP TRIGGER IF EXISTS files_usage ON files;
+CREATE TRIGGER files_usage
+    AFTER INSERT OR DELETE OR UPDATE OF uploader, file_size ON files
+    FOR EACH ROW EXECUTE PROCEDURE files_usage_update();
+
+DROP TRIGGER IF EXISTS shortens_usage ON shortens;
+CREATE TRIGGER shortens_usage
+    AFTER INSERT OR DELETE OR UPDATE OF uploader ON shortens
+    FOR EACH ROW EXECUTE PROCEDURE shortens_usage_update();
+
+INSERT INTO user_usage (user_id, bucket, bytes_used)
+SELECT uploader, usage_bucket(file_id), SUM(COALESCE(file_size, 0))
+FROM files
+WHERE file_id > time_snowflake(now() - interval '7 days')
+  AND uploader IS NOT NULL
+GROUP BY uploader, usage_bucket(file_id);
+
+INSERT INTO user_usage (user_id, bucket, shortens_used)
+SELECT uploader, usage_bucket(shorten_id), COUNT(*)
+FROM shortens
+WHERE shorten_id > time_snowflake(now() - interval '7 days')
+  AND uploader IS NOT NULL
+GROUP BY uploader, usage_bucket(shorten_id)
+ON CONFLICT (user_id, bucket) DO UPDATE
+    SET shortens_used = EXCLUDED.shortens_used;
+
+COMMIT;
@@ -0,0 +1,106 @@
+-- explicit, reference-counted blobs for deduplicated file storage,
+-- instead of counting files with the same fspath.
+
+BEGIN;
+
+-- stored objects, deduplicated by their content. files refer to
+-- their blob by fspath, which is where the blob is stored.
+CREATE TABLE IF NOT EXISTS blobs (
+    -- sha256 of the contents
+    hash text NOT NULL,
+
+    -- the same contents can be stored with different extensions
+    extension text NOT NULL DEFAULT '',
+
+    fspath text UNIQUE NOT NULL,
+    size bigint NOT NULL,
+    mimetype text,
+
+    -- how many non-deleted files refer to this blob,
+    -- maintained by the trigger below.
+    refcount bigint NOT NULL DEFAULT 0,
+
+    created_at timestamp without time zone default (now() at time zone 'utc'),
+    PRIMARY KEY (hash, extension)
+);
+
+CREATE INDEX IF NOT EXISTS files_fspath_idx ON files (fspath);
+
+CREATE OR REPLACE FUNCTION files_blobs_update ()
+    RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.deleted = false THEN
+        UPDATE blobs
+        SET refcount = refcount - 1
+        WHERE fspath = OLD.fspath;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.deleted = false THEN
+        UPDATE blobs
+        SET refcount = refcount + 1
+        WHERE fspath = NEW.fspath;
+    END IF;
+
+    RETURN NULL;
+END; $$
+LANGUAGE PLPGSQL;
+
+-- fix any drift of blob refcounts, without locking the tables.
+-- same as reconcile_stats, the drift is taken out of a single
+-- snapshot and applied as a delta.
+CREATE OR REPLACE FUNCTION reconcile_blobs ()
+    RETURNS VOID AS $$
+BEGIN
+    UPDATE blobs
+    SET refcount = blobs.refcount + drift.delta
+    FROM (
+        SELECT blobs.fspath,
+               COUNT(files.file_id) - blobs.refcount AS delta
+        FROM blobs
+        LEFT JOIN files
+          ON files.fspath = blobs.fspath
+         AND files.deleted = false
+        GROUP BY blobs.fspath, blobs.refcount
+    ) AS drift
+    WHERE blobs.fspath = drift.fspath
+      AND drift.delta <> 0;
+END; $$
+LANGUAGE PLPGSQL;
+
+DROP TRIGGER IF EXISTS files_blobs ON files;
+CREATE TRIGGER files_blobs
+    AFTER INSERT OR DELETE OR UPDATE OF fspath, deleted ON files
+    FOR EACH ROW EXECUTE PROCEDURE files_blobs_update();
+
+-- initial fill, from the files that are already stored.
+-- fspaths end in the file's hash and extension, and the first
+-- upload of a hash holds its real size.
+CREATE TEMPORARY TABLE legacy_blobs ON COMMIT DROP AS
+SELECT file_id, fspath, file_size, mimetype,
+       substring(fspath from '([0-9a-f]{64})[^/]*$') AS hash,
+       COALESCE(substring(fspath from '[0-9a-f]{64}(\.[^/]*)$'), '') AS extension
+FROM files
+WHERE fspath ~ '[0-9a-f]{64}[^/]*$';
+
+INSERT INTO blobs (hash, extension, fspath, size, mimetype)
+SELECT DISTINCT ON (hash, extension)
+       hash, extension, fspath, COALESCE(file_size, 0), mimetype
+FROM legacy_blobs
+ORDER BY hash, extension, file_id
+ON CONFLICT DO NOTHING;
+
+-- the same contents can be referred to with different spellings of
+-- their path (e.g relative and absolute ones). files refer to the
+-- one their blob got, so they're all counted.
+UPDATE files
+SET fspath = blobs.fspath
+FROM legacy_blobs
+JOIN blobs
+  ON blobs.hash = legacy_blobs.hash
+ AND blobs.extension = legacy_blobs.extension
+WHERE files.file_id = legacy_blobs.file_id
+  AND files.fspath <> blobs.fspath;
+
+SELECT reconcile_blobs();
+
+COMMIT;
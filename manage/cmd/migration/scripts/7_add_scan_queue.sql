@@ -0,0 +1,29 @@
+-- a durable queue for background virus scans, instead of
+-- tasks that were lost on restarts.
+
+BEGIN;
+
+-- files whose virus scan took too long to be done while they
+-- were uploaded, and are scanned in the background instead.
+-- a file is pending a scan while it is in here.
+CREATE TABLE IF NOT EXISTS scan_queue (
+    file_id bigint REFERENCES files (file_id) ON DELETE CASCADE,
+
+    -- failed scans are retried, with a backoff
+    attempts integer NOT NULL DEFAULT 0,
+
+    -- when the file can be claimed next. claiming it pushes this
+    -- forward, so files of workers that died get claimed again.
+    next_attempt timestamp without time zone
+        NOT NULL DEFAULT (now() at time zone 'utc'),
+
+    queued_at timestamp without time zone
+        NOT NULL DEFAULT (now() at time zone 'utc'),
+
+    PRIMARY KEY (file_id)
+);
+
+CREATE INDEX IF NOT EXISTS scan_queue_next_attempt_idx
+    ON scan_queue (next_attempt);
+
+COMMIT;
@@ -0,0 +1,13 @@
+-- failed data dumps are retried with a backoff, instead of
+-- being claimed again by the worker right away.
+
+BEGIN;
+
+ALTER TABLE current_dump_state
+    ADD COLUMN IF NOT EXISTS attempts integer NOT NULL DEFAULT 0;
+
+ALTER TABLE current_dump_state
+    ADD COLUMN IF NOT EXISTS next_attempt timestamp without time zone
+        NOT NULL DEFAULT (now() at time zone 'utc');
+
+COMMIT;
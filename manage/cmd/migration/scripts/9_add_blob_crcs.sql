@@ -0,0 +1,10 @@
+-- keep the crc32 of blobs, so streamed data dumps don't
+-- have to read every file to know it.
+
+BEGIN;
+
+-- existing blobs get theirs the first time they're streamed
+ALTER TABLE blobs
+    ADD COLUMN IF NOT EXISTS crc bigint;
+
+COMMIT;
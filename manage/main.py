@@ -18,6 +18,7 @@ from quart import Quart
 # import stuff from api for our Context.
 # more info on Context @ manage/utils.py
 from api.storage import Storage
+from api.blobstore import create_blobstore
 from api.common.utils import LockStorage
 from api.jobs import JobManager
 
@@ -84,6 +85,7 @@ async def amain(loop, config, argv: List[str], *, is_testing: bool = False):
     app.storage = Storage(app)
     app.locks = LockStorage()
     app.session = aiohttp.ClientSession()
+    app.blobs = create_blobstore(app)
     app.sched = JobManager(context_function=app.app_context)
 
     if is_testing:
@@ -4,10 +4,9 @@
 
 import logging
 import asyncio
-import string
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-import asyncpg
 import aiohttp
 from redis import asyncio as aioredis
 
@@ -37,7 +36,14 @@ import api.bp.frontend
 
 from api.errors import APIError, Banned
 from api.common.utils import LockStorage
+from api.common.shortname import ShortnameAllocator
+from api.common.usage import spawn_usage_janitor
+from api.common.stats import spawn_stats_reconciler
+from api.bp.upload.scan_queue import spawn_scan_queue
 from api.storage import Storage
+from api.blobstore import create_blobstore
+from api.clamd import ClamdClient, DEFAULT_ADDRESS as DEFAULT_CLAMD_ADDRESS
+from api.database import create_pool
 from api.jobs import JobManager
 
 import api.bp.metrics.blueprint
@@ -209,9 +215,8 @@ def _setup_working_directory_folders():
     thumbnail_dir.mkdir(exist_ok=True)
     dump_dir.mkdir(exist_ok=True)
 
-    hexadecimal_alphabet = string.digits + "abcdef"
-    for letter in hexadecimal_alphabet:
-        (image_dir / letter).mkdir(exist_ok=True)
+    # shard folders of the image folder are made as files go in them,
+    # see IMAGE_SHARDS
 
 
 @app.before_serving
@@ -223,12 +228,16 @@ async def app_before_serving():
     except AttributeError:
         app.loop = asyncio.get_event_loop()
 
+    # an explicit default executor, so its queue depth can be measured
+    app.executor = ThreadPoolExecutor()
+    app.loop.set_default_executor(app.executor)
+
     app.sched = JobManager(context_function=app.app_context)
 
     app.session = aiohttp.ClientSession(loop=app.loop)
 
     log.info("connecting to db")
-    app.db = await asyncpg.create_pool(**config.db)
+    app.db = await create_pool(config)
     await api.bp.cors.setup()
 
     log.info("connecting to redis")
@@ -241,7 +250,16 @@ async def app_before_serving():
     app.redis = aioredis.Redis(connection_pool=app.redis_pool)
 
     app.storage = Storage(app)
+    app.blobs = create_blobstore(app)
     app.locks = LockStorage()
+    app.shortnames = ShortnameAllocator(app)
+
+    # connections to clamd are only made once files are scanned
+    app.clamd = ClamdClient(
+        getattr(app.econfig, "CLAMD_ADDRESS", DEFAULT_CLAMD_ADDRESS),
+        pool_size=getattr(app.econfig, "CLAMD_POOL_SIZE", 4),
+        timeout=getattr(app.econfig, "CLAMD_TIMEOUT", 60),
+    )
 
     # keep an app-level resolver instead of instantiate
     # on every check_email call
@@ -264,6 +282,9 @@ async def app_before_serving():
 
     api.bp.datadump.start_tasks()
     await api.common.spawn_thumbnail_janitor()
+    await spawn_usage_janitor()
+    await spawn_stats_reconciler()
+    await spawn_scan_queue()
 
 
 @app.after_serving
@@ -276,8 +297,10 @@ async def app_after_serving():
 
     app.sched.stop()
     await app.session.close()
+    await app.clamd.close()
 
     await api.bp.metrics.blueprint.close_worker()
+    app.executor.shutdown(wait=False)
 
 
 set_blueprints(app)
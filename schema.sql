@@ -1,3 +1,6 @@
+-- used for the admin search indexes
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
 -- Thank you FrostLuma for giving those functions
 -- convert Discord snowflake to timestamp
 CREATE OR REPLACE FUNCTION snowflake_time (snowflake BIGINT)
@@ -58,6 +61,14 @@ CREATE TABLE IF NOT EXISTS users (
     shorten_domain bigint REFERENCES domains (domain_id) DEFAULT NULL
 );
 
+-- admin search (api/common/search.py)
+CREATE INDEX IF NOT EXISTS users_username_trgm_idx
+    ON users USING gin (username gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS users_user_id_trgm_idx
+    ON users USING gin ((user_id::text) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS domains_domain_trgm_idx
+    ON domains USING gin (domain gin_trgm_ops);
+
 CREATE TABLE IF NOT EXISTS admin_user_settings (
     user_id bigint REFERENCES users (user_id) ON DELETE CASCADE,
 
@@ -191,6 +202,11 @@ CREATE TABLE IF NOT EXISTS current_dump_state (
     total_files bigint,
     files_done bigint,
 
+    -- dumps that fail are retried, with a backoff
+    attempts integer NOT NULL DEFAULT 0,
+    next_attempt timestamp without time zone
+        NOT NULL DEFAULT (now() at time zone 'utc'),
+
     PRIMARY KEY (user_id)
 );
 
@@ -199,3 +215,496 @@ CREATE TABLE IF NOT EXISTS dump_queue (
     request_timestamp timestamp without time zone default now(),
     PRIMARY KEY (user_id)
 );
+
+-- files whose virus scan took too long to be done while they
+-- were uploaded, and are scanned in the background instead.
+-- a file is pending a scan while it is in here.
+CREATE TABLE IF NOT EXISTS scan_queue (
+    file_id bigint REFERENCES files (file_id) ON DELETE CASCADE,
+
+    -- failed scans are retried, with a backoff
+    attempts integer NOT NULL DEFAULT 0,
+
+    -- when the file can be claimed next. claiming it pushes this
+    -- forward, so files of workers that died get claimed again.
+    next_attempt timestamp without time zone
+        NOT NULL DEFAULT (now() at time zone 'utc'),
+
+    queued_at timestamp without time zone
+        NOT NULL DEFAULT (now() at time zone 'utc'),
+
+    PRIMARY KEY (file_id)
+);
+
+CREATE INDEX IF NOT EXISTS scan_queue_next_attempt_idx
+    ON scan_queue (next_attempt);
+
+-- hour number of a snowflake, used to bucket the usage ledger
+CREATE OR REPLACE FUNCTION usage_bucket (snowflake BIGINT)
+    RETURNS BIGINT AS $$
+BEGIN
+    RETURN (snowflake >> 22) / 3600000;
+END; $$
+LANGUAGE PLPGSQL IMMUTABLE;
+
+-- rolling usage ledger, in hourly buckets (see api/common/usage.py)
+-- maintained by the triggers below.
+CREATE TABLE IF NOT EXISTS user_usage (
+    user_id bigint REFERENCES users (user_id) ON DELETE CASCADE,
+    bucket bigint NOT NULL,
+    bytes_used bigint NOT NULL DEFAULT 0,
+    shortens_used bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, bucket)
+);
+
+CREATE OR REPLACE FUNCTION files_usage_update ()
+    RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE user_usage
+        SET bytes_used = bytes_used - COALESCE(OLD.file_size, 0)
+        WHERE user_id = OLD.uploader
+          AND bucket = usage_bucket(OLD.file_id);
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.uploader IS NOT NULL THEN
+        INSERT INTO user_usage (user_id, bucket, bytes_used)
+        VALUES (NEW.uploader, usage_bucket(NEW.file_id), COALESCE(NEW.file_size, 0))
+        ON CONFLICT (user_id, bucket) DO UPDATE
+            SET bytes_used = user_usage.bytes_used + EXCLUDED.bytes_used;
+    END IF;
+
+    RETURN NULL;
+END; $$
+LANGUAGE PLPGSQL;
+
+CREATE OR REPLACE FUNCTION shortens_usage_update ()
+    RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE user_usage
+        SET shortens_used = shortens_used - 1
+        WHERE user_id = OLD.uploader
+          AND bucket = usage_bucket(OLD.shorten_id);
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.uploader IS NOT NULL THEN
+        INSERT INTO user_usage (user_id, bucket, shortens_used)
+        VALUES (NEW.uploader, usage_bucket(NEW.shorten_id), 1)
+        ON CONFLICT (user_id, bucket) DO UPDATE
+            SET shortens_used = user_usage.shortens_used + 1;
+    END IF;
+
+    RETURN NULL;
+END; $$
+LANGUAGE PLPGSQL;
+
+DROP TRIGGER IF EXISTS files_usage ON files;
+CREATE TRIGGER files_usage
+    AFTER INSERT OR DELETE OR UPDATE OF uploader, file_size ON files
+    FOR EACH ROW EXECUTE PROCEDURE files_usage_update();
+
+DROP TRIGGER IF EXISTS shortens_usage ON shortens;
+CREATE TRIGGER shortens_usage
+    AFTER INSERT OR DELETE OR UPDATE OF uploader ON shortens
+    FOR EACH ROW EXECUTE PROCEDURE shortens_usage_update();
+
+-- precomputed statistics (see api/common/stats.py), maintained by
+-- the triggers below and reconciled periodically with reconcile_stats().
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id bigint REFERENCES users (user_id) ON DELETE CASCADE,
+    total_files bigint NOT NULL DEFAULT 0,
+    total_deleted_files bigint NOT NULL DEFAULT 0,
+    total_bytes bigint NOT NULL DEFAULT 0,
+    total_shortens bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id)
+);
+
+-- per domain, split by the consent of the uploaders,
+-- so public stats only need the consented = true row.
+CREATE TABLE IF NOT EXISTS domain_stats (
+    domain_id bigint REFERENCES domains (domain_id) ON DELETE CASCADE,
+    consented boolean NOT NULL,
+
+    users bigint NOT NULL DEFAULT 0,
+
+    -- files and bytes only count non-deleted files
+    files bigint NOT NULL DEFAULT 0,
+    bytes bigint NOT NULL DEFAULT 0,
+
+    shortens bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY (domain_id, consented)
+);
+
+CREATE OR REPLACE FUNCTION user_consented (uid BIGINT)
+    RETURNS BOOLEAN AS $$
+BEGIN
+    RETURN COALESCE(
+        (SELECT consented IS TRUE FROM users WHERE user_id = uid),
+        false
+    );
+END; $$
+LANGUAGE PLPGSQL STABLE;
+
+CREATE OR REPLACE FUNCTION files_stats_update ()
+    RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE user_stats
+        SET total_files = total_files - 1,
+            total_deleted_files = total_deleted_files
+                - (CASE WHEN OLD.deleted THEN 1 ELSE 0 END),
+            total_bytes = total_bytes - COALESCE(OLD.file_size, 0)
+        WHERE user_id = OLD.uploader;
+
+        IF OLD.deleted = false THEN
+            UPDATE domain_stats
+            SET files = files - 1,
+                bytes = bytes - COALESCE(OLD.file_size, 0)
+            WHERE domain_id = OLD.domain
+              AND consented = user_consented(OLD.uploader);
+        END IF;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        IF NEW.uploader IS NOT NULL THEN
+            INSERT INTO user_stats
+                (user_id, total_files, total_deleted_files, total_bytes)
+            VALUES
+                (NEW.uploader, 1, CASE WHEN NEW.deleted THEN 1 ELSE 0 END,
+                 COALESCE(NEW.file_size, 0))
+            ON CONFLICT (user_id) DO UPDATE
+                SET total_files = user_stats.total_files + 1,
+                    total_deleted_files = user_stats.total_deleted_files
+                        + EXCLUDED.total_deleted_files,
+                    total_bytes = user_stats.total_bytes + EXCLUDED.total_bytes;
+        END IF;
+
+        IF NEW.deleted = false AND NEW.domain IS NOT NULL THEN
+            INSERT INTO domain_stats (domain_id, consented, files, bytes)
+            VALUES (NEW.domain, user_consented(NEW.uploader),
+                    1, COALESCE(NEW.file_size, 0))
+            ON CONFLICT (domain_id, consented) DO UPDATE
+                SET files = domain_stats.files + 1,
+                    bytes = domain_stats.bytes + EXCLUDED.bytes;
+        END IF;
+    END IF;
+
+    RETURN NULL;
+END; $$
+LANGUAGE PLPGSQL;
+
+CREATE OR REPLACE FUNCTION shortens_stats_update ()
+    RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE user_stats
+        SET total_shortens = total_shortens - 1
+        WHERE user_id = OLD.uploader;
+
+        UPDATE domain_stats
+        SET shortens = shortens - 1
+        WHERE domain_id = OLD.domain
+          AND consented = user_consented(OLD.uploader);
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        IF NEW.uploader IS NOT NULL THEN
+            INSERT INTO user_stats (user_id, total_shortens)
+            VALUES (NEW.uploader, 1)
+            ON CONFLICT (user_id) DO UPDATE
+                SET total_shortens = user_stats.total_shortens + 1;
+        END IF;
+
+        IF NEW.domain IS NOT NULL THEN
+            INSERT INTO domain_stats (domain_id, consented, shortens)
+            VALUES (NEW.domain, user_consented(NEW.uploader), 1)
+            ON CONFLICT (domain_id, consented) DO UPDATE
+                SET shortens = domain_stats.shortens + 1;
+        END IF;
+    END IF;
+
+    RETURN NULL;
+END; $$
+LANGUAGE PLPGSQL;
+
+CREATE OR REPLACE FUNCTION users_stats_update ()
+    RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE domain_stats
+        SET users = users - 1
+        WHERE domain_id = OLD.domain
+          AND consented = (OLD.consented IS TRUE);
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.domain IS NOT NULL THEN
+        INSERT INTO domain_stats (domain_id, consented, users)
+        VALUES (NEW.domain, NEW.consented IS TRUE, 1)
+        ON CONFLICT (domain_id, consented) DO UPDATE
+            SET users = domain_stats.users + 1;
+    END IF;
+
+    -- when consent changes, everything the user uploaded
+    -- moves between the consented and non-consented rows.
+    IF TG_OP = 'UPDATE'
+       AND (OLD.consented IS TRUE) <> (NEW.consented IS TRUE) THEN
+        UPDATE domain_stats
+        SET files = domain_stats.files - agg.files,
+            bytes = domain_stats.bytes - agg.bytes
+        FROM (
+            SELECT domain, COUNT(*) AS files,
+                   COALESCE(SUM(file_size), 0) AS bytes
+            FROM files
+            WHERE uploader = NEW.user_id AND deleted = false
+            GROUP BY domain
+        ) AS agg
+        WHERE domain_stats.domain_id = agg.domain
+          AND domain_stats.consented = (OLD.consented IS TRUE);
+
+        INSERT INTO domain_stats (domain_id, consented, files, bytes)
+        SELECT domain, NEW.consented IS TRUE, COUNT(*),
+               COALESCE(SUM(file_size), 0)
+        FROM files
+        WHERE uploader = NEW.user_id AND deleted = false
+          AND domain IS NOT NULL
+        GROUP BY domain
+        ON CONFLICT (domain_id, consented) DO UPDATE
+            SET files = domain_stats.files + EXCLUDED.files,
+                bytes = domain_stats.bytes + EXCLUDED.bytes;
+
+        UPDATE domain_stats
+        SET shortens = domain_stats.shortens - agg.shortens
+        FROM (
+            SELECT domain, COUNT(*) AS shortens
+            FROM shortens
+            WHERE uploader = NEW.user_id
+            GROUP BY domain
+        ) AS agg
+        WHERE domain_stats.domain_id = agg.domain
+          AND domain_stats.consented = (OLD.consented IS TRUE);
+
+        INSERT INTO domain_stats (domain_id, consented, shortens)
+        SELECT domain, NEW.consented IS TRUE, COUNT(*)
+        FROM shortens
+        WHERE uploader = NEW.user_id AND domain IS NOT NULL
+        GROUP BY domain
+        ON CONFLICT (domain_id, consented) DO UPDATE
+            SET shortens = domain_stats.shortens + EXCLUDED.shortens;
+    END IF;
+
+    RETURN NULL;
+END; $$
+LANGUAGE PLPGSQL;
+
+-- fix any drift of the statistics, without locking the tables.
+--
+-- the drift is taken out of a single snapshot, where the statistics
+-- and what they count are consistent with each other, and applied
+-- as a delta. so changes committed meanwhile, which the triggers
+-- apply as deltas too, are kept, and only drifting rows get locked.
+CREATE OR REPLACE FUNCTION reconcile_stats ()
+    RETURNS VOID AS $$
+BEGIN
+    WITH actual AS (
+        SELECT uploader AS user_id,
+               SUM(total_files)::bigint AS total_files,
+               SUM(total_deleted_files)::bigint AS total_deleted_files,
+               SUM(total_bytes)::bigint AS total_bytes,
+               SUM(total_shortens)::bigint AS total_shortens
+        FROM (
+            SELECT uploader, COUNT(*) AS total_files,
+                   COUNT(*) FILTER (WHERE deleted = true) AS total_deleted_files,
+                   COALESCE(SUM(file_size), 0) AS total_bytes,
+                   0 AS total_shortens
+            FROM files
+            WHERE uploader IS NOT NULL
+            GROUP BY uploader
+
+            UNION ALL
+
+            SELECT uploader, 0, 0, 0, COUNT(*)
+            FROM shortens
+            WHERE uploader IS NOT NULL
+            GROUP BY uploader
+        ) AS counts
+        GROUP BY uploader
+    ), drift AS (
+        SELECT COALESCE(actual.user_id, user_stats.user_id) AS user_id,
+               COALESCE(actual.total_files, 0)
+                - COALESCE(user_stats.total_files, 0) AS total_files,
+               COALESCE(actual.total_deleted_files, 0)
+                - COALESCE(user_stats.total_deleted_files, 0)
+                AS total_deleted_files,
+               COALESCE(actual.total_bytes, 0)
+                - COALESCE(user_stats.total_bytes, 0) AS total_bytes,
+               COALESCE(actual.total_shortens, 0)
+                - COALESCE(user_stats.total_shortens, 0) AS total_shortens
+        FROM actual
+        FULL JOIN user_stats
+          ON user_stats.user_id = actual.user_id
+    )
+    INSERT INTO user_stats
+        (user_id, total_files, total_deleted_files, total_bytes, total_shortens)
+    SELECT user_id, total_files, total_deleted_files, total_bytes, total_shortens
+    FROM drift
+    WHERE (total_files, total_deleted_files, total_bytes, total_shortens)
+        <> (0, 0, 0, 0)
+    ON CONFLICT (user_id) DO UPDATE
+        SET total_files = user_stats.total_files + EXCLUDED.total_files,
+            total_deleted_files = user_stats.total_deleted_files
+                + EXCLUDED.total_deleted_files,
+            total_bytes = user_stats.total_bytes + EXCLUDED.total_bytes,
+            total_shortens = user_stats.total_shortens
+                + EXCLUDED.total_shortens;
+
+    -- like the triggers, what has no uploader counts as not consented
+    WITH actual AS (
+        SELECT domain_id, consented,
+               SUM(users)::bigint AS users,
+               SUM(files)::bigint AS files,
+               SUM(bytes)::bigint AS bytes,
+               SUM(shortens)::bigint AS shortens
+        FROM (
+            SELECT domain AS domain_id, consented IS TRUE AS consented,
+                   COUNT(*) AS users, 0 AS files, 0 AS bytes, 0 AS shortens
+            FROM users
+            WHERE domain IS NOT NULL
+            GROUP BY domain, consented IS TRUE
+
+            UNION ALL
+
+            SELECT files.domain, users.consented IS TRUE, 0, COUNT(*),
+                   COALESCE(SUM(files.file_size), 0), 0
+            FROM files
+            LEFT JOIN users
+              ON users.user_id = files.uploader
+            WHERE files.deleted = false AND files.domain IS NOT NULL
+            GROUP BY files.domain, users.consented IS TRUE
+
+            UNION ALL
+
+            SELECT shortens.domain, users.consented IS TRUE, 0, 0, 0, COUNT(*)
+            FROM shortens
+            LEFT JOIN users
+              ON users.user_id = shortens.uploader
+            WHERE shortens.domain IS NOT NULL
+            GROUP BY shortens.domain, users.consented IS TRUE
+        ) AS counts
+        GROUP BY domain_id, consented
+    ), drift AS (
+        SELECT COALESCE(actual.domain_id, domain_stats.domain_id) AS domain_id,
+               COALESCE(actual.consented, domain_stats.consented) AS consented,
+               COALESCE(actual.users, 0)
+                - COALESCE(domain_stats.users, 0) AS users,
+               COALESCE(actual.files, 0)
+                - COALESCE(domain_stats.files, 0) AS files,
+               COALESCE(actual.bytes, 0)
+                - COALESCE(domain_stats.bytes, 0) AS bytes,
+               COALESCE(actual.shortens, 0)
+                - COALESCE(domain_stats.shortens, 0) AS shortens
+        FROM actual
+        FULL JOIN domain_stats
+          ON domain_stats.domain_id = actual.domain_id
+         AND domain_stats.consented = actual.consented
+    )
+    INSERT INTO domain_stats (domain_id, consented, users, files, bytes, shortens)
+    SELECT domain_id, consented, users, files, bytes, shortens
+    FROM drift
+    WHERE (users, files, bytes, shortens) <> (0, 0, 0, 0)
+    ON CONFLICT (domain_id, consented) DO UPDATE
+        SET users = domain_stats.users + EXCLUDED.users,
+            files = domain_stats.files + EXCLUDED.files,
+            bytes = domain_stats.bytes + EXCLUDED.bytes,
+            shortens = domain_stats.shortens + EXCLUDED.shortens;
+END; $$
+LANGUAGE PLPGSQL;
+
+DROP TRIGGER IF EXISTS files_stats ON files;
+CREATE TRIGGER files_stats
+    AFTER INSERT OR DELETE OR UPDATE OF uploader, file_size, deleted, domain
+    ON files
+    FOR EACH ROW EXECUTE PROCEDURE files_stats_update();
+
+DROP TRIGGER IF EXISTS shortens_stats ON shortens;
+CREATE TRIGGER shortens_stats
+    AFTER INSERT OR DELETE OR UPDATE OF uploader, domain ON shortens
+    FOR EACH ROW EXECUTE PROCEDURE shortens_stats_update();
+
+DROP TRIGGER IF EXISTS users_stats ON users;
+CREATE TRIGGER users_stats
+    AFTER INSERT OR DELETE OR UPDATE OF domain, consented ON users
+    FOR EACH ROW EXECUTE PROCEDURE users_stats_update();
+
+-- stored objects, deduplicated by their content. files refer to
+-- their blob by fspath, which is where the blob is stored.
+CREATE TABLE IF NOT EXISTS blobs (
+    -- sha256 of the contents
+    hash text NOT NULL,
+
+    -- the same contents can be stored with different extensions
+    extension text NOT NULL DEFAULT '',
+
+    fspath text UNIQUE NOT NULL,
+    size bigint NOT NULL,
+    mimetype text,
+
+    -- crc32 of the contents, for streamed data dumps.
+    -- NULL until known, for blobs stored before it was kept.
+    crc bigint,
+
+    -- how many non-deleted files refer to this blob,
+    -- maintained by the trigger below.
+    refcount bigint NOT NULL DEFAULT 0,
+
+    created_at timestamp without time zone default (now() at time zone 'utc'),
+    PRIMARY KEY (hash, extension)
+);
+
+CREATE INDEX IF NOT EXISTS files_fspath_idx ON files (fspath);
+
+CREATE OR REPLACE FUNCTION files_blobs_update ()
+    RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.deleted = false THEN
+        UPDATE blobs
+        SET refcount = refcount - 1
+        WHERE fspath = OLD.fspath;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.deleted = false THEN
+        UPDATE blobs
+        SET refcount = refcount + 1
+        WHERE fspath = NEW.fspath;
+    END IF;
+
+    RETURN NULL;
+END; $$
+LANGUAGE PLPGSQL;
+
+-- fix any drift of blob refcounts, without locking the tables.
+-- same as reconcile_stats, the drift is taken out of a single
+-- snapshot and applied as a delta.
+CREATE OR REPLACE FUNCTION reconcile_blobs ()
+    RETURNS VOID AS $$
+BEGIN
+    UPDATE blobs
+    SET refcount = blobs.refcount + drift.delta
+    FROM (
+        SELECT blobs.fspath,
+               COUNT(files.file_id) - blobs.refcount AS delta
+        FROM blobs
+        LEFT JOIN files
+          ON files.fspath = blobs.fspath
+         AND files.deleted = false
+        GROUP BY blobs.fspath, blobs.refcount
+    ) AS drift
+    WHERE blobs.fspath = drift.fspath
+      AND drift.delta <> 0;
+END; $$
+LANGUAGE PLPGSQL;
+
+DROP TRIGGER IF EXISTS files_blobs ON files;
+CREATE TRIGGER files_blobs
+    AFTER INSERT OR DELETE OR UPDATE OF fspath, deleted ON files
+    FOR EACH ROW EXECUTE PROCEDURE files_blobs_update();
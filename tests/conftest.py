@@ -206,3 +206,20 @@ async def test_cli_admin(test_cli, test_user_admin):
         await _set_owner(0, old_owner_id)
 
     await client.cleanup()
+
+
+@pytest.fixture(name="clamd")
+async def clamd_fixture():
+    """Yield a fake clamd server, listening on fake.address."""
+    fake = tests.util.mock.FakeClamd()
+    server = await asyncio.start_server(fake.handle, "127.0.0.1", 0)
+    fake.address = server.sockets[0].getsockname()[:2]
+
+    yield fake
+
+    server.close()
+    fake.disconnect()
+
+    for task in fake.tasks:
+        task.cancel()
+    await asyncio.gather(*fake.tasks, return_exceptions=True)
@@ -4,6 +4,8 @@
 
 import pytest
 
+from api.common.search import USER_SEARCH
+
 pytestmark = pytest.mark.asyncio
 
 
@@ -119,6 +121,96 @@ async def test_user_search(test_cli_admin):
     assert isinstance(pag["current"], int)
 
 
+async def test_user_search_keyset(test_cli_admin):
+    """Test paginating user search with the ?after cursor."""
+    resp = await test_cli_admin.get(
+        "/api/admin/users/search", query_string={"per_page": 1}
+    )
+
+    assert resp.status_code == 200
+    rjson = await resp.json
+    first_page = rjson["results"]
+    cursor = rjson["pagination"]["next"]
+    assert len(first_page) == 1
+    assert cursor == first_page[0]["user_id"]
+
+    resp = await test_cli_admin.get(
+        "/api/admin/users/search", query_string={"per_page": 1, "after": cursor}
+    )
+
+    assert resp.status_code == 200
+    rjson = await resp.json
+
+    for user in rjson["results"]:
+        assert int(user["user_id"]) > int(cursor)
+
+
+async def test_user_search_bad_cursor(test_cli_admin):
+    for cursor in ("abc", "-1", str(1 << 64)):
+        resp = await test_cli_admin.get(
+            "/api/admin/users/search", query_string={"after": cursor}
+        )
+        assert resp.status_code == 400
+
+        resp = await test_cli_admin.get(
+            "/api/admin/listusers/0", query_string={"after": cursor}
+        )
+        assert resp.status_code == 400
+
+    # ranked searches can't be paginated by ID
+    resp = await test_cli_admin.get(
+        "/api/admin/users/search", query_string={"query": "a", "after": "1"}
+    )
+    assert resp.status_code == 400
+
+
+async def test_user_search_indexed(test_cli_admin):
+    """Seed a large amount of users and make sure a ranked search over
+    them is served from the trigram indexes."""
+    seed_count = 50000
+
+    # user ids way past any real snowflake so we don't collide
+    base_id = 1 << 62
+
+    async with test_cli_admin.app.app_context():
+        db = test_cli_admin.app.db
+        await db.execute(
+            """
+        INSERT INTO users (user_id, username, email, password_hash)
+        SELECT $1::bigint + g, 'elixire-bench-' || g,
+               'bench-' || g || '@bench.invalid', ''
+        FROM generate_series(1, $2) AS g
+        """,
+            base_id,
+            seed_count,
+        )
+        await db.execute("ANALYZE users")
+
+    try:
+        resp = await test_cli_admin.get(
+            "/api/admin/users/search",
+            query_string={"query": "elixire-bench-4242", "per_page": 5},
+        )
+
+        assert resp.status_code == 200
+        rjson = await resp.json
+
+        # the exact prefix match ranks first
+        assert rjson["results"][0]["username"] == "elixire-bench-4242"
+
+        # the query search_users runs
+        async with test_cli_admin.app.app_context():
+            plan = await db.fetch(
+                f"EXPLAIN {USER_SEARCH}", True, "elixire-bench-4242", 5, 0
+            )
+
+        plan = "\n".join(row[0] for row in plan)
+        assert "users_username_trgm_idx" in plan, plan
+    finally:
+        async with test_cli_admin.app.app_context():
+            await db.execute("DELETE FROM users WHERE user_id > $1", base_id)
+
+
 async def test_domain_search(test_cli_admin):
     def assert_standard_response(json):
         assert isinstance(json, dict)
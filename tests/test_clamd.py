@@ -0,0 +1,104 @@
+# elixire: Image Host software
+# Copyright 2018-2019, elixi.re Team and the elixire contributors
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import asyncio
+import io
+
+import pytest
+
+from api.clamd import ClamdClient, ClamdConnectionError, ClamdError
+from tests.util.mock import EICAR
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_clamd_scan(clamd):
+    client = ClamdClient(clamd.address)
+
+    assert await client.scan_stream(io.BytesIO(b"a clean file" * 10000)) is None
+    assert await client.scan_stream(io.BytesIO(EICAR)) == "Eicar-Signature"
+
+    # both scans went through the same connection
+    assert clamd.connections == 1
+
+    clamd.max_length = 16
+    with pytest.raises(ClamdError):
+        await client.scan_stream(io.BytesIO(b"a file too big for clamd"))
+
+    await client.close()
+
+
+async def test_clamd_scan_file(clamd, tmp_path):
+    client = ClamdClient(clamd.address)
+
+    # files on disk are read in the executor
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"a clean file" * 10000 + EICAR)
+    with path.open("rb") as stream:
+        assert await client.scan_stream(stream) == "Eicar-Signature"
+
+    await client.close()
+
+
+async def test_clamd_version(clamd, monkeypatch):
+    client = ClamdClient(clamd.address)
+    assert await client.version() == "26830"
+
+    # kept around until it expires
+    clamd.signatures = 26831
+    assert await client.version() == "26830"
+
+    monkeypatch.setattr("api.clamd.VERSION_TTL", 0)
+    client._version = None
+    assert await client.version() == "26831"
+    assert await client.version() == "26831"
+
+
+async def test_clamd_reconnect(clamd):
+    client = ClamdClient(clamd.address)
+    assert await client.scan_stream(io.BytesIO(b"clean")) is None
+
+    # like clamd closing idle sessions
+    clamd.disconnect()
+    await asyncio.sleep(0.01)
+
+    stream = io.BytesIO(b"prefix" + EICAR)
+    stream.seek(6)
+    assert await client.scan_stream(stream) == "Eicar-Signature"
+    assert clamd.connections == 2
+
+    await client.close()
+
+
+async def test_clamd_concurrency(clamd):
+    clamd.delay = 0.05
+    client = ClamdClient(clamd.address, pool_size=2)
+
+    results = await asyncio.gather(
+        *(client.scan_stream(io.BytesIO(b"clean")) for _ in range(6))
+    )
+    assert results == [None] * 6
+    assert clamd.connections == 2
+
+    await client.close()
+
+
+async def test_clamd_timeout(clamd):
+    clamd.delay = 1
+    client = ClamdClient(clamd.address, timeout=0.05)
+
+    with pytest.raises(ClamdConnectionError):
+        await client.scan_stream(io.BytesIO(b"clean"))
+
+    # the session that timed out isn't reused
+    assert not client.idle
+
+    await client.close()
+
+
+async def test_clamd_unavailable(tmp_path):
+    client = ClamdClient(str(tmp_path / "clamd.ctl"))
+
+    with pytest.raises(ClamdConnectionError):
+        await client.scan_stream(io.BytesIO(b"clean"))
@@ -0,0 +1,51 @@
+# elixire: Image Host software
+# Copyright 2018-2022, elixi.re Team and the elixire contributors
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import pytest
+
+from api.statements import STATEMENTS
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_statements_prepared(app, test_cli_user):
+    # every connection prepares every statement when it's created
+    async with app.db.acquire() as conn:
+        assert set(conn.statements) == set(STATEMENTS)
+
+    user_id = test_cli_user.id
+    assert await app.db.fetchval_stmt("username", user_id) == test_cli_user.username
+    assert await app.db.fetchval_stmt("user_admin", user_id) is False
+
+    row = await app.db.fetchrow_stmt("user_ban", user_id)
+    assert row is None
+
+
+async def test_statement_outdated(app, monkeypatch):
+    monkeypatch.setitem(STATEMENTS, "stmt_test", "SELECT * FROM stmt_test")
+
+    async with app.db.acquire() as conn:
+        await conn.execute("CREATE TABLE stmt_test (a int)")
+
+        try:
+            await conn.execute("INSERT INTO stmt_test (a) VALUES (1)")
+            conn.statements["stmt_test"] = await conn.prepare(STATEMENTS["stmt_test"])
+
+            class _Acquire:
+                async def __aenter__(self):
+                    return conn
+
+                async def __aexit__(self, *exc):
+                    pass
+
+            monkeypatch.setattr(app.db, "acquire", lambda **kwargs: _Acquire())
+
+            # changes the result type of the prepared statement
+            await conn.execute("ALTER TABLE stmt_test ADD COLUMN b int")
+
+            row = await app.db.fetchrow_stmt("stmt_test")
+            assert dict(row) == {"a": 1, "b": None}
+        finally:
+            conn.statements.pop("stmt_test", None)
+            await conn.execute("DROP TABLE stmt_test")
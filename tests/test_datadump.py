@@ -3,15 +3,19 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 
 import asyncio
+import io
 import os
 import json
 import zipfile
+import zlib
 import logging
 import pytest
 from urllib.parse import parse_qs
 from pathlib import Path
 
+from api.bp.datadump import tasks
 from api.bp.datadump.tasks import dump_janitor
+from api.bp.datadump.zipstream import LOCAL_HEADER, ZipStream
 
 from tests.test_upload import png_request
 from tests.util.helpers import extract_first_url
@@ -113,3 +117,250 @@ async def test_datadump(test_cli, test_cli_user):
             zip_path.unlink()
         except Exception as err:
             log.exception("failed to remove test user dump file: %r", err)
+
+
+async def test_dump_files_batched(test_cli_user, tmp_path, monkeypatch):
+    monkeypatch.setattr(tasks, "DUMP_BATCH", 2)
+    monkeypatch.setattr(tasks, "DUMP_CHECKPOINT_FILES", 2)
+
+    # the test user is shared, so only dump the files uploaded here
+    shortnames = [(await upload_test_png(test_cli_user))["shortname"] for _ in range(3)]
+
+    app = test_cli_user.app
+    user_id = test_cli_user.id
+
+    async with app.app_context():
+        rows = await app.db.fetch(
+            "SELECT file_id FROM files WHERE filename = ANY($1::text[]) "
+            "ORDER BY file_id",
+            shortnames,
+        )
+        file_ids = [row["file_id"] for row in rows]
+
+        await app.db.execute(
+            """
+            INSERT INTO current_dump_state (user_id, current_id, total_files, files_done)
+            VALUES ($1, $2, $3, 0)
+            """,
+            user_id,
+            file_ids[0],
+            len(file_ids),
+        )
+
+        try:
+            zip_path = tmp_path / "dump.zip"
+            with zipfile.ZipFile(zip_path, "w") as zipdump:
+                await tasks.dump_files(zipdump, user_id, file_ids[0], 0)
+
+            with zipfile.ZipFile(zip_path, "r") as zipdump:
+                names = zipdump.namelist()
+                infos = zipdump.infolist()
+
+            # pngs are already compressed, so they're stored as-is
+            assert all(info.compress_type == zipfile.ZIP_STORED for info in infos)
+
+            assert len(names) == len(file_ids)
+            for file_id in file_ids:
+                assert any(name.startswith(f"files/{file_id}_") for name in names)
+
+            # the last file written is what resume_dump continues from
+            state = await app.db.fetchrow(
+                "SELECT current_id, files_done FROM current_dump_state "
+                "WHERE user_id = $1",
+                user_id,
+            )
+            assert state["current_id"] == file_ids[-1]
+            assert state["files_done"] == len(file_ids)
+        finally:
+            await app.db.execute(
+                "DELETE FROM current_dump_state WHERE user_id = $1", user_id
+            )
+
+
+async def test_dump_zip_recovered(tmp_path):
+    zip_path = tmp_path / "dump.zip"
+    payloads = {f"files/{idx}_file.txt": os.urandom(2048) * 4 for idx in range(3)}
+
+    with zipfile.ZipFile(zip_path, "w") as zipdump:
+        for name, data in payloads.items():
+            zipdump.writestr(name, data, compress_type=zipfile.ZIP_DEFLATED)
+
+    with zipfile.ZipFile(zip_path, "r") as zipdump:
+        last = zipdump.infolist()[-1]
+
+    # like a worker that died while writing the last file,
+    # before the central directory was there
+    with open(zip_path, "r+b") as fhandle:
+        fhandle.truncate(last.header_offset + 40)
+
+    zipdump = tasks._reopen_zip(str(zip_path))
+    try:
+        assert zipdump.namelist() == list(payloads)[:2]
+        assert tasks._has_entry(zipdump, "./files/0_file.txt")
+        assert not tasks._has_entry(zipdump, "./files/2_file.txt")
+
+        zipdump.writestr("files/2_file.txt", payloads["files/2_file.txt"])
+    finally:
+        zipdump.close()
+
+    with zipfile.ZipFile(zip_path, "r") as zipdump:
+        assert zipdump.testzip() is None
+        assert zipdump.namelist() == list(payloads)
+        for name, data in payloads.items():
+            assert zipdump.read(name) == data
+
+
+async def test_dump_retry_backoff(test_cli_user, monkeypatch):
+    app = test_cli_user.app
+    user_id = test_cli_user.id
+
+    async def _failed_dump(user_id, resume=False):
+        # do_dump logs errors, leaving the dump in the current state
+        pass
+
+    monkeypatch.setattr(tasks, "do_dump", _failed_dump)
+    monkeypatch.setattr(app.econfig, "DUMP_RETRIES", 2, raising=False)
+
+    async def _attempts():
+        return await app.db.fetchval(
+            "SELECT attempts FROM current_dump_state WHERE user_id = $1", user_id
+        )
+
+    async with app.app_context():
+        await app.db.execute(
+            """
+            INSERT INTO current_dump_state (user_id, current_id, total_files, files_done)
+            VALUES ($1, NULL, 0, 0)
+            """,
+            user_id,
+        )
+
+        try:
+            await tasks.dump_worker()
+            assert await _attempts() == 1
+
+            # not claimed again until the backoff is over
+            await tasks.dump_worker()
+            assert await _attempts() == 1
+
+            await app.db.execute(
+                "UPDATE current_dump_state SET next_attempt = next_attempt "
+                "- interval '1 hour' WHERE user_id = $1",
+                user_id,
+            )
+
+            # given up on after DUMP_RETRIES attempts
+            await tasks.dump_worker()
+            assert await _attempts() is None
+        finally:
+            await app.db.execute(
+                "DELETE FROM current_dump_state WHERE user_id = $1", user_id
+            )
+
+
+async def test_dump_compress_type():
+    assert tasks.compress_type("image/png") == zipfile.ZIP_STORED
+    assert tasks.compress_type("video/mp4") == zipfile.ZIP_STORED
+    assert tasks.compress_type(None) == zipfile.ZIP_STORED
+    assert tasks.compress_type("text/plain") == zipfile.ZIP_DEFLATED
+    assert tasks.compress_type("image/svg+xml") == zipfile.ZIP_DEFLATED
+
+
+async def _read_stream(stream, start=0, stop=None):
+    return b"".join([chunk async for chunk in stream.stream(start, stop)])
+
+
+async def test_zipstream_ranges(tmp_path):
+    data = os.urandom(300 * 1024)
+    fspath = tmp_path / "file.bin"
+    fspath.write_bytes(data)
+
+    def _make():
+        stream = ZipStream()
+        stream.writestr("user_data.json", '{"user_id": "1"}')
+        stream.add_file("./files/1_file.bin", str(fspath), len(data))
+        return stream
+
+    stream = _make()
+    full = await _read_stream(stream)
+    assert len(full) == stream.size
+
+    with zipfile.ZipFile(io.BytesIO(full)) as zipdump:
+        assert zipdump.testzip() is None
+        assert zipdump.read("files/1_file.bin") == data
+        infos = zipdump.infolist()
+
+    # crcs and sizes are in the local headers, without data descriptors
+    for info in infos:
+        assert not info.flag_bits & 0x08
+
+        header = LOCAL_HEADER.unpack_from(full, info.header_offset)
+        assert header[6:9] == (info.CRC, info.file_size, info.file_size)
+
+    # every range is generated on its own, in a new stream
+    for start, stop in ((0, 10), (100, None), (50000, 250000), (len(full) - 30, None)):
+        assert await _read_stream(_make(), start, stop) == full[start:stop]
+
+    assert _make().etag == stream.etag
+
+
+async def test_zipstream_given_crc(tmp_path):
+    data = os.urandom(1024)
+    fspath = tmp_path / "file.bin"
+    fspath.write_bytes(data)
+
+    reads = []
+
+    async def _reader(path, start, end):
+        reads.append((start, end))
+        with open(path, "rb") as fhandle:
+            fhandle.seek(start)
+            return fhandle.read(end - start)
+
+    stream = ZipStream(reader=_reader)
+    stream.add_file("./files/1_file.bin", str(fspath), len(data), crc=zlib.crc32(data))
+
+    full = await _read_stream(stream)
+    with zipfile.ZipFile(io.BytesIO(full)) as zipdump:
+        assert zipdump.read("files/1_file.bin") == data
+
+    # only read once, for its data
+    assert reads == [(0, len(data))]
+
+
+async def test_datadump_streamed(test_cli, test_cli_user, monkeypatch):
+    monkeypatch.setattr(test_cli.app.econfig, "DUMP_MODE", "stream", raising=False)
+
+    elixire_file = await upload_test_png(test_cli_user)
+
+    current_email_count = len(test_cli_user.app._test_email_list)
+    resp = await test_cli_user.post("/api/dump/request")
+    assert resp.status_code == 200
+
+    await wait_for_finished_dump(test_cli.app, current_email_count)
+
+    email = test_cli.app._test_email_list[-1]
+    url = extract_first_url(email["body"])
+    dump_token = parse_qs(url.query)["key"][0]
+
+    resp = await test_cli.get("/api/dump_get", query_string={"key": dump_token})
+    assert resp.status_code == 200
+    assert resp.headers["Accept-Ranges"] == "bytes"
+    full = await resp.get_data()
+    assert int(resp.headers["Content-Length"]) == len(full)
+
+    with zipfile.ZipFile(io.BytesIO(full)) as zipdump:
+        assert zipdump.testzip() is None
+        with zipdump.open("files.json") as files_file:
+            files = json.load(files_file)
+            assert any(f["filename"] == elixire_file["shortname"] for f in files)
+
+    # resume the download from the middle
+    resp = await test_cli.get(
+        "/api/dump_get",
+        query_string={"key": dump_token},
+        headers={"Range": "bytes=100-", "If-Range": resp.headers["ETag"]},
+    )
+    assert resp.status_code == 206
+    assert resp.headers["Content-Range"] == f"bytes 100-{len(full) - 1}/{len(full)}"
+    assert await resp.get_data() == full[100:]
@@ -1,6 +1,9 @@
 # elixire: Image Host software
 # Copyright 2018-2019, elixi.re Team and the elixire contributors
 # SPDX-License-Identifier: AGPL-3.0-only
+import os
+from urllib.parse import urlparse
+
 import pytest
 
 from manage.main import amain
@@ -80,3 +83,84 @@ async def test_file_operations(test_cli_user):
     rjson = await resp.json
     assert new_shortname not in rjson["files"]
     assert old_shortname not in rjson["files"]
+
+
+async def test_reshard_files(test_cli_user, monkeypatch):
+    resp = await test_cli_user.post("/api/upload", **png_request())
+    assert resp.status_code == 200
+    rjson = await resp.json
+    shortname = rjson["shortname"]
+    host = urlparse(rjson["url"]).netloc
+
+    app = test_cli_user.app
+    monkeypatch.setattr(app.econfig, "IMAGE_SHARDS", (2, 2), raising=False)
+
+    _, status = await _run(test_cli_user, ["reshard_files", "--batch-size", "1"])
+    assert status == 0
+
+    row = await app.db.fetchrow(
+        """
+    SELECT blobs.hash, blobs.fspath, blobs.refcount
+    FROM files
+    JOIN blobs ON blobs.fspath = files.fspath
+    WHERE files.filename = $1
+    """,
+        shortname,
+    )
+    assert row is not None
+    assert row["refcount"] >= 1
+
+    file_hash = row["hash"]
+    assert f"/{file_hash[:2]}/{file_hash[2:4]}/{file_hash}" in row["fspath"]
+
+    # the file is still served, from its new path
+    resp = await test_cli_user.get(
+        f"/i/{shortname}.png", do_token=False, headers={"host": host}
+    )
+    assert resp.status_code == 200
+
+
+async def test_reshard_relative_paths(test_cli_user):
+    resp = await test_cli_user.post("/api/upload", **png_request())
+    assert resp.status_code == 200
+    rjson = await resp.json
+    shortname = rjson["shortname"]
+    host = urlparse(rjson["url"]).netloc
+
+    app = test_cli_user.app
+    fspath = await app.db.fetchval(
+        "SELECT fspath FROM files WHERE filename = $1", shortname
+    )
+    relative = os.path.relpath(fspath)
+
+    # like rows from before paths were absolute, e.g "./images/a/..."
+    async with app.db.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                "UPDATE files SET fspath = $2 WHERE fspath = $1", fspath, relative
+            )
+            await conn.execute(
+                "UPDATE blobs SET fspath = $2 WHERE fspath = $1", fspath, relative
+            )
+
+    # the layout didn't change, so nothing is moved, only rewritten
+    _, status = await _run(test_cli_user, ["reshard_files", "--restart"])
+    assert status == 0
+
+    assert os.path.exists(fspath)
+    row = await app.db.fetchrow(
+        """
+    SELECT files.fspath, blobs.refcount
+    FROM files
+    JOIN blobs ON blobs.fspath = files.fspath
+    WHERE files.filename = $1
+    """,
+        shortname,
+    )
+    assert row["fspath"] == fspath
+    assert row["refcount"] >= 1
+
+    resp = await test_cli_user.get(
+        f"/i/{shortname}.png", do_token=False, headers={"host": host}
+    )
+    assert resp.status_code == 200
@@ -0,0 +1,337 @@
+# elixire: Image Host software
+# Copyright 2018-2019, elixi.re Team and the elixire contributors
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import datetime
+from collections import deque
+
+import pytest
+
+from api.bp.metrics.compactor import SEC_NANOSEC, CompactorContext, compact_single
+from api.bp.metrics.histogram import Histograms, series_key
+from api.bp.metrics.prometheus import PrometheusMetrics, merge, render
+from api.bp.metrics.tasks import hourly_tasks
+from api.database import fingerprint
+from api.bp.metrics.uniq import track_uploader, count_uploaders
+
+pytestmark = pytest.mark.asyncio
+
+
+class RecordingMetrics:
+    """Stand-in for MetricsManager that keeps every submitted datapoint."""
+
+    def __init__(self):
+        self.points = {}
+
+    def submit(self, title, value):
+        self.points[title] = value
+
+    def submit_many(self, values: dict):
+        self.points.update(values)
+
+
+async def test_hourly_tasks_queries(app, monkeypatch):
+    """The hourly metrics tick takes every count in a single query."""
+    recorder = RecordingMetrics()
+    monkeypatch.setattr(app, "metrics", recorder)
+
+    queries = []
+    stats = app.db.stats
+    record_query = stats.record_query
+
+    def _record(query, started):
+        queries.append(query)
+        record_query(query, started)
+
+    monkeypatch.setattr(stats, "record_query", _record)
+
+    async with app.app_context():
+        await hourly_tasks()
+
+    for measurement in (
+        "total_files",
+        "total_files_public",
+        "total_size",
+        "total_size_public",
+        "active_users",
+        "consented_users",
+        "inactive_users",
+    ):
+        assert measurement in recorder.points
+
+    assert recorder.points["total_files"] >= 0
+    assert len(queries) == 1
+    assert "FROM files" not in queries[0]
+
+
+async def test_uniq_uploaders(app, monkeypatch):
+    monkeypatch.setattr(app.econfig, "ENABLE_METRICS", True)
+    today = datetime.datetime.utcnow().date()
+
+    # ids that can't be real users, so the test doesn't depend on uploads
+    uploaders = [(1 << 62) + idx for idx in range(3)]
+
+    async with app.app_context():
+        before = await count_uploaders(today)
+        before_pub = await count_uploaders(today, public=True)
+
+        for user_id in uploaders:
+            await track_uploader(user_id, False)
+            await track_uploader(user_id, False)
+
+        await track_uploader(uploaders[0], True)
+
+        assert await count_uploaders(today) == before + len(uploaders)
+        assert await count_uploaders(today, public=True) == before_pub + 1
+
+        # mergeable: the week includes today
+        assert await count_uploaders(today, 7) >= before + len(uploaders)
+
+
+async def test_metrics_buffer(app, monkeypatch):
+    monkeypatch.setattr(app.econfig, "ENABLE_METRICS", True)
+    metrics = app.metrics
+    monkeypatch.setattr(metrics, "points", deque(maxlen=3))
+    monkeypatch.setattr(metrics, "dropped", 0)
+
+    # same-instant datapoints must not overwrite each other
+    metrics.submit_many({"a": 1, "b": 2.5})
+    metrics.submit("a", 3)
+    metrics.submit("c", 4)
+
+    # buffer was full, so the oldest one got dropped
+    assert metrics.dropped == 1
+    assert [point[:2] for point in metrics.points] == [
+        ("b", 2.5),
+        ("a", 3),
+        ("c", 4),
+    ]
+
+    points = metrics._fetch_points(2)
+    assert len(points) == 2
+    assert len(metrics.points) == 1
+
+    lines = metrics._serialize(points).split("\n")
+    assert lines[0].startswith("b value=2.5 ")
+    assert lines[1].startswith("a value=3i ")
+    assert lines[2].startswith("metrics_dropped value=1i ")
+    assert metrics.dropped == 0
+
+
+async def test_latency_histogram():
+    histograms = Histograms("response_latency", ("endpoint", "status"))
+    for latency in range(1, 101):
+        histograms.record(("upload.upload_handler", "2xx"), latency)
+    histograms.record(("upload.upload_handler", "4xx"), 3)
+
+    values = histograms.flush()
+    assert not histograms.histograms
+
+    tags = {"endpoint": "upload.upload_handler", "status": "2xx"}
+    assert values[series_key("response_latency_count", **tags)] == 100
+    assert values[series_key("response_latency_max", **tags)] == 100
+    assert 45 <= values[series_key("response_latency_p50", **tags)] <= 55
+    assert 85 <= values[series_key("response_latency_p90", **tags)] <= 100
+    assert values[series_key("response_latency_p99", **tags)] <= 100
+    assert values[series_key("response_latency_bucket", bucket="50", **tags)] == 25
+
+    assert (
+        values[
+            series_key(
+                "response_latency_count",
+                endpoint="upload.upload_handler",
+                status="4xx",
+            )
+        ]
+        == 1
+    )
+
+
+async def test_histogram_max_series():
+    histograms = Histograms("db_query", ("query",), max_series=2)
+    for query in ("SELECT 1", "SELECT 2", "SELECT 3", "SELECT 4", "SELECT 1"):
+        histograms.record((query,), 1)
+
+    assert set(histograms.histograms) == {("SELECT 1",), ("SELECT 2",), ("other",)}
+    assert histograms.histograms[("SELECT 1",)].total == 2
+    assert histograms.histograms[("other",)].total == 2
+
+
+class FakeInflux:
+    """Stand-in for the InfluxDB client, answering the compactor's queries
+    from a list of (timestamp, value) datapoints per measurement."""
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.queries = []
+        self.writes = []
+
+    @staticmethod
+    def _result(values):
+        return {"results": [{"series": [{"values": values}]} if values else {}]}
+
+    async def query(self, query: str):
+        self.queries.append(query)
+        words = query.split()
+        measurement = words[words.index("from") + 1]
+        points = sorted(self.data.get(measurement, []))
+
+        if "last(value)" in query:
+            return self._result(points[-1:])
+
+        if "first(value)" in query:
+            return self._result(points[:1])
+
+        start = int(words[words.index(">=") + 1])
+        end = int(words[words.index("<") + 1])
+        size = int(query.split("time(")[1].split("s)")[0]) * SEC_NANOSEC
+
+        sums = {}
+        for timestamp, value in points:
+            if start <= timestamp < end:
+                chunk = timestamp - (timestamp % size)
+                sums[chunk] = sums.get(chunk, 0) + value
+
+        return self._result(sorted(sums.items()))
+
+    async def write(self, payload: str):
+        self.writes.append(payload)
+        for line in payload.split("\n"):
+            measurement, value, timestamp = line.split(" ")
+            point = (int(timestamp), int(value[len("value=") : -1]))
+            self.data.setdefault(measurement, []).append(point)
+
+
+async def test_compactor():
+    hour = 3600 * SEC_NANOSEC
+    now = 100 * hour + 10
+
+    # 3 datapoints per hour, for 50 hours of backlog
+    source = [(hour * h + offset, 1) for h in range(48, 98) for offset in (1, 2, 3)]
+    influx = FakeInflux({"request": source})
+    ctx = CompactorContext(influx, "request", "request_hour", 3600)
+
+    await compact_single(ctx, now)
+
+    # everything up to the hour before the current one, in one write
+    assert len(influx.writes) == 1
+    assert len(influx.queries) == 3
+    assert influx.data["request_hour"] == [(hour * h, 3) for h in range(48, 98)]
+
+    # running it again in the same hour doesn't compact anything twice
+    await compact_single(ctx, now)
+    assert len(influx.writes) == 1
+
+    # new hours get appended after the ones already compacted
+    source.extend((hour * 98 + offset, 2) for offset in (1, 2))
+    await compact_single(ctx, now + hour)
+    assert len(influx.writes) == 2
+    assert influx.data["request_hour"][-1] == (hour * 98, 4)
+
+
+async def test_prometheus_exposition(app, test_cli, monkeypatch):
+    monkeypatch.setattr(app.econfig, "ENABLE_METRICS", True)
+    monkeypatch.setattr(app.econfig, "METRICS_BACKEND", "prometheus", raising=False)
+    monkeypatch.setattr(app.econfig, "PROMETHEUS_MULTIWORKER", False, raising=False)
+
+    metrics = PrometheusMetrics(app)
+    monkeypatch.setattr(app, "metrics", metrics)
+
+    metrics.submit("total_files", 42)
+    metrics.record_latency("upload.upload_handler", "2xx", 3)
+    metrics.record_latency("upload.upload_handler", "2xx", 30)
+
+    monkeypatch.setattr(app.econfig, "PROMETHEUS_TOKEN", "scraper", raising=False)
+    monkeypatch.setattr(app.econfig, "PROMETHEUS_ALLOW", [], raising=False)
+
+    resp = await test_cli.get("/metrics")
+    assert resp.status_code == 403
+
+    resp = await test_cli.get(
+        "/metrics", headers={"Authorization": "Bearer not-the-token"}
+    )
+    assert resp.status_code == 403
+
+    # the test client comes from localhost
+    monkeypatch.setattr(app.econfig, "PROMETHEUS_ALLOW", ["127.0.0.0/8"])
+    resp = await test_cli.get("/metrics")
+    assert resp.status_code == 200
+
+    monkeypatch.setattr(app.econfig, "PROMETHEUS_ALLOW", [])
+    resp = await test_cli.get("/metrics", headers={"Authorization": "Bearer scraper"})
+    assert resp.status_code == 200
+    body = await resp.get_data(as_text=True)
+
+    assert "# TYPE elixire_request_total counter" in body
+    assert "elixire_total_files 42" in body
+    assert "elixire_db_pool_size " in body
+    assert "elixire_cache_hits_total " in body
+
+    labels = 'endpoint="upload.upload_handler",status="2xx"'
+    assert (
+        f'elixire_response_latency_milliseconds_bucket{{le="5.0",{labels}}} 1' in body
+    )
+    assert (
+        f'elixire_response_latency_milliseconds_bucket{{le="+Inf",{labels}}} 2' in body
+    )
+    assert f"elixire_response_latency_milliseconds_count{{{labels}}} 2" in body
+
+
+async def test_prometheus_merge():
+    families = {
+        "elixire_request_total": {"type": "counter", "samples": [["", {}, 3]]},
+    }
+
+    body = render(merge({"1": families, "2": families}))
+    assert body.count("# TYPE elixire_request_total counter") == 1
+    assert 'elixire_request_total{worker="1"} 3' in body
+    assert 'elixire_request_total{worker="2"} 3' in body
+
+
+async def test_db_pool_instrumentation(app):
+    stats = app.db.stats
+    before = sum(h.total for h in stats.acquire_wait.histograms.values())
+
+    await app.db.fetchval("SELECT 1 + 41")
+    async with app.db.acquire() as conn:
+        await conn.fetchval("SELECT  2\n + 40")
+
+    after = sum(h.total for h in stats.acquire_wait.histograms.values())
+    assert after == before + 2
+
+    # both queries share a fingerprint
+    assert fingerprint("SELECT 1 + 41") == "SELECT ? + ?"
+    assert stats.queries.histograms[("SELECT ? + ?",)].total >= 2
+
+    pool_stats = app.db.pool_stats()
+    assert pool_stats["db_pool_size"] >= pool_stats["db_pool_in_use"] >= 0
+
+
+async def test_metrics_histograms_batch(app, monkeypatch):
+    monkeypatch.setattr(app.econfig, "ENABLE_METRICS", True)
+    metrics = app.metrics
+
+    class _Influx:
+        writes = []
+
+        async def write(self, payload: str):
+            self.writes.append(payload)
+
+    influx = _Influx()
+    monkeypatch.setattr(metrics, "influx", influx)
+    monkeypatch.setattr(metrics, "points", deque(maxlen=10))
+    monkeypatch.setattr(metrics, "_timestamps", 2)
+
+    for index in range(50):
+        metrics.record_latency(f"endpoint_{index}", "2xx", 3)
+
+    metrics.submit("a", 1)
+    await metrics._work()
+
+    # histograms don't go through the buffer, so nothing was dropped
+    histogram_lines = influx.writes[0].split("\n")
+    assert (
+        sum(line.startswith("response_latency_count") for line in histogram_lines) == 50
+    )
+    assert influx.writes[1].startswith("a value=1i ")
+    assert metrics.dropped == 0
@@ -7,6 +7,8 @@ from .common import token, username, email
 from .test_upload import png_request
 from .util.helpers import extract_url_from_emails
 
+from api.common import get_upload_profile, invalidate_upload_profiles
+
 pytestmark = pytest.mark.asyncio
 
 
@@ -48,6 +50,52 @@ async def test_limits_work(test_cli_user):
     assert rjson["shortenused"] <= rjson["shortenlimit"]
 
 
+async def test_limits_track_usage(test_cli_user):
+    resp = await test_cli_user.get("/api/limits")
+    assert resp.status_code == 200
+    before = await resp.json
+
+    resp = await test_cli_user.post("/api/shorten", json={"url": "https://elixi.re"})
+    assert resp.status_code == 200
+
+    resp = await test_cli_user.get("/api/limits")
+    assert resp.status_code == 200
+    after = await resp.json
+
+    assert after["shortenused"] == before["shortenused"] + 1
+    assert after["used"] == before["used"]
+
+
+async def test_limits_missing(test_cli_quick_user):
+    app = test_cli_quick_user.app
+    async with app.app_context():
+        await app.db.execute(
+            "DELETE FROM limits WHERE user_id = $1", test_cli_quick_user.id
+        )
+
+    # users without limits get the default ones
+    resp = await test_cli_quick_user.post(
+        "/api/shorten", json={"url": "https://elixi.re"}
+    )
+    assert resp.status_code == 200
+
+    resp = await test_cli_quick_user.get("/api/limits")
+    assert resp.status_code == 200
+    rjson = await resp.json
+    assert rjson["shortenlimit"] == 100
+    assert rjson["shortenused"] == 1
+
+    # without giving them a limits row on reads
+    async with app.app_context():
+        assert (
+            await app.db.fetchval(
+                "SELECT user_id FROM limits WHERE user_id = $1",
+                test_cli_quick_user.id,
+            )
+            is None
+        )
+
+
 async def test_patch_profile(test_cli_user):
     # request 1: getting profile info to
     # change back to later
@@ -159,3 +207,105 @@ async def test_user_deletion(test_cli_quick_user):
     )
     assert row is not None
     assert row["deleted"]
+
+
+async def test_upload_profile_invalidation(test_cli_user):
+    # shortens go through the upload profile, so it gets cached
+    resp = await test_cli_user.post("/api/shorten", json={"url": "https://elixi.re"})
+    assert resp.status_code == 200
+    assert len((await resp.json)["shortname"]) < 8
+
+    resp = await test_cli_user.patch(
+        "/api/profile",
+        json={"paranoid": True, "password": test_cli_user.password},
+    )
+    assert resp.status_code == 200
+
+    try:
+        # paranoid users get longer shortnames, right away
+        resp = await test_cli_user.post(
+            "/api/shorten", json={"url": "https://elixi.re"}
+        )
+        assert resp.status_code == 200
+        assert len((await resp.json)["shortname"]) == 8
+    finally:
+        resp = await test_cli_user.patch(
+            "/api/profile",
+            json={"paranoid": False, "password": test_cli_user.password},
+        )
+        assert resp.status_code == 200
+
+
+async def test_upload_profile_partial_change(test_cli_user):
+    app = test_cli_user.app
+    user_id = test_cli_user.id
+
+    async with app.app_context():
+        subdomain = (await get_upload_profile(user_id))["subdomain"]
+
+    # the subdomain is written, then the shorten domain isn't
+    resp = await test_cli_user.patch(
+        "/api/profile",
+        json={"subdomain": "partial", "shorten_domain": 1 << 62},
+    )
+    assert resp.status_code != 200
+
+    try:
+        # what was written is in the profile uploads see
+        async with app.app_context():
+            assert (await get_upload_profile(user_id))["subdomain"] == "partial"
+    finally:
+        resp = await test_cli_user.patch("/api/profile", json={"subdomain": subdomain})
+        assert resp.status_code == 200
+
+
+async def test_upload_profile_generation(test_cli_user):
+    app = test_cli_user.app
+    user_id = test_cli_user.id
+
+    async with app.app_context():
+        assert not (await get_upload_profile(user_id))["paranoid"]
+
+        await app.db.execute(
+            "UPDATE users SET paranoid = true WHERE user_id = $1", user_id
+        )
+
+        try:
+            # still cached
+            assert not (await get_upload_profile(user_id))["paranoid"]
+
+            await invalidate_upload_profiles()
+            assert (await get_upload_profile(user_id))["paranoid"]
+        finally:
+            await app.db.execute(
+                "UPDATE users SET paranoid = false WHERE user_id = $1", user_id
+            )
+            await app.storage.invalidate(user_id, "upload_profile")
+
+
+async def test_upload_profile_admin(test_cli_admin):
+    async def _admin_shorten():
+        return await test_cli_admin.post(
+            "/api/shorten",
+            query_string={"admin": "1"},
+            json={"url": "https://elixi.re"},
+        )
+
+    resp = await _admin_shorten()
+    assert resp.status_code == 200
+
+    app = test_cli_admin.app
+    async with app.app_context():
+        await app.db.execute(
+            "UPDATE users SET admin = false WHERE user_id = $1", test_cli_admin.id
+        )
+
+    try:
+        # demotions apply right away, even with the upload profile cached
+        resp = await _admin_shorten()
+        assert resp.status_code == 403
+    finally:
+        async with app.app_context():
+            await app.db.execute(
+                "UPDATE users SET admin = true WHERE user_id = $1", test_cli_admin.id
+            )
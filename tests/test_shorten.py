@@ -2,9 +2,11 @@
 # Copyright 2018-2019, elixi.re Team and the elixire contributors
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import json
 import pytest
 from pathlib import Path
 from .common import token, username
+from api.bp import list as list_bp
 
 pytestmark = pytest.mark.asyncio
 
@@ -70,6 +72,49 @@ async def test_shorten_complete(test_cli, test_cli_user):
     assert resp.status_code == 404
 
 
+async def test_shorten_export(test_cli_user):
+    resp = await test_cli_user.post(
+        "/api/shorten",
+        json={"url": "https://elixi.re"},
+    )
+
+    assert resp.status_code == 200
+    shortname = (await resp.json)["shortname"]
+
+    resp = await test_cli_user.get("/api/list/export")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "application/x-ndjson"
+
+    lines = (await resp.get_data()).decode().splitlines()
+    entries = [json.loads(line) for line in lines]
+    shortens = {e["shortname"]: e for e in entries if e["type"] == "shorten"}
+    assert shortens[shortname]["redirto"] == "https://elixi.re"
+
+
+async def test_shorten_export_batches(test_cli_user, monkeypatch):
+    monkeypatch.setattr(list_bp, "EXPORT_BATCH", 1)
+
+    shortnames = []
+    for _ in range(3):
+        resp = await test_cli_user.post(
+            "/api/shorten",
+            json={"url": "https://elixi.re"},
+        )
+        assert resp.status_code == 200
+        shortnames.append((await resp.json)["shortname"])
+
+    resp = await test_cli_user.get("/api/list/export")
+    assert resp.status_code == 200
+
+    lines = (await resp.get_data()).decode().splitlines()
+    entries = [json.loads(line) for line in lines if line]
+    exported = [e["shortname"] for e in entries if e["type"] == "shorten"]
+
+    # every batch follows the previous one, newest first
+    assert len(exported) == len(set(exported))
+    assert exported[:3] == shortnames[::-1]
+
+
 async def test_shorten_wrong_scheme(test_cli_user):
     some_schemes = [
         "ftp://",
@@ -92,3 +137,19 @@ async def test_shorten_wrong_scheme(test_cli_user):
         )
 
         assert resp.status_code == 400
+
+
+async def test_shortname_allocator(app):
+    # one character names run out fast, so the allocator
+    # has to move on to longer ones
+    async with app.app_context():
+        names = [(await app.shortnames.allocate(1, "shortens"))[0] for _ in range(50)]
+
+    assert len(set(names)) == len(names)
+    assert max(len(name) for name in names) > 1
+    assert app.shortnames.lengths[("shortens", 1)] > 1
+
+    taken = await app.db.fetchval(
+        "SELECT COUNT(*) FROM shortens WHERE filename = ANY($1::text[])", names
+    )
+    assert taken == 0
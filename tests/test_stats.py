@@ -2,8 +2,12 @@
 # Copyright 2018-2019, elixi.re Team and the elixire contributors
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import asyncio
+
 import pytest
 
+from api.snowflake import get_snowflake
+
 pytestmark = pytest.mark.asyncio
 
 
@@ -41,3 +45,106 @@ async def test_domains(test_cli_admin):
     assert isinstance(pub["users"], int)
     assert isinstance(pub["files"], int)
     assert isinstance(pub["shortens"], int)
+
+
+async def test_stats_update(test_cli_user):
+    resp = await test_cli_user.get("/api/stats")
+    assert resp.status_code == 200
+    before = await resp.json
+
+    resp = await test_cli_user.post("/api/shorten", json={"url": "https://elixi.re"})
+    assert resp.status_code == 200
+
+    resp = await test_cli_user.get("/api/stats")
+    assert resp.status_code == 200
+    after = await resp.json
+
+    assert after["total_shortens"] == before["total_shortens"] + 1
+    assert after["total_files"] == before["total_files"]
+
+
+async def test_stats_reconcile(test_cli_user):
+    # so the user has statistics to drift
+    resp = await test_cli_user.post("/api/shorten", json={"url": "https://elixi.re"})
+    assert resp.status_code == 200
+
+    app = test_cli_user.app
+    user_id = test_cli_user.id
+
+    async def _stats():
+        return await app.db.fetchrow(
+            "SELECT total_files, total_shortens FROM user_stats WHERE user_id = $1",
+            user_id,
+        )
+
+    async with app.app_context():
+        before = await _stats()
+
+        await app.db.execute(
+            """
+            UPDATE user_stats
+            SET total_files = total_files + 3, total_shortens = total_shortens + 5
+            WHERE user_id = $1
+            """,
+            user_id,
+        )
+
+        async with app.db.acquire() as conn:
+            tx = conn.transaction()
+            await tx.start()
+
+            # a shorten made while reconciling is kept
+            await conn.execute(
+                """
+                INSERT INTO shortens (shorten_id, filename, redirto, uploader)
+                VALUES ($1, $2, 'https://elixi.re', $3)
+                """,
+                get_snowflake(),
+                f"reconcile{user_id}",
+                user_id,
+            )
+
+            reconcile = asyncio.ensure_future(
+                app.db.execute("SELECT reconcile_stats()")
+            )
+            await asyncio.sleep(0.1)
+            await tx.commit()
+            await reconcile
+
+        after = await _stats()
+        assert after["total_files"] == before["total_files"]
+        assert after["total_shortens"] == before["total_shortens"] + 1
+
+
+async def test_stats_reconcile_no_uploader(test_cli_user):
+    app = test_cli_user.app
+
+    async def _domain_stats():
+        return await app.db.fetchval(
+            "SELECT shortens FROM domain_stats "
+            "WHERE domain_id = 0 AND consented = false"
+        )
+
+    async with app.app_context():
+        await app.db.execute("SELECT reconcile_stats()")
+        before = await _domain_stats() or 0
+
+        shorten_id = get_snowflake()
+        await app.db.execute(
+            """
+            INSERT INTO shortens (shorten_id, filename, redirto, uploader, domain)
+            VALUES ($1, $2, 'https://elixi.re', NULL, 0)
+            """,
+            shorten_id,
+            f"nouploader{shorten_id}",
+        )
+
+        try:
+            # counted the same by the trigger and by reconciling
+            assert await _domain_stats() == before + 1
+            await app.db.execute("SELECT reconcile_stats()")
+            assert await _domain_stats() == before + 1
+        finally:
+            await app.db.execute(
+                "DELETE FROM shortens WHERE shorten_id = $1", shorten_id
+            )
@@ -4,7 +4,9 @@
 
 import io
 import os
+import hashlib
 import time
+import zlib
 import asyncio
 import pytest
 import os.path
@@ -17,6 +19,11 @@ from quart.datastructures import FileStorage
 
 from .common import png_data, hexs
 from api.common import thumbnail_janitor_tick
+from api.common import common as api_common
+from api.clamd import ClamdClient
+from api.bp.upload.file import UploadFile
+from api.bp.upload.scan_queue import queue_scan, scan_worker
+from api.bp.upload.virus import set_verdict
 
 pytestmark = pytest.mark.asyncio
 
@@ -160,12 +167,15 @@ async def test_delete_file(test_cli_user):
     await check_exists(test_cli_user, respjson["shortname"], True)
 
 
-async def test_delete_all_files(test_cli_user):
-    kwargs = png_request()
-    resp = await test_cli_user.post("/api/upload", **kwargs)
+async def test_delete_all_files(test_cli_user, monkeypatch):
+    # go through more than one batch
+    monkeypatch.setattr(api_common, "DELETE_BATCH", 1)
 
-    assert resp.status_code == 200
-    respjson = await resp.json
+    shortnames = []
+    for _ in range(2):
+        resp = await test_cli_user.post("/api/upload", **png_request())
+        assert resp.status_code == 200
+        shortnames.append((await resp.json)["shortname"])
 
     resp = await test_cli_user.post(
         "/api/delete_all",
@@ -181,7 +191,210 @@ async def test_delete_all_files(test_cli_user):
         timeout=5,
     )
 
-    await check_exists(test_cli_user, respjson["shortname"], deleted=True)
+    for shortname in shortnames:
+        await check_exists(test_cli_user, shortname, deleted=True)
+
+
+async def test_upload_blob_refcount(test_cli_user, test_cli_admin):
+    app = test_cli_user.app
+    data = png_data().getvalue()
+
+    shortnames = []
+    for client in (test_cli_user, test_cli_admin):
+        resp = await client.post("/api/upload", **png_request(io.BytesIO(data)))
+        assert resp.status_code == 200
+        shortnames.append((await resp.json)["shortname"])
+
+    fspath = await app.db.fetchval(
+        "SELECT fspath FROM files WHERE filename = $1", shortnames[0]
+    )
+
+    async def _refcount():
+        return await app.db.fetchval(
+            "SELECT refcount FROM blobs WHERE fspath = $1", fspath
+        )
+
+    # both files share the same blob
+    assert await _refcount() == 2
+
+    # drift is fixed by reconciling
+    await app.db.execute(
+        "UPDATE blobs SET refcount = refcount + 3 WHERE fspath = $1", fspath
+    )
+    await app.db.execute("SELECT reconcile_blobs()")
+    assert await _refcount() == 2
+
+    resp = await test_cli_admin.delete(f"/api/delete/{shortnames[1]}")
+    assert resp.status_code == 200
+    assert await _refcount() == 1
+    assert os.path.exists(fspath)
+
+    resp = await test_cli_user.delete(f"/api/delete/{shortnames[0]}")
+    assert resp.status_code == 200
+    assert await _refcount() is None
+    assert not os.path.exists(fspath)
+
+
+async def test_release_blobs_locked(test_cli_user, monkeypatch):
+    app = test_cli_user.app
+    data = png_data().getvalue() + hexs(16).encode()
+
+    resp = await test_cli_user.post("/api/upload", **png_request(io.BytesIO(data)))
+    assert resp.status_code == 200
+    shortname = (await resp.json)["shortname"]
+
+    fspath = await app.db.fetchval(
+        "SELECT fspath FROM files WHERE filename = $1", shortname
+    )
+
+    seen = []
+
+    async def _delete_many(locations):
+        # the blob row is still there for others until the contents are gone
+        async with app.db.acquire() as conn:
+            seen.append(
+                await conn.fetchval(
+                    "SELECT refcount FROM blobs WHERE fspath = $1", fspath
+                )
+            )
+
+        raise OSError("storage is down")
+
+    monkeypatch.setattr(app.blobs, "delete_many", _delete_many)
+
+    resp = await test_cli_user.delete(f"/api/delete/{shortname}")
+    assert resp.status_code == 200
+    assert seen == [0]
+
+    # failing to delete contents doesn't bring the blob back
+    assert (
+        await app.db.fetchval("SELECT 1 FROM blobs WHERE fspath = $1", fspath) is None
+    )
+
+
+async def test_upload_blob_crc(test_cli_user):
+    app = test_cli_user.app
+
+    resp = await test_cli_user.post("/api/upload", **png_request())
+    assert resp.status_code == 200
+    shortname = (await resp.json)["shortname"]
+
+    row = await app.db.fetchrow(
+        """
+        SELECT blobs.fspath, blobs.crc
+        FROM files
+        JOIN blobs ON blobs.fspath = files.fspath
+        WHERE files.filename = $1
+        """,
+        shortname,
+    )
+
+    # the crc of what's stored, kept for data dumps
+    assert row["crc"] == zlib.crc32(Path(row["fspath"]).read_bytes())
+
+
+async def test_upload_blob_released(test_cli_user, monkeypatch):
+    app = test_cli_user.app
+    resolve = UploadFile.resolve
+
+    async def _resolve(self, extension):
+        await resolve(self, extension)
+
+        # like the blob being released right after it was looked up
+        self.stored = True
+
+    monkeypatch.setattr(UploadFile, "resolve", _resolve)
+
+    data = png_data().getvalue() + hexs(16).encode()
+    resp = await test_cli_user.post("/api/upload", **png_request(io.BytesIO(data)))
+    assert resp.status_code == 200
+    shortname = (await resp.json)["shortname"]
+
+    fspath = await app.db.fetchval(
+        "SELECT fspath FROM files WHERE filename = $1", shortname
+    )
+
+    # the contents were stored anyways
+    assert os.path.exists(fspath)
+    assert Path(fspath).read_bytes() == data
+
+
+async def test_scan_queue(test_cli_user, clamd, monkeypatch):
+    app = test_cli_user.app
+
+    resp = await test_cli_user.post("/api/upload", **png_request())
+    assert resp.status_code == 200
+    rjson = await resp.json
+    shortname = rjson["shortname"]
+    host = urlparse(rjson["url"]).netloc
+
+    row = await app.db.fetchrow(
+        "SELECT file_id, domain FROM files WHERE filename = $1", shortname
+    )
+
+    async with app.db.acquire() as conn:
+        await queue_scan(conn, row["file_id"])
+
+    async def _fetch():
+        return await test_cli_user.get(
+            f"/i/{shortname}.png", do_token=False, headers={"host": host}
+        )
+
+    # pending files aren't served unless SERVE_UNSCANNED is set
+    monkeypatch.setattr(app.econfig, "SERVE_UNSCANNED", False, raising=False)
+    await app.storage.raw_invalidate(f"fspath:{row['domain']}:{shortname}")
+    assert (await _fetch()).status_code == 404
+
+    client = ClamdClient(clamd.address)
+    monkeypatch.setattr(app, "clamd", client)
+
+    async with app.app_context():
+        await scan_worker()
+
+    await client.close()
+
+    pending = await app.db.fetchval(
+        "SELECT COUNT(*) FROM scan_queue WHERE file_id = $1", row["file_id"]
+    )
+    assert pending == 0
+    assert clamd.connections == 1
+    assert (await _fetch()).status_code == 200
+
+
+async def test_scan_verdicts(test_cli_user, clamd, monkeypatch):
+    app = test_cli_user.app
+    client = ClamdClient(clamd.address)
+    monkeypatch.setattr(app, "clamd", client)
+    monkeypatch.setattr(app.econfig, "UPLOAD_SCAN", True)
+
+    # verdicts outlive test runs, so contents must be new
+    data = png_data().getvalue() + hexs(16).encode()
+    for _ in range(2):
+        resp = await test_cli_user.post("/api/upload", **png_request(io.BytesIO(data)))
+        assert resp.status_code == 200
+
+    # the same contents were only scanned once
+    assert clamd.scans == 1
+
+    # known bad contents are rejected without scanning them
+    data = png_data().getvalue() + hexs(16).encode()
+    file_hash = hashlib.sha256(data).hexdigest()
+    async with app.app_context():
+        await set_verdict(await client.version(), file_hash, "Eicar-Signature")
+
+    resp = await test_cli_user.post("/api/upload", **png_request(io.BytesIO(data)))
+    assert resp.status_code == 415
+    assert clamd.scans == 1
+
+    # verdicts are for a version of the signatures
+    clamd.signatures += 1
+    client._version = None
+
+    resp = await test_cli_user.post("/api/upload", **png_request(io.BytesIO(data)))
+    assert resp.status_code == 200
+    assert clamd.scans == 2
+
+    await client.close()
 
 
 async def test_delete_nonexist(test_cli_user):
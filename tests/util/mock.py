@@ -2,6 +2,8 @@
 # Copyright 2018-2019, elixi.re Team and the elixire contributors
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import asyncio
+import struct
 
 from quart import current_app as app
 from collections import namedtuple
@@ -13,6 +15,8 @@ from api.bp.admin.audit_log import AuditLog
 
 WrappedResponse = namedtuple("WrappedResponse", ("status",))
 
+EICAR = b"X5O!P%@AP[4\\PZX54(P^)7CC)7}$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!$H+H*"
+
 
 async def mocked_send_email(user_email: str, subject: str, email_body: str) -> tuple:
     app._test_email_list.append(
@@ -51,3 +55,77 @@ class MockResolver:
 
     def query(self, domain: str, resource_type: str) -> None:
         self.test_queries.append({"domain": domain, "resource_type": resource_type})
+
+
+class FakeClamd:
+    """Speaks enough of the clamd protocol for the client."""
+
+    def __init__(self, *, delay: float = 0, max_length: int = 1024 * 1024):
+        self.delay = delay
+        self.max_length = max_length
+        #: how many sessions were opened
+        self.connections = 0
+        self.writers = []
+        self.tasks = []
+
+        #: version of the signatures, and how many streams were scanned
+        self.signatures = 26830
+        self.scans = 0
+
+    async def _instream(self, reader) -> bytes:
+        data = b""
+        while True:
+            (length,) = struct.unpack(">L", await reader.readexactly(4))
+            if not length:
+                return data
+
+            data += await reader.readexactly(length)
+            if len(data) > self.max_length:
+                return None
+
+    async def handle(self, reader, writer):
+        self.writers.append(writer)
+        self.tasks.append(asyncio.current_task())
+
+        command = await reader.readuntil(b"\0")
+        if command == b"zVERSION\0":
+            version = f"ClamAV 1.0.0/{self.signatures}/Mon Mar  6 08:22:42 2023"
+            writer.write(f"{version}\0".encode())
+            writer.close()
+            return
+
+        assert command == b"zIDSESSION\0"
+        self.connections += 1
+
+        command_id = 0
+        while True:
+            try:
+                command = await reader.readuntil(b"\0")
+            except asyncio.IncompleteReadError:
+                break
+
+            if command == b"zEND\0":
+                break
+
+            assert command == b"zINSTREAM\0"
+            command_id += 1
+            self.scans += 1
+
+            data = await self._instream(reader)
+            await asyncio.sleep(self.delay)
+
+            if data is None:
+                reply = "INSTREAM size limit exceeded. ERROR"
+            elif EICAR in data:
+                reply = "stream: Eicar-Signature FOUND"
+            else:
+                reply = "stream: OK"
+
+            writer.write(f"{command_id}: {reply}\0".encode())
+            await writer.drain()
+
+        writer.close()
+
+    def disconnect(self):
+        for writer in self.writers:
+            writer.close()